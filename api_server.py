@@ -0,0 +1,373 @@
+"""
+This file runs a read-only JSON API on the scores in MongoDB, so that
+consumers can look up a few labels or patents without downloading the whole
+db2csv.csv.zip.
+Run with `nohup python3 api_server.py -port 8080 &` with no quotes.
+
+Endpoints:
+
+    GET /api/labels/<label_id>/additions/<addition_key>/claims?k=10
+        top k scored claims of an addition of a label
+
+    GET /api/patents/<patent_number>/additions?min_score=0.5&limit=50
+                                              &cursor=<label_id>
+        additions of labels related to the patent with a score of at least
+        min_score for a claim of the patent, one page of labels at a time
+
+    GET /api/set_ids/<set_id>/diffs?limit=10&cursor=<published_date>|<_id>
+        diff_against_previous_label of the labels of a set_id, by
+        published_date
+
+Paginated responses include 'next_cursor', which is null on the last page.
+All threads share one MongoClient (and its connection pool), every query is
+answered by an index (see MongoClient.required_indexes(), created with
+`main.py -indexes`, as the API never writes to MongoDB), and successful
+responses are kept in an in-process LRU cache.
+"""
+
+import argparse
+from bson import json_util
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from collections import OrderedDict
+from dotenv import dotenv_values
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import re
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+
+from db import score_store
+from db.mongo import MongoClient
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+_config = dict(
+    dotenv_values(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), ".env")
+    )
+)
+
+MAX_K = 1000
+MAX_LIMIT = 500
+
+# addition keys usable in a projection path: no leading '$' and no '.'
+ADDITION_KEY_PATTERN = re.compile(r"^[^$.][^.]*$")
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of responses, with entries expiring after ttl."""
+
+    def __init__(self, capacity=1024, ttl=300):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _int_param(params, name, default, maximum):
+    """Returns the int query parameter name within [1, maximum]."""
+    try:
+        value = int(params.get(name, [default])[0])
+    except ValueError:
+        raise BadRequest(f"'{name}' must be an integer")
+    if value < 1:
+        raise BadRequest(f"'{name}' must be at least 1")
+    return min(value, maximum)
+
+
+def _float_param(params, name, default):
+    """Returns the float query parameter name."""
+    try:
+        return float(params.get(name, [default])[0])
+    except ValueError:
+        raise BadRequest(f"'{name}' must be a number")
+
+
+def _object_id(value, name):
+    """Returns ObjectId(value), raising BadRequest if value is invalid."""
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise BadRequest(f"'{name}' must be a label _id")
+
+
+def addition_claims(mongo_client, label_id, addition_key, params):
+    """Returns the top k claims of an addition, or None if not found."""
+    k = _int_param(params, "k", 10, MAX_K)
+    if not ADDITION_KEY_PATTERN.match(addition_key):
+        raise BadRequest("'addition_key' must not start with '$' or hold '.'")
+    label = mongo_client.label_collection.find_one(
+        {"_id": _object_id(label_id, "label_id")},
+        {f"additions.{addition_key}": 1, "score_claims": 1},
+    )
+    if not label or addition_key not in (label.get("additions") or {}):
+        return None
+    label = score_store.expand_scores(mongo_client, [label])[0]
+    addition = label["additions"][addition_key]
+    scores = sorted(
+        addition.get("scores") or [], key=lambda x: x["score"], reverse=True
+    )
+    return {
+        "label_id": label_id,
+        "addition_key": addition_key,
+        "expanded_content": addition.get("expanded_content"),
+        "claims": scores[:k],
+    }
+
+
+def patent_additions(mongo_client, patent_number, params):
+    """
+    Returns one page of additions scored against claims of patent_number with
+    a score of at least min_score.  Pages are ranges of label _id.
+    """
+    min_score = _float_param(params, "min_score", 0.5)
+    limit = _int_param(params, "limit", 50, MAX_LIMIT)
+    query = {"nda_to_patent.patents": patent_number}
+    if params.get("cursor"):
+        query["_id"] = {"$gt": _object_id(params["cursor"][0], "cursor")}
+    labels = list(
+        mongo_client.label_collection.find(
+            query,
+            {
+                "set_id": 1,
+                "published_date": 1,
+                "additions": 1,
+                "score_claims": 1,
+            },
+        )
+        .sort("_id", 1)
+        .limit(limit)
+    )
+    labels = score_store.expand_scores(mongo_client, labels)
+    additions = []
+    for label in labels:
+        for key, addition in (label.get("additions") or {}).items():
+            claims = [
+                x
+                for x in addition.get("scores") or []
+                if str(x["patent_number"]) == patent_number
+                and x["score"] >= min_score
+            ]
+            if claims:
+                additions.append(
+                    {
+                        "label_id": str(label["_id"]),
+                        "set_id": label["set_id"],
+                        "published_date": label["published_date"],
+                        "addition_key": key,
+                        "expanded_content": addition.get("expanded_content"),
+                        "claims": sorted(
+                            claims, key=lambda x: x["score"], reverse=True
+                        ),
+                    }
+                )
+    return {
+        "patent_number": patent_number,
+        "min_score": min_score,
+        "additions": additions,
+        "next_cursor": str(labels[-1]["_id"]) if len(labels) == limit else None,
+    }
+
+
+def _diff_cursor(value):
+    """
+    Returns (published_date, _id) of a '<published_date>|<_id>' cursor of
+    set_id_diffs(), raising BadRequest if value is invalid.
+    """
+    published_date, sep, label_id = value.rpartition("|")
+    if not sep:
+        raise BadRequest("'cursor' must be '<published_date>|<_id>'")
+    return published_date, _object_id(label_id, "cursor")
+
+
+def set_id_diffs(mongo_client, set_id, params):
+    """
+    Returns one page of label diffs of set_id, by published_date and _id.
+    Pages are ranges of (published_date, _id), so labels sharing a
+    published_date are not skipped.  Copies of additions within the diffs are
+    replaced by their keys.
+    """
+    limit = _int_param(params, "limit", 10, MAX_LIMIT)
+    query = {"set_id": set_id}
+    if params.get("cursor"):
+        published_date, label_id = _diff_cursor(params["cursor"][0])
+        query["$or"] = [
+            {"published_date": {"$gt": published_date}},
+            {"published_date": published_date, "_id": {"$gt": label_id}},
+        ]
+    labels = list(
+        mongo_client.label_collection.find(
+            query,
+            {
+                "published_date": 1,
+                "previous_label_published_date": 1,
+                "spl_id": 1,
+                "spl_version": 1,
+                "diff_against_previous_label": 1,
+            },
+        )
+        .sort([("published_date", 1), ("_id", 1)])
+        .limit(limit)
+    )
+    for label in labels:
+        label["_id"] = str(label["_id"])
+        for diff in label.get("diff_against_previous_label") or []:
+            diff["text"] = [text[:3] for text in diff["text"]]
+    return {
+        "set_id": set_id,
+        "labels": labels,
+        "next_cursor": f"{labels[-1]['published_date']}|{labels[-1]['_id']}"
+        if len(labels) == limit
+        else None,
+    }
+
+
+ROUTES = [
+    (
+        re.compile(r"^/api/labels/([^/]+)/additions/([^/]+)/claims$"),
+        addition_claims,
+    ),
+    (re.compile(r"^/api/patents/([^/]+)/additions$"), patent_additions),
+    (re.compile(r"^/api/set_ids/([^/]+)/diffs$"), set_id_diffs),
+]
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    """Answers GET requests of ROUTES with JSON."""
+
+    mongo_client = None
+    cache = ResponseCache()
+
+    def do_GET(self):
+        start = time.time()
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        key = (
+            url.path,
+            tuple(sorted((k, tuple(v)) for k, v in params.items())),
+        )
+        body = self.cache.get(key)
+        status = HTTPStatus.OK
+        if body is None:
+            status, response = self._route(url)
+            body = json_util.dumps(response).encode()
+            if status == HTTPStatus.OK:
+                self.cache.put(key, body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == HTTPStatus.OK:
+            self.send_header("Cache-Control", f"max-age={self.cache.ttl}")
+        else:
+            self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+        _logger.info(
+            f'{self.address_string()} "{self.requestline}" {int(status)} '
+            f"{len(body)} bytes {time.time() - start:.3f}s"
+        )
+
+    def _route(self, url):
+        """Returns (status, response) of the handler of url."""
+        for pattern, handler in ROUTES:
+            match = pattern.match(url.path)
+            if not match:
+                continue
+            try:
+                response = handler(
+                    self.mongo_client,
+                    *[unquote(x) for x in match.groups()],
+                    parse_qs(url.query),
+                )
+            except BadRequest as e:
+                return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+            except Exception:
+                # such as MongoDB errors; answered instead of dropping the
+                # connection
+                _logger.exception(f"Error answering {url.path}")
+                return (
+                    HTTPStatus.INTERNAL_SERVER_ERROR,
+                    {"error": "Internal server error"},
+                )
+            if response is None:
+                return HTTPStatus.NOT_FOUND, {"error": "Not found"}
+            return HTTPStatus.OK, response
+        return HTTPStatus.NOT_FOUND, {"error": "Unknown endpoint"}
+
+    def log_request(self, code="-", size="-"):
+        # logged with duration once the response is sent
+        pass
+
+    def log_message(self, format, *args):
+        _logger.warning(f"{self.address_string()} {format % args}")
+
+
+def make_server(mongo_client, host="", port=8080, cache_size=1024, ttl=300):
+    """
+    Returns a ThreadingHTTPServer answering ROUTES.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        host (String): address to listen on; all addresses if ""
+        port (int): port to listen on
+        cache_size (int): number of responses kept in the LRU cache
+        ttl (int): seconds a cached response is valid
+    """
+    handler = type(
+        "Handler",
+        (APIHandler,),
+        {"mongo_client": mongo_client, "cache": ResponseCache(cache_size, ttl)},
+    )
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the scores API.")
+    parser.add_argument("-port", "--port", type=int, default=8080)
+    parser.add_argument("-cache_size", "--cache_size", type=int, default=1024)
+    parser.add_argument("-ttl", "--ttl", type=int, default=300)
+    args = parser.parse_args()
+
+    mongo_client = MongoClient(
+        _config["MONGODB_LABEL_COLLECTION_NAME"],
+        _config["MONGODB_LABELMAP_COLLECTION_NAME"],
+        _config["MONGODB_PATENT_COLLECTION_NAME"],
+        _config["MONGODB_ORANGE_BOOK_COLLECTION_NAME"],
+        score_collection_name=_config.get(
+            "MONGODB_SCORE_COLLECTION_NAME", "scores"
+        ),
+    )
+
+    server_object = make_server(
+        mongo_client, port=args.port, cache_size=args.cache_size, ttl=args.ttl
+    )
+    _logger.info(f"Serving API on port {args.port}")
+    server_object.serve_forever()
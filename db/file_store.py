@@ -0,0 +1,135 @@
+"""
+Stores exported files, such as the -db2csv zip file, in GridFS so that files
+larger than the 16 MB document limit can be uploaded and downloaded in
+streamed chunks.
+
+Each upload is a new version of the file name within the bucket.  The sha256
+of the content is kept in the file metadata:
+
+    {
+        'filename': 'db2csv.csv.zip',
+        'metadata': {
+            'sha256': '...',
+            'description': 'Last Edit Sep-16-2019',
+        },
+        ...
+    }
+
+An upload is skipped if the latest version has the same sha256, and only the
+newest versions are kept.  Files must be written reproducibly for uploads to
+be skipped, such as the zip file of -db2csv, whose entry has a fixed date.
+"""
+
+from datetime import date
+import gridfs
+import hashlib
+import os
+import pymongo
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+EXPORT_BUCKET_NAME = "exports"
+
+CHUNK_SIZE = 1 << 20
+
+
+def _sha256(file_name, chunk_size=CHUNK_SIZE):
+    """Returns the sha256 hex digest of the content of file_name."""
+    sha256 = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for data in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def _versions(bucket, name):
+    """Returns a cursor of all versions of name, newest first."""
+    return bucket.find({"filename": name}).sort(
+        "uploadDate", pymongo.DESCENDING
+    )
+
+
+def upload_file(
+    mongo_client,
+    file_name,
+    bucket_name=EXPORT_BUCKET_NAME,
+    keep_versions=3,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Uploads file_name to GridFS as a new version of its base name.  Returns
+    the _id of the new version, or None if the content is unchanged since the
+    latest version.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        file_name (Path): file to upload
+        bucket_name (String): name of the GridFS bucket
+        keep_versions (int): number of newest versions to keep
+        chunk_size (int): size of GridFS chunks in bytes
+    """
+    bucket = gridfs.GridFSBucket(mongo_client.db, bucket_name)
+    name = os.path.basename(file_name)
+    sha256 = _sha256(file_name)
+
+    latest = next(iter(_versions(bucket, name).limit(1)), None)
+    if latest is not None and (latest.metadata or {}).get("sha256") == sha256:
+        _logger.info(f"{name} is unchanged; skipping upload")
+        return None
+
+    # ex: Sep-16-2019
+    date_str = date.today().strftime("%b-%d-%Y")
+    with open(file_name, "rb") as f:
+        file_id = bucket.upload_from_stream(
+            name,
+            f,
+            chunk_size_bytes=chunk_size,
+            metadata={"sha256": sha256, "description": "Last Edit " + date_str},
+        )
+    _logger.info(f"Uploaded {name} ({os.path.getsize(file_name)} bytes)")
+
+    for old in _versions(bucket, name).skip(max(keep_versions, 1)):
+        bucket.delete(old._id)
+        _logger.info(f"Deleted version {old._id} of {name}")
+    return file_id
+
+
+def download_file(
+    mongo_client,
+    name,
+    file_name,
+    bucket_name=EXPORT_BUCKET_NAME,
+    revision=-1,
+):
+    """
+    Streams a version of name from GridFS to file_name and verifies its
+    sha256.  Returns file_name.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        name (String): file name within the bucket, ex: 'db2csv.csv.zip'
+        file_name (Path): location to store the file
+        bucket_name (String): name of the GridFS bucket
+        revision (int): -1 for the newest version, 0 for the oldest version
+    """
+    bucket = gridfs.GridFSBucket(mongo_client.db, bucket_name)
+    file_name = str(file_name)
+    if os.path.dirname(file_name) and not os.path.exists(
+        os.path.dirname(file_name)
+    ):
+        os.makedirs(os.path.dirname(file_name))
+    sha256 = hashlib.sha256()
+    with bucket.open_download_stream_by_name(name, revision) as grid_out:
+        expected = (grid_out.metadata or {}).get("sha256")
+        with open(file_name + ".part", "wb") as f:
+            for chunk in grid_out:
+                sha256.update(chunk)
+                f.write(chunk)
+    if expected and sha256.hexdigest() != expected:
+        os.remove(file_name + ".part")
+        raise ValueError(f"Checksum mismatch of {name} from GridFS")
+    os.replace(file_name + ".part", file_name)
+    _logger.info(f"Downloaded {name} to {file_name}")
+    return file_name
@@ -1,11 +1,15 @@
 from dotenv import dotenv_values
+from bson import json_util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import os
 import pymongo
-from bson.objectid import ObjectId
-import dateutil
-import json
+from pymongo.errors import BulkWriteError
 import sys
+import time
 
+from utils import misc
 from utils.logging import getLogger
 
 _logger = getLogger(__name__)
@@ -25,6 +29,7 @@ class MongoClient:
         patent_collection_name,
         orange_book_collection_name,
         alt_db_name=None,
+        score_collection_name="scores",
     ):
         """
         Initializes a MongoDB connection and stores strings of collection names
@@ -35,15 +40,186 @@ class MongoClient:
             orange_book_collection_name (String): name of orange book collection
             alt_db_name (String): name of database if different from the one in
                                   `.env`. Used mainly for unit-tests.
+            score_collection_name (String): name of the collection storing
+                                            scores outside of labels
         """
         self.db = connect_mongo(alt_db_name)
         self.label_collection_name = label_collection_name
         self.labelmap_collection_name = labelmap_collection_name
         self.patent_collection_name = patent_collection_name
         self.orange_book_collection_name = orange_book_collection_name
+        self.score_collection_name = score_collection_name
         self.label_collection = self.db[self.label_collection_name]
         self.patent_collection = self.db[self.patent_collection_name]
         self.orange_book_collection = self.db[self.orange_book_collection_name]
+        self.score_collection = self.db[self.score_collection_name]
+
+    def required_indexes(self):
+        """
+        Returns a dict of {collection_name: [index keys,]} of all indexes the
+        queries of this package rely on.
+        """
+        return {
+            self.label_collection_name: [
+                [("application_numbers", pymongo.ASCENDING)],
+                [
+                    ("nda_group_key", pymongo.ASCENDING),
+                    ("set_id", pymongo.ASCENDING),
+                    ("published_date", pymongo.ASCENDING),
+                ],
+                # diff pages of api_server.py
+                [
+                    ("set_id", pymongo.ASCENDING),
+                    ("published_date", pymongo.ASCENDING),
+                    ("_id", pymongo.ASCENDING),
+                ],
+                # patent lookups of api_server.py
+                [
+                    ("nda_to_patent.patents", pymongo.ASCENDING),
+                    ("_id", pymongo.ASCENDING),
+                ],
+            ],
+            self.patent_collection_name: [
+                [("patent_number", pymongo.ASCENDING)],
+            ],
+            self.orange_book_collection_name: [
+                [("nda", pymongo.ASCENDING)],
+                [("created_at", pymongo.ASCENDING)],
+            ],
+            self.score_collection_name: [
+                [("label_id", pymongo.ASCENDING)],
+            ],
+        }
+
+    def create_indexes(self):
+        """
+        Creates all indexes returned by required_indexes().  Indexes that
+        already exist are left unchanged.
+        """
+        for collection_name, indexes in self.required_indexes().items():
+            for keys in indexes:
+                name = self.db[collection_name].create_index(keys)
+                _logger.info(f"Index '{name}' on '{collection_name}'")
+
+    def index_sizes(self):
+        """
+        Returns a dict of {collection_name: {index_name: size_in_bytes,},} for
+        the collections of required_indexes().
+        """
+        sizes = {}
+        for collection_name in self.required_indexes().keys():
+            if collection_name in self.db.list_collection_names():
+                sizes[collection_name] = self.db.command(
+                    "collStats", collection_name
+                )["indexSizes"]
+        return sizes
+
+    def sample_queries(self):
+        """
+        Returns a list of (collection_name, query, sort) representative of the
+        queries of this package, with values taken from documents in the
+        database.  Queries on empty collections are omitted.
+        """
+        queries = []
+        label = self.label_collection.find_one(
+            {"application_numbers.0": {"$exists": True}},
+            {"application_numbers": 1, "set_id": 1},
+        )
+        if label:
+            application_numbers = label["application_numbers"]
+            queries += [
+                (
+                    self.label_collection_name,
+                    {"nda_group_key": misc.nda_group_key(application_numbers)},
+                    [
+                        ("set_id", pymongo.ASCENDING),
+                        ("published_date", pymongo.ASCENDING),
+                    ],
+                ),
+                (
+                    self.label_collection_name,
+                    {"application_numbers": {"$in": application_numbers}},
+                    None,
+                ),
+                (
+                    self.label_collection_name,
+                    {"set_id": label["set_id"]},
+                    [("published_date", pymongo.ASCENDING)],
+                ),
+            ]
+        label = self.label_collection.find_one(
+            {"nda_to_patent.patents.0": {"$exists": True}},
+            {"nda_to_patent": 1},
+        )
+        if label:
+            patent_number = next(
+                x["patents"][0] for x in label["nda_to_patent"] if x["patents"]
+            )
+            queries.append(
+                (
+                    self.label_collection_name,
+                    {
+                        "nda_to_patent.patents": patent_number,
+                        "_id": {"$gt": label["_id"]},
+                    },
+                    [("_id", pymongo.ASCENDING)],
+                )
+            )
+        patent = self.patent_collection.find_one({}, {"patent_number": 1})
+        if patent:
+            queries.append(
+                (
+                    self.patent_collection_name,
+                    {"patent_number": patent["patent_number"]},
+                    None,
+                )
+            )
+        orange_book = self.orange_book_collection.find_one(
+            {}, {"nda": 1, "created_at": 1}
+        )
+        if orange_book:
+            queries += [
+                (
+                    self.orange_book_collection_name,
+                    {"nda": orange_book["nda"]},
+                    None,
+                ),
+                (
+                    self.orange_book_collection_name,
+                    {"created_at": {"$gte": orange_book["created_at"]}},
+                    None,
+                ),
+            ]
+        score = self.score_collection.find_one({}, {"label_id": 1})
+        if score:
+            queries.append(
+                (
+                    self.score_collection_name,
+                    {"label_id": score["label_id"]},
+                    None,
+                )
+            )
+        return queries
+
+    def verify_indexes(self):
+        """
+        Runs explain() on each query of sample_queries() and returns a list of
+        (collection_name, query) whose winning plan is a collection scan.
+        """
+        collection_scans = []
+        for collection_name, query, sort in self.sample_queries():
+            cursor = self.db[collection_name].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            if "COLLSCAN" in str(plan):
+                _logger.error(
+                    f"Query {query} on '{collection_name}' is a COLLSCAN"
+                )
+                collection_scans.append((collection_name, query))
+            else:
+                _logger.info(f"Query {query} on '{collection_name}' uses index")
+        return collection_scans
 
     def drop_collection(self, collection_name):
         """
@@ -57,36 +233,169 @@ class MongoClient:
         collection = db[collection_name]
         collection.drop()
 
-    def reimport_collection(self, collection_name, file_name):
+    def reimport_collection(
+        self,
+        collection_name,
+        file_name,
+        start_line=0,
+        batch_size=1000,
+        workers=4,
+    ):
         """
-        Reimports collection from file_name into MongoDB
+        Reimports collection from file_name into MongoDB.  file_name is read
+        lazily, each line is decoded as MongoDB extended json, and batches of
+        documents are inserted by a pool of worker threads.
 
         Parameters:
             collection_name (String):
                 name of the collection to reimport
             file_name (path):
                 location of the json file for the collection to import
+            start_line (int):
+                number of lines of file_name to skip; if set, the collection is
+                not dropped so that an interrupted reimport can be resumed
+                from the last line reported in the log
+            batch_size (int):
+                number of documents per insert_many
+            workers (int):
+                number of threads inserting batches
         """
         db = self.db
         collection = db[collection_name]
-        collection.drop()
-        with open(file_name, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                doc = json.loads(line)
-                doc["_id"] = ObjectId(doc["_id"]["$oid"])
-                # additional code to process oid in claims
-                if "claims" in doc.keys():
-                    for item in doc["claims"]:
-                        if "_id" in item.keys():
-                            item["_id"] = ObjectId(item["_id"]["$oid"])
-                if "created_at" in doc:
-                    doc["created_at"] = dateutil.parser.parse(
-                        doc["created_at"]["$date"]
-                    )
-                collection.insert_one(doc)
+        if not start_line:
+            collection.drop()
+
+        def insert_batch(lines):
+            docs = [json_util.loads(line) for line in lines if line.strip()]
+            if collection_name == self.label_collection_name:
+                for doc in docs:
+                    if doc.get("application_numbers"):
+                        doc["nda_group_key"] = misc.nda_group_key(
+                            doc["application_numbers"]
+                        )
+            if docs:
+                try:
+                    collection.insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    # when resuming, docs after the reported line may already
+                    # have been inserted
+                    if any(
+                        x["code"] != 11000 for x in e.details["writeErrors"]
+                    ):
+                        raise
+            return len(docs)
+
+        def wait_for_oldest():
+            nonlocal inserted
+            future, done_line = pending.popleft()
+            inserted += future.result()
+            elapsed = max(time.time() - start_time, 1e-9)
+            _logger.info(
+                f"Reimported {inserted} docs into '{collection_name}' "
+                f"({inserted / elapsed:.0f} docs/sec), through line "
+                f"{done_line} of '{file_name}'"
+            )
+
+        start_time = time.time()
+        inserted = 0
+        line_num = start_line
+        # futures are waited on in order, so all lines before the reported
+        # line number have been inserted
+        pending = deque()
+        with open(file_name, "r") as f, ThreadPoolExecutor(workers) as pool:
+            lines = islice(f, start_line, None)
+            batch = list(islice(lines, batch_size))
+            while batch:
+                line_num += len(batch)
+                pending.append((pool.submit(insert_batch, batch), line_num))
+                # bound the number of batches held in memory
+                if len(pending) > 2 * workers:
+                    wait_for_oldest()
+                batch = list(islice(lines, batch_size))
+            while pending:
+                wait_for_oldest()
         _logger.info(f"Reimported '{collection_name}' with '{file_name}'")
 
+    def backfill_nda_group_key(self, only_missing=True, batch_size=1000):
+        """
+        Sets 'nda_group_key' (see misc.nda_group_key()) of labels having
+        application_numbers.  Returns the number of labels updated.
+
+        Parameters:
+            only_missing (Boolean): if False, the key of every label is
+                                    recomputed
+            batch_size (int): number of updates per bulk write
+        """
+        query = {"application_numbers.0": {"$exists": True}}
+        if only_missing:
+            query["nda_group_key"] = {"$exists": False}
+        requests = []
+        updated = 0
+        for doc in self.label_collection.find(
+            query, {"application_numbers": 1}
+        ):
+            requests.append(
+                pymongo.UpdateOne(
+                    {"_id": doc["_id"]},
+                    {
+                        "$set": {
+                            "nda_group_key": misc.nda_group_key(
+                                doc["application_numbers"]
+                            )
+                        }
+                    },
+                )
+            )
+            if len(requests) >= batch_size:
+                self.label_collection.bulk_write(requests, ordered=False)
+                updated += len(requests)
+                requests = []
+        if requests:
+            self.label_collection.bulk_write(requests, ordered=False)
+            updated += len(requests)
+        if updated:
+            _logger.info(f"Set nda_group_key of {updated} labels")
+        return updated
+
+    def update_fields(self, collection_name, docs, fields, unset_fields=None):
+        """
+        Set only the given fields of all docs in the collection with one bulk
+        write.  Unlike update_db(), fields of the stored docs that are not in
+        fields are kept, so docs may be read with a projection.
+
+        Parameters:
+            collection_name (string):
+                MongoDB collection name
+            docs (list):
+                list of docs having an '_id'
+            fields (list):
+                names of the fields to set; fields missing from a doc are not
+                set
+            unset_fields (list):
+                optional; names of the fields to remove from each doc, unless
+                set by fields
+        """
+        requests = []
+        for doc in docs:
+            update = {"$set": {x: doc[x] for x in fields if x in doc}}
+            unset = {x: "" for x in unset_fields or [] if x not in doc}
+            if unset:
+                update["$unset"] = unset
+            requests.append(pymongo.UpdateOne({"_id": doc["_id"]}, update))
+        if not requests:
+            return
+        result = self.db[collection_name].bulk_write(requests, ordered=False)
+        if result.matched_count < len(requests):
+            _logger.error(
+                f"Unable to update {len(requests) - result.matched_count} of "
+                f"{len(requests)} docs in collection '{collection_name}'"
+            )
+        else:
+            _logger.info(
+                f"Updated {fields} of {len(requests)} docs in collection "
+                f"'{collection_name}'"
+            )
+
     def update_db(self, collection_name, docs):
         """
         Update all docs in docs in the collection
@@ -0,0 +1,297 @@
+"""
+Stores the scores of label additions in a sidecar collection instead of within
+the label documents.
+
+Each document of the sidecar collection holds the scores of one addition of
+one label:
+
+    {
+        '_id': '<label _id>/<addition key>',
+        'label_id': ObjectId('...'),
+        'addition_key': '0',
+        'dtype': 'float16',
+        'scores': Binary(...),       # packed array of scores
+        'claim_index': Binary(...),  # packed int32 array of indexes into the
+                                     # 'score_claims' of the label document
+    }
+
+The label document keeps 'scores': [] and a 'scores_ref' (the sidecar '_id')
+for each addition, and a 'score_claims' list of [patent_number, claim_number,
+parent_claim_numbers] that 'claim_index' refers to.  expand_scores() rebuilds
+the inline format described in the README for consumers such as the front end.
+
+Labels scored with reference-only additions keep just the addition key (the
+third index) in each addition of 'diff_against_previous_label'.
+expand_diff_additions() appends the copy of the addition (the fourth index)
+for consumers, and strip_diff_additions() migrates existing labels.
+"""
+
+from bson.binary import Binary
+import numpy as np
+from pymongo import ReplaceOne
+import re
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+SCORE_DTYPES = ["float16", "float32"]
+
+_indexed_collections = set()
+
+
+def _ensure_index(collection):
+    """Create the 'label_id' index on collection once per process."""
+    if collection.full_name not in _indexed_collections:
+        collection.create_index("label_id")
+        _indexed_collections.add(collection.full_name)
+
+
+def pack_scores(scores, claim_keys, dtype="float32"):
+    """
+    Returns a tuple of (packed scores, packed claim indexes) for a list of
+    score dicts in the inline format.  claim_keys is extended with any
+    (patent_number, claim_number, parent_claim_numbers) not already in it.
+
+    Parameters:
+        scores (list): [{'patent_number':..., 'claim_number':...,
+                         'parent_claim_numbers':[...], 'score':...},]
+        claim_keys (dict): {(patent_number, claim_number,
+                            tuple(parent_claim_numbers)): index,}
+        dtype (String): 'float16' or 'float32'
+    """
+    if dtype not in SCORE_DTYPES:
+        raise ValueError(f"Unknown score dtype: {dtype}")
+    claim_index = []
+    for score in scores:
+        key = (
+            score["patent_number"],
+            score["claim_number"],
+            tuple(score["parent_claim_numbers"]),
+        )
+        if key not in claim_keys:
+            claim_keys[key] = len(claim_keys)
+        claim_index.append(claim_keys[key])
+    packed_scores = np.asarray(
+        [score["score"] for score in scores], dtype=dtype
+    ).tobytes()
+    packed_index = np.asarray(claim_index, dtype="<i4").tobytes()
+    return packed_scores, packed_index
+
+
+def unpack_scores(sidecar_doc, score_claims):
+    """
+    Returns a list of score dicts in the inline format from a sidecar document.
+
+    Parameters:
+        sidecar_doc (dict): document from the sidecar collection
+        score_claims (list): [[patent_number, claim_number,
+                              parent_claim_numbers],] of the label document
+    """
+    scores = np.frombuffer(sidecar_doc["scores"], dtype=sidecar_doc["dtype"])
+    claim_index = np.frombuffer(sidecar_doc["claim_index"], dtype="<i4")
+    return [
+        {
+            "patent_number": score_claims[index][0],
+            "claim_number": score_claims[index][1],
+            "parent_claim_numbers": list(score_claims[index][2]),
+            "score": float(score),
+        }
+        for score, index in zip(scores.tolist(), claim_index.tolist())
+    ]
+
+
+def store_scores(mongo_client, docs, dtype="float32"):
+    """
+    Moves the scores of all additions of docs into the sidecar collection and
+    replaces them with references.  Sidecar documents of additions no longer
+    in a label are deleted.  Returns docs, ready for
+    MongoClient.update_fields().
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        docs (list): list of label docs from MongoDB with scored additions
+        dtype (String): 'float16' or 'float32'
+    """
+    collection = mongo_client.score_collection
+    _ensure_index(collection)
+    for doc in docs:
+        if not doc.get("additions"):
+            continue
+        claim_keys = {}
+        requests = []
+        for key, addition in doc["additions"].items():
+            packed_scores, packed_index = pack_scores(
+                addition.get("scores", []), claim_keys, dtype
+            )
+            ref = f"{doc['_id']}/{key}"
+            requests.append(
+                ReplaceOne(
+                    {"_id": ref},
+                    {
+                        "_id": ref,
+                        "label_id": doc["_id"],
+                        "addition_key": key,
+                        "dtype": dtype,
+                        "scores": Binary(packed_scores),
+                        "claim_index": Binary(packed_index),
+                    },
+                    upsert=True,
+                )
+            )
+            addition["scores"] = []
+            addition["scores_ref"] = ref
+        collection.bulk_write(requests, ordered=False)
+        collection.delete_many(
+            {
+                "label_id": doc["_id"],
+                "addition_key": {"$nin": list(doc["additions"].keys())},
+            }
+        )
+        doc["score_claims"] = [
+            [patent_number, claim_number, list(parent_claim_numbers)]
+            for (patent_number, claim_number, parent_claim_numbers) in sorted(
+                claim_keys, key=claim_keys.get
+            )
+        ]
+        # copies of additions within diff_against_previous_label
+        for diff in doc.get("diff_against_previous_label", []):
+            for text in diff["text"]:
+                if len(text) > 3 and text[2] in doc["additions"]:
+                    text[3] = doc["additions"][text[2]]
+    return docs
+
+
+def delete_scores(mongo_client, docs):
+    """
+    Deletes all sidecar documents of docs, such as those of labels stored
+    with store_scores() by a previous run and now stored inline.  Returns the
+    number of deleted documents.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        docs (list): list of label docs from MongoDB
+    """
+    if not docs:
+        return 0
+    result = mongo_client.score_collection.delete_many(
+        {
+            "$or": [
+                {"_id": {"$regex": "^" + re.escape(str(doc["_id"])) + "/"}}
+                for doc in docs
+            ]
+        }
+    )
+    return result.deleted_count
+
+
+def expand_scores(mongo_client, docs):
+    """
+    Rebuilds 'scores' of each addition, and of each copy of an addition within
+    'diff_against_previous_label', for docs stored with store_scores().  Docs
+    without references are left unchanged.  Returns docs.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        docs (list): list of label docs from MongoDB
+    """
+    refs = [
+        addition["scores_ref"]
+        for doc in docs
+        for addition in (doc.get("additions") or {}).values()
+        if addition.get("scores_ref")
+    ]
+    if not refs:
+        return docs
+    sidecar_docs = {
+        x["_id"]: x
+        for x in mongo_client.score_collection.find({"_id": {"$in": refs}})
+    }
+    for doc in docs:
+        if not doc.get("additions"):
+            continue
+        for key, addition in doc["additions"].items():
+            ref = addition.get("scores_ref")
+            if not ref:
+                continue
+            if ref not in sidecar_docs:
+                _logger.error(f"Missing scores '{ref}' for label {doc['_id']}")
+                continue
+            addition["scores"] = unpack_scores(
+                sidecar_docs[ref], doc.get("score_claims", [])
+            )
+        for diff in doc.get("diff_against_previous_label", []):
+            for text in diff["text"]:
+                if len(text) > 3 and text[2] in doc["additions"]:
+                    text[3]["scores"] = doc["additions"][text[2]]["scores"]
+    return docs
+
+
+def expand_diff_additions(docs):
+    """
+    Appends a copy of doc['additions'][key] to each addition within
+    'diff_against_previous_label' that only stores the key.  Returns docs.
+
+    Parameters:
+        docs (list): list of label docs from MongoDB
+    """
+    for doc in docs:
+        if not doc.get("additions"):
+            continue
+        for diff in doc.get("diff_against_previous_label", []):
+            for text in diff["text"]:
+                if (
+                    text[0] == 1
+                    and len(text) == 3
+                    and text[2] in doc["additions"]
+                ):
+                    text.append(doc["additions"][text[2]])
+    return docs
+
+
+def strip_diff_additions(mongo_client):
+    """
+    Migrates all labels to reference-only additions by dropping the copy of
+    the addition (the fourth index) from each element of 'text' within
+    'diff_against_previous_label'.  The update runs on the server.  Returns
+    the number of modified labels.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+    """
+    result = mongo_client.label_collection.update_many(
+        {"diff_against_previous_label": {"$exists": True}},
+        [
+            {
+                "$set": {
+                    "diff_against_previous_label": {
+                        "$map": {
+                            "input": "$diff_against_previous_label",
+                            "as": "diff",
+                            "in": {
+                                "$mergeObjects": [
+                                    "$$diff",
+                                    {
+                                        "text": {
+                                            "$map": {
+                                                "input": "$$diff.text",
+                                                "as": "text",
+                                                "in": {
+                                                    "$slice": ["$$text", 3]
+                                                },
+                                            }
+                                        }
+                                    },
+                                ]
+                            },
+                        }
+                    }
+                }
+            }
+        ],
+    )
+    _logger.info(
+        f"Stripped additions from diff_against_previous_label of "
+        f"{result.modified_count} labels"
+    )
+    return result.modified_count
@@ -0,0 +1,185 @@
+"""
+Tracks the high-water mark of a processing stage so that a run only processes
+NDA groups that changed since the last successful run of the stage.
+
+A watermark is a dict:
+
+    {
+        'label_id': ObjectId('...'),           # max label _id processed
+        'orange_book_created_at': datetime,    # max Orange Book created_at
+    }
+
+An NDA group changed if it has a label with a greater _id (labels are
+inserted with increasing ObjectId) or if the Orange Book has a document for
+one of its NDA numbers with a greater 'created_at'.  A field of None, such as
+'label_id' of a watermark stored while the label collection was empty, marks
+all labels (or all Orange Book documents) as changed.
+"""
+
+from bson.objectid import ObjectId
+from datetime import datetime
+import json
+import os
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+
+def from_date(date_):
+    """
+    Returns a watermark selecting all labels inserted, and all Orange Book
+    documents created, on or after date_.
+
+    Parameters:
+        date_ (datetime): datetime object
+    """
+    # ObjectId.from_datetime() is the smallest _id generated at date_
+    return {
+        "label_id": ObjectId.from_datetime(date_),
+        "orange_book_created_at": date_,
+        "inclusive": True,
+    }
+
+
+def read_watermark(file_name):
+    """
+    Returns the watermark stored in file_name, or None if it does not exist.
+    """
+    if not file_name or not os.path.exists(file_name):
+        return None
+    with open(file_name, "r") as f:
+        stored = json.load(f)
+    return {
+        "label_id": ObjectId(stored["label_id"])
+        if stored.get("label_id")
+        else None,
+        "orange_book_created_at": datetime.fromisoformat(
+            stored["orange_book_created_at"]
+        )
+        if stored.get("orange_book_created_at")
+        else None,
+    }
+
+
+def store_watermark(file_name, watermark):
+    """Stores watermark to file_name."""
+    if not os.path.exists(os.path.dirname(file_name)):
+        os.makedirs(os.path.dirname(file_name))
+    with open(file_name, "w") as f:
+        json.dump(
+            {
+                "label_id": str(watermark["label_id"])
+                if watermark["label_id"]
+                else None,
+                "orange_book_created_at": watermark[
+                    "orange_book_created_at"
+                ].isoformat()
+                if watermark["orange_book_created_at"]
+                else None,
+            },
+            f,
+        )
+    _logger.info(f"Stored watermark {watermark} to {file_name}")
+
+
+def current_watermark(mongo_client):
+    """
+    Returns the watermark of the current state of the database.  Read it
+    before processing, so that labels inserted during a run are processed by
+    the next run.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+    """
+    label = mongo_client.label_collection.find_one(
+        {}, {"_id": 1}, sort=[("_id", -1)]
+    )
+    orange_book = mongo_client.orange_book_collection.find_one(
+        {"created_at": {"$exists": True}},
+        {"_id": 0, "created_at": 1},
+        sort=[("created_at", -1)],
+    )
+    return {
+        "label_id": label["_id"] if label else None,
+        "orange_book_created_at": orange_book["created_at"]
+        if orange_book
+        else None,
+    }
+
+
+def application_number_strings(nda):
+    """
+    Returns the strings of application_numbers in the label collection that
+    may refer to the Orange Book nda number.  For example, 19501 returns
+    ['NDA019501', 'ANDA019501'].
+    """
+    return [f"NDA{int(nda):06d}", f"ANDA{int(nda):06d}"]
+
+
+def changed_nda_group_keys(mongo_client, watermark):
+    """
+    Returns the set of nda_group_key of NDA groups that changed after
+    watermark.  All queries are answered by indexes on '_id',
+    'application_numbers' and Orange Book 'created_at'.  A field of watermark
+    that is missing or None selects all labels or Orange Book documents.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        watermark (dict): see module docstring
+    """
+    label_collection = mongo_client.label_collection
+    op = "$gte" if watermark.get("inclusive") else "$gt"
+    keys = set()
+
+    if watermark.get("label_id") is None:
+        # no label was processed yet: all NDA groups changed
+        keys.update(label_collection.distinct("nda_group_key", {}))
+        keys.discard(None)
+        return keys
+    keys.update(
+        label_collection.distinct(
+            "nda_group_key", {"_id": {op: watermark["label_id"]}}
+        )
+    )
+
+    if watermark.get("orange_book_created_at") is None:
+        ob_query = {}
+    else:
+        ob_query = {"created_at": {op: watermark["orange_book_created_at"]}}
+    ndas = mongo_client.orange_book_collection.distinct("nda", ob_query)
+    application_numbers = [
+        x for nda in ndas for x in application_number_strings(nda)
+    ]
+    if application_numbers:
+        keys.update(
+            label_collection.distinct(
+                "nda_group_key",
+                {"application_numbers": {"$in": application_numbers}},
+            )
+        )
+    keys.discard(None)
+    return keys
+
+
+def changed_label_ids(mongo_client, watermark):
+    """
+    Returns a list of label _id strings of all labels of NDA groups that
+    changed after watermark.  If watermark is None, all label _id strings are
+    returned.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        watermark (dict): see module docstring
+    """
+    label_collection = mongo_client.label_collection
+    if watermark is None:
+        return [str(x) for x in label_collection.distinct("_id", {})]
+    keys = changed_nda_group_keys(mongo_client, watermark)
+    _logger.info(f"{len(keys)} NDA groups changed since {watermark}")
+    return [
+        str(x["_id"])
+        for x in label_collection.find(
+            {"nda_group_key": {"$in": sorted(keys)}}, {"_id": 1}
+        )
+    ]
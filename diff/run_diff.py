@@ -4,13 +4,38 @@ import re
 import os
 from itertools import groupby
 
+from db import watermark
 from orangebook.merge import OrangeBookMap
-from utils import misc
+from utils import metrics, misc
 from utils.logging import getLogger
 
 _logger = getLogger(__name__)
 _dmp = dmp_module.diff_match_patch()
 
+# fields of each label read by run_diff()
+DIFF_PROJECTION = [
+    "set_id",
+    "published_date",
+    "spl_id",
+    "spl_version",
+    "sections",
+]
+# fields of each label written by run_diff()
+DIFF_FIELDS = [
+    "previous_label_published_date",
+    "previous_label_spl_id",
+    "previous_label_spl_version",
+    "next_label_published_date",
+    "next_label_spl_id",
+    "next_label_spl_version",
+    "diff_against_previous_label",
+    "additions",
+    "nda_to_patent",
+]
+# fields of each label removed by run_diff(), as they refer to the additions of
+# a previous run ('scores_discarded' is within 'additions', which is replaced)
+DIFF_UNSET_FIELDS = ["score_claims"]
+
 
 def add_previous_and_next_labels(docs):
     """
@@ -413,6 +438,30 @@ def group_label_docs_by_set_id(docs):
     return return_list
 
 
+def iter_set_id_groups(label_collection, application_numbers, projection=None):
+    """
+    Yields one list of label docs per set_id for the NDA group of
+    application_numbers.  Docs are sorted by set_id and published_date on the
+    MongoDB server and streamed, so only one set_id group is held in memory.
+
+    Parameters:
+        label_collection (object): MongoDB label collection
+        application_numbers (list): a list of application numbers such as
+                                    ['NDA204223',]
+        projection (list): fields to return; 'set_id' and 'published_date'
+                           are always returned.  If None, all fields are
+                           returned.
+    """
+    if projection is not None:
+        projection = list(set(projection) | {"set_id", "published_date"})
+    cursor = label_collection.find(
+        {"nda_group_key": misc.nda_group_key(application_numbers)},
+        projection,
+    ).sort([("set_id", 1), ("published_date", 1)])
+    for _, set_id_group in groupby(cursor, key=lambda k: k["set_id"]):
+        yield list(set_id_group)
+
+
 def add_patent_map(mongo_client, docs, application_numbers):
     """
     Add to each doc in docs a mapping to patents for each NDA
@@ -437,12 +486,45 @@ def add_patent_map(mongo_client, docs, application_numbers):
     return docs
 
 
+def refresh_patent_map(mongo_client, label_ids):
+    """
+    Updates only 'nda_to_patent' of all labels of the NDA groups of label_ids,
+    for example after the Orange Book changed.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        label_ids (list): label _id strings
+    """
+    label_collection = mongo_client.label_collection
+    # NDA groups of label_ids, by nda_group_key
+    groups = {}
+    for doc in label_collection.find(
+        {"_id": {"$in": [ObjectId(x) for x in label_ids]}},
+        {"_id": 0, "nda_group_key": 1, "application_numbers": 1},
+    ):
+        if doc.get("nda_group_key") and doc.get("application_numbers"):
+            groups[doc["nda_group_key"]] = doc["application_numbers"]
+    for application_numbers in groups.values():
+        for set_id_group in iter_set_id_groups(
+            label_collection, application_numbers, []
+        ):
+            set_id_group = add_patent_map(
+                mongo_client, set_id_group, application_numbers
+            )
+            mongo_client.update_fields(
+                mongo_client.label_collection_name,
+                set_id_group,
+                ["nda_to_patent"],
+            )
+
+
 def run_diff(
     mongo_client,
     processed_label_ids_file,
     processed_nda_file,
     unprocessed_label_ids_file,
     since_date=None,
+    watermark_file=None,
 ):
     """
     This method calls other methods in this module and tracks completed
@@ -453,23 +535,27 @@ def run_diff(
         processed_label_ids_file (Path): location to store processed ids
         processed_nda_file (Path): location to store processed NDAs
         unprocessed_label_ids_file (Path): location to store unprocessed ids
-        since_date (datetime): optional argument
+        since_date (datetime): optional argument; process only NDA groups
+                               with labels inserted or Orange Book updates on
+                               or after since_date
+        watermark_file (Path): optional location of the watermark of the last
+                               run (see db/watermark.py); if set, process only
+                               NDA groups changed since the last run
     """
     label_collection = mongo_client.label_collection
-
-    # select all label_ids with date on or after since_date
-    if since_date:
-        ob = OrangeBookMap(mongo_client)
-        NDA_list = ob.get_all_nda_past_date(since_date)
-        # $in finds all labels with any NDA in NDA_list
-        # https://docs.mongodb.com/manual/reference/operator/query/in/
-        all_label_ids = []
-        for x in NDA_list:
-            for y in label_collection.find(
-                {"application_numbers": {"$in": x}}, {"_id", 1}
-            ):
-                all_label_ids.append(str(y["_id"]))
-        all_label_ids = list(set(all_label_ids))
+    # labels must have nda_group_key to be found with their NDA group
+    mongo_client.backfill_nda_group_key()
+
+    # select all labels of NDA groups changed on or after since_date, or
+    # since the watermark of the last run
+    new_watermark = None
+    if since_date or watermark_file:
+        new_watermark = watermark.current_watermark(mongo_client)
+        if since_date:
+            since = watermark.from_date(since_date)
+        else:
+            since = watermark.read_watermark(watermark_file)
+        all_label_ids = watermark.changed_label_ids(mongo_client, since)
 
     else:
         # open processed_label_id_file and return a list of processed _id string
@@ -513,47 +599,55 @@ def run_diff(
             label_index += 1
             continue
 
-        # find all other docs with the same list of NDA numbers
-        # $all disregard order
-        # see https://docs.mongodb.com/manual/tutorial/query-arrays/
-        # len(similar_label_docs) is at least 1
-        similar_label_docs = list(
-            label_collection.find(
-                {"application_numbers": {"$all": application_numbers}}
-            )
-        )
-
-        groups_by_set_id = group_label_docs_by_set_id(similar_label_docs)
-        for set_id_group in groups_by_set_id:
-            # sort by published_date
-            set_id_group = sorted(
-                set_id_group,
-                key=lambda i: (i["published_date"]),
-                reverse=False,
-            )
-            set_id_group = add_previous_and_next_labels(set_id_group)
-            set_id_group = add_diff_against_previous_label(set_id_group)
-            set_id_group = gather_additions(set_id_group)
-        # ungroup similar_label_docs by set id
-        similar_label_docs = [
-            item for sublist in groups_by_set_id for item in sublist
-        ]
-
-        # add mapping at end of label
-        similar_label_docs = add_patent_map(
-            mongo_client, similar_label_docs, application_numbers
-        )
+        # stream all other docs with the same list of NDA numbers, one set_id
+        # group at a time, sorted by published_date
+        similar_label_docs_ids = []
+        with metrics.group("diff", misc.nda_group_key(application_numbers)):
+            for set_id_group in metrics.timed_iter(
+                iter_set_id_groups(
+                    label_collection, application_numbers, DIFF_PROJECTION
+                ),
+                "diff.mongo_read",
+            ):
+                docs = len(set_id_group)
+                with metrics.timer("diff.previous_next_labels", docs):
+                    set_id_group = add_previous_and_next_labels(set_id_group)
+                with metrics.timer("diff.get_diff", docs):
+                    set_id_group = add_diff_against_previous_label(
+                        set_id_group
+                    )
+                with metrics.timer("diff.gather_additions", docs):
+                    set_id_group = gather_additions(set_id_group)
+                metrics.add_sizes(
+                    labels=docs,
+                    sections=sum(
+                        len(x["sections"] or []) for x in set_id_group
+                    ),
+                    additions=sum(len(x["additions"]) for x in set_id_group),
+                )
+                # add mapping at end of label
+                with metrics.timer("diff.patent_map", docs):
+                    set_id_group = add_patent_map(
+                        mongo_client, set_id_group, application_numbers
+                    )
 
-        mongo_client.update_db(
-            mongo_client.label_collection_name, similar_label_docs
-        )
+                with metrics.timer("diff.update_db", docs):
+                    mongo_client.update_fields(
+                        mongo_client.label_collection_name,
+                        set_id_group,
+                        DIFF_FIELDS,
+                        DIFF_UNSET_FIELDS,
+                    )
+                similar_label_docs_ids += [str(x["_id"]) for x in set_id_group]
 
-        similar_label_docs_ids = [str(x["_id"]) for x in similar_label_docs]
+        if not similar_label_docs_ids:
+            # label is missing nda_group_key; skip for now
+            label_index += 1
+            continue
 
         # remove similar_label_docs_ids from all_label_ids
-        all_label_ids = [
-            x for x in all_label_ids if x not in similar_label_docs_ids
-        ]
+        processed_ids = set(similar_label_docs_ids)
+        all_label_ids = [x for x in all_label_ids if x not in processed_ids]
         # store processed_label_ids and processed application_numbers to disk
         if processed_label_ids_file:
             misc.append_to_file(
@@ -563,3 +657,7 @@ def run_diff(
             misc.append_to_file(
                 processed_nda_file, str(application_numbers)[1:-1]
             )
+
+    # store watermark of the state of the database at the start of this run
+    if watermark_file and new_watermark:
+        watermark.store_watermark(watermark_file, new_watermark)
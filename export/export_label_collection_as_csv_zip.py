@@ -2,24 +2,50 @@
 This file creates a .csv copy of all data in the labels collection and uploads
 """
 from bson.objectid import ObjectId
+import io
 import os
-from bson.binary import Binary
-from datetime import date
 import zipfile
 
-from diff.run_diff import group_label_docs_by_set_id
-from utils import misc
+from db import file_store
+from db import score_store
+from diff.run_diff import iter_set_id_groups
+from utils import metrics, misc
 from utils.logging import getLogger
 
 _logger = getLogger(__name__)
 
-
-def compress_file(file_name):
-    new_zip_file = os.path.abspath(file_name) + ".zip"
-    _logger.info("Compressing %s" % file_name)
-    zip_file = zipfile.ZipFile(new_zip_file, "w", zipfile.ZIP_DEFLATED)
-    zip_file.write(file_name, os.path.basename(file_name))
-    zip_file.close()
+CSV_HEADING = [
+    "NDA",
+    "set_id",
+    "previous_published_date",
+    "published_date",
+    "name",
+    "generic_name",
+    "active_ingredient",
+    "section_name",
+    "addition",
+    "expanded_content",
+    "patent_number",
+    "claim_number",
+    "parent_claim",
+    "score",
+]
+
+# date of the csv entry of the zip file; fixed, so that exports of unchanged
+# data are identical and their upload is skipped (see db/file_store.py)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# label fields read for the export
+EXPORT_PROJECTION = [
+    "previous_label_published_date",
+    "name",
+    "generic_name",
+    "active_ingredient",
+    "spl_version",
+    "diff_against_previous_label",
+    "additions",
+    "score_claims",
+]
 
 
 def delete_file(file_name):
@@ -30,36 +56,56 @@ def delete_file(file_name):
         os.remove(file_name)
 
 
-def upload_file_to_db(mongo_client, collection_name, file_name):
-    collection = mongo_client.db[collection_name]
+def upload_file_to_db(mongo_client, bucket_name, file_name, keep_versions=3):
+    """
+    Uploads file_name to the GridFS bucket bucket_name, unless its content is
+    unchanged since the last upload.  See db/file_store.py.
 
-    with open(file_name, "rb") as f:
-        encoded = Binary(f.read())
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        bucket_name (String): name of the GridFS bucket
+        file_name (Path): file to upload
+        keep_versions (int): number of newest versions to keep
+    """
+    return file_store.upload_file(
+        mongo_client, file_name, bucket_name, keep_versions
+    )
 
-    today = date.today()
-    # ex: Sep-16-2019
-    date_str = today.strftime("%b-%d-%Y")
 
-    collection.insert(
-        {
-            "filename": file_name,
-            "file": encoded,
-            "description": "Last Edit " + date_str,
-        }
-    )
+def _csv_field(value):
+    """
+    Returns value as a csv field, quoted only if it contains a delimiter, a
+    quote or a line break.
+    """
+    value = "" if value is None else str(value)
+    if any(x in value for x in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
 
 
-def append_to_csv(file_name, nda_str, set_id_group):
+def _quoted_text(txt):
     """
-    Output all doc in set_id to a csv file.
+    Returns txt fixed by fix_text() as an always quoted csv field, as
+    section_name, addition and expanded_content are written.
+    """
+    return '"' + fix_text(txt) + '"'
+
+
+def append_to_csv(csv_file, nda_str, set_id_group):
+    """
+    Output all doc in set_id to a csv file.  Returns the number of rows
+    written, or None if set_id_group is not processed by run_diff and
+    run_similarity.
+
+    section_name, addition and expanded_content are always quoted, other
+    fields only when needed.
 
     Parameters:
-        file_name (Path): filename to store exported csv
+        csv_file (object): writable text file
         nda_str (String): ex "12345-23456"
         set_id_group (String): ex: "7b5489a1-e30f-450f-bd2b-00d05fd52915"
     """
     _logger.info(f"NDA: {nda_str}")
-    multi_line = []
     for label in set_id_group:
         label["_id"] = str(label["_id"])
         if "diff_against_previous_label" not in label:
@@ -75,77 +121,62 @@ def append_to_csv(file_name, nda_str, set_id_group):
                 "Please run main.py --diff before running this script."
             )
             return None
+
+    rows = 0
+    for label in set_id_group:
         # output: NDA,set-id,full_json,published_date
-        output_string = (
-            nda_str
-            + ","
-            + label["set_id"]
-            + ","
-            + (
-                label["previous_label_published_date"]
-                if label["previous_label_published_date"]
-                else ""
-            )
-            + ","
-            + label["published_date"]
-            + ","
-            + label["name"]
-            + ","
-            + label["generic_name"]
-            + ","
-            + label["active_ingredient"]
+        label_columns = ",".join(
+            _csv_field(x)
+            for x in [
+                nda_str,
+                label["set_id"],
+                label["previous_label_published_date"] or "",
+                label["published_date"],
+                label["name"],
+                label["generic_name"],
+                label["active_ingredient"],
+            ]
         )
         _logger.info(
             f"\n\tset_id: {label['set_id']}\tspl_id: {label['spl_version']}\t"
             f"{label['published_date']}"
         )
         for diff in label["diff_against_previous_label"]:
-            if diff["text"]:
-                output_string_1 = (
-                    output_string + ',"' + fix_text(diff["name"]) + '"'
+            if not diff["text"]:
+                continue
+            section_name = _quoted_text(diff["name"])
+            for text in diff["text"]:
+                if len(text) <= 3:
+                    continue
+                # add additions and expanded_content
+                addition_columns = ",".join(
+                    [
+                        label_columns,
+                        section_name,
+                        _quoted_text(text[1]),
+                        _quoted_text(text[3]["expanded_content"]),
+                    ]
                 )
-                for text in diff["text"]:
-                    if len(text) > 3:
-                        # add additions
-                        output_string_2 = (
-                            output_string_1 + ',"' + fix_text(text[1]) + '"'
-                        )
-                        # add expanded_content
-                        output_string_2 = (
-                            output_string_2
-                            + ',"'
-                            + fix_text(text[3]["expanded_content"])
-                            + '"'
-                        )
-                        for score in text[3]["scores"]:
-                            output_string_3 = (
-                                output_string_2
-                                + ","
-                                + str(score["patent_number"])
-                            )
-                            output_string_3 = (
-                                output_string_3
-                                + ","
-                                + str(score["claim_number"])
-                            )
-                            output_string_3 = (
-                                output_string_3
-                                + ","
-                                + ";".join(
+                for score in text[3]["scores"]:
+                    csv_file.write(
+                        ",".join(
+                            [
+                                addition_columns,
+                                _csv_field(score["patent_number"]),
+                                _csv_field(score["claim_number"]),
+                                ";".join(
                                     [
                                         str(x)
                                         for x in score["parent_claim_numbers"]
                                     ]
-                                )
-                            )
-                            output_string_3 = (
-                                output_string_3
-                                + ","
-                                + str(round(score["score"], 9))
-                            )
-                            multi_line += [output_string_3]
-
-    return multi_line
+                                ),
+                                str(round(score["score"], 9)),
+                            ]
+                        )
+                        + "\n"
+                    )
+                    rows += 1
+    return rows
 
 
 def fix_text(txt):
@@ -155,29 +186,25 @@ def fix_text(txt):
     return " ".join(txt.replace('"', "'").split())
 
 
-def loop_through_set_id(mongo_client, file_name):
+def loop_through_set_id(mongo_client, csv_file):
     """
     This method will gather all label additions in the labels collection in
-    MongoDB into a csv file, with one row per score.
+    MongoDB into a csv file, with one row per score.  Labels are streamed one
+    set_id group at a time.
 
     Parameters:
         mongo_client (object): MongoClient object with database and collections
-        file_name (Path): filename to store exported csv
+        csv_file (object): writable text file
     """
     label_collection = mongo_client.label_collection
+    # labels must have nda_group_key to be found with their NDA group
+    mongo_client.backfill_nda_group_key()
 
     # get list of label_id strings excluding any string in processed_label_id
     all_label_ids = [str(y) for y in label_collection.distinct("_id", {})]
 
-    csv_heading = (
-        "NDA,set_id,previous_published_date,published_date,name,generic_name,"
-        "active_ingredient,section_name,addition,expanded_content,patent_number"
-        ",claim_number,parent_claim,score"
-    )
-
-    final_csv = [csv_heading]
-    delete_file(file_name)
-    misc.append_to_file(file_name, final_csv)
+    csv_file.write(",".join(CSV_HEADING) + "\n")
+    rows = 0
 
     label_index = 0
     while len(all_label_ids) > 0:
@@ -200,47 +227,89 @@ def loop_through_set_id(mongo_client, file_name):
             label_index += 1
             continue
 
-        # find all other docs with the same list of NDA numbers
-        # len(similar_label_docs) is at least 1
-        similar_label_docs = list(
-            label_collection.find(
-                {"application_numbers": {"$all": application_numbers}}
-            )
-        )
+        # stream all other docs with the same list of NDA numbers, one set_id
+        # group at a time
+        similar_label_docs_ids = []
+        with metrics.group("csv", misc.nda_group_key(application_numbers)):
+            for set_id_group in metrics.timed_iter(
+                iter_set_id_groups(
+                    label_collection, application_numbers, EXPORT_PROJECTION
+                ),
+                "csv.mongo_read",
+            ):
+                similar_label_docs_ids += [str(x["_id"]) for x in set_id_group]
+                # rebuild scores stored in the score collection and additions
+                # stored as references
+                with metrics.timer("csv.expand_scores", len(set_id_group)):
+                    set_id_group = score_store.expand_scores(
+                        mongo_client, set_id_group
+                    )
+                    set_id_group = score_store.expand_diff_additions(
+                        set_id_group
+                    )
+
+                with metrics.timer("csv.write", len(set_id_group)):
+                    rows += (
+                        append_to_csv(
+                            csv_file,
+                            ";".join(application_numbers),
+                            set_id_group,
+                        )
+                        or 0
+                    )
 
-        groups_by_set_id = group_label_docs_by_set_id(similar_label_docs)
+        if not similar_label_docs_ids:
+            label_index += 1
+            continue
 
-        for set_id_group in groups_by_set_id:
+        # remove similar_label_docs_ids from all_label_ids
+        processed_ids = set(similar_label_docs_ids)
+        all_label_ids = [x for x in all_label_ids if x not in processed_ids]
+    _logger.info(f"Exported {rows} rows")
 
-            multi_line = append_to_csv(
-                file_name,
-                ";".join(application_numbers),
-                set_id_group,
-            )
-            if multi_line:
-                misc.append_to_file(file_name, multi_line)
 
-        similar_label_docs_ids = [str(x["_id"]) for x in similar_label_docs]
+def open_csv_entry(zip_file, name):
+    """
+    Returns the writable binary entry name of zip_file, dated ZIP_DATE_TIME
+    instead of the time of the export.
 
-        # remove similar_label_docs_ids from all_label_ids
-        all_label_ids = [
-            x for x in all_label_ids if x not in similar_label_docs_ids
-        ]
+    Parameters:
+        zip_file (object): zipfile.ZipFile opened for writing
+        name (String): name of the entry, ex: 'db2csv.csv'
+    """
+    info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return zip_file.open(info, "w", force_zip64=True)
 
 
-def run_export_csv_zip(mongo_client, file_name):
+def run_export_csv_zip(mongo_client, file_name, upload_versions=None):
     """
-    This method runs all other methods in this module
+    This method runs all other methods in this module.  Rows are written
+    directly into the compressed entry of file_name + ".zip", without an
+    intermediate csv file.  The entry has a fixed date, so the zip file of
+    unchanged data is identical and its upload is skipped.
 
     Parameters:
         mongo_client (object): MongoClient object with database and collections
         file_name (Path): filename to store exported csv
+        upload_versions (int): optional; if set, upload the zip file to GridFS
+                               and keep this many versions
     """
-    # delete csv_file
-    delete_file(file_name)
+    zip_file_name = os.path.abspath(file_name) + ".zip"
     # delete zip file
-    delete_file(os.path.abspath(file_name) + ".zip")
-    loop_through_set_id(mongo_client, file_name)
-    compress_file(file_name)
-    # delete csv file
-    delete_file(file_name)
+    delete_file(zip_file_name)
+    if not os.path.exists(os.path.dirname(zip_file_name)):
+        os.makedirs(os.path.dirname(zip_file_name))
+    _logger.info("Compressing %s" % file_name)
+    with zipfile.ZipFile(zip_file_name, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        with open_csv_entry(zip_file, os.path.basename(file_name)) as entry:
+            with io.TextIOWrapper(entry, encoding="utf-8", newline="") as f:
+                loop_through_set_id(mongo_client, f)
+    if upload_versions:
+        upload_file_to_db(
+            mongo_client,
+            file_store.EXPORT_BUCKET_NAME,
+            zip_file_name,
+            upload_versions,
+        )
@@ -0,0 +1,303 @@
+"""
+This file exports the labels collection as normalized Parquet tables for data
+analysis, instead of the row-per-score csv of -db2csv which repeats label
+metadata and addition text on every row.
+
+Tables are written to one folder per table, partitioned by NDA group:
+
+    <folder>/labels/nda=<NDA group>/part-0.parquet
+    <folder>/additions/nda=<NDA group>/part-0.parquet
+    <folder>/claims/nda=<NDA group>/part-0.parquet
+    <folder>/scores/nda=<NDA group>/part-0.parquet
+
+'labels' has one row per label, 'additions' one row per addition of a label
+(joined on label_id), 'claims' one row per claim scored within the NDA group,
+and 'scores' one row per score of an addition (joined on label_id
+and addition_key, and on patent_number and claim_number).  Repeated strings
+are dictionary-encoded.  Each NDA group is streamed one set_id group (one row
+group) at a time.  Load the tables with, for example:
+
+    pandas.read_parquet('<folder>/scores', columns=['score'])
+
+pyarrow is an optional dependency, required only for this export.
+"""
+
+from bson.objectid import ObjectId
+import os
+import shutil
+
+from db import score_store
+from diff.run_diff import iter_set_id_groups
+from utils import metrics, misc
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+TABLES = ["labels", "additions", "claims", "scores"]
+
+# label fields read for the export
+EXPORT_PROJECTION = [
+    "spl_id",
+    "spl_version",
+    "previous_label_published_date",
+    "name",
+    "generic_name",
+    "active_ingredient",
+    "diff_against_previous_label",
+    "additions",
+    "score_claims",
+]
+
+
+def _schemas():
+    """Returns a dict of {table: pyarrow.Schema,}."""
+    import pyarrow as pa
+
+    category = pa.dictionary(pa.int32(), pa.string())
+    return {
+        "labels": pa.schema(
+            [
+                ("label_id", pa.string()),
+                ("set_id", category),
+                ("spl_id", pa.string()),
+                ("spl_version", pa.string()),
+                ("published_date", pa.string()),
+                ("previous_published_date", pa.string()),
+                ("name", category),
+                ("generic_name", category),
+                ("active_ingredient", category),
+            ]
+        ),
+        "additions": pa.schema(
+            [
+                ("label_id", category),
+                ("addition_key", pa.string()),
+                ("section_name", category),
+                ("addition", pa.string()),
+                ("expanded_content", pa.string()),
+            ]
+        ),
+        "claims": pa.schema(
+            [
+                ("patent_number", category),
+                ("claim_number", pa.int32()),
+                ("parent_claim_numbers", pa.list_(pa.int32())),
+            ]
+        ),
+        "scores": pa.schema(
+            [
+                ("label_id", category),
+                ("addition_key", category),
+                ("patent_number", category),
+                ("claim_number", pa.int32()),
+                ("score", pa.float32()),
+            ]
+        ),
+    }
+
+
+def table_rows(set_id_group, seen_claims=None):
+    """
+    Returns a dict of {table: {column: [values,],},} of a set_id group with
+    scores expanded.  Each addition of a label is exported once, even if it
+    spans several elements of 'diff_against_previous_label'; its section_name
+    is the name of the first diff holding it and its addition the text of
+    all elements holding it.  Claims in seen_claims are skipped, and new
+    claims are added to seen_claims.
+
+    Parameters:
+        set_id_group (list): list of label docs from MongoDB with one set_id
+        seen_claims (set): (patent_number, claim_number) already exported for
+                           the NDA group
+    """
+    if seen_claims is None:
+        seen_claims = set()
+    rows = {
+        table: {name: [] for name in schema.names}
+        for table, schema in _schemas().items()
+    }
+
+    def append(table, **values):
+        for name, value in values.items():
+            rows[table][name].append(value)
+
+    for label in set_id_group:
+        label_id = str(label["_id"])
+        additions = label.get("additions") or {}
+        append(
+            "labels",
+            label_id=label_id,
+            set_id=label["set_id"],
+            spl_id=label.get("spl_id"),
+            spl_version=None
+            if label.get("spl_version") is None
+            else str(label["spl_version"]),
+            published_date=label["published_date"],
+            previous_published_date=label.get("previous_label_published_date"),
+            name=label.get("name"),
+            generic_name=label.get("generic_name"),
+            active_ingredient=label.get("active_ingredient"),
+        )
+        # {addition_key: section_name} and {addition_key: [text,]} from diff
+        section_names = {}
+        addition_texts = {}
+        for diff in label.get("diff_against_previous_label") or []:
+            for text in diff["text"]:
+                if text[0] != 1 or len(text) < 3 or text[2] not in additions:
+                    continue
+                section_names.setdefault(text[2], diff["name"])
+                addition_texts.setdefault(text[2], []).append(text[1])
+        for key, addition in additions.items():
+            if key not in section_names:
+                continue
+            append(
+                "additions",
+                label_id=label_id,
+                addition_key=key,
+                section_name=section_names[key],
+                addition="".join(addition_texts[key]),
+                expanded_content=addition.get("expanded_content"),
+            )
+            for score in addition.get("scores") or []:
+                claim = (
+                    str(score["patent_number"]),
+                    int(score["claim_number"]),
+                )
+                append(
+                    "scores",
+                    label_id=label_id,
+                    addition_key=key,
+                    patent_number=claim[0],
+                    claim_number=claim[1],
+                    score=score["score"],
+                )
+                if claim not in seen_claims:
+                    seen_claims.add(claim)
+                    append(
+                        "claims",
+                        patent_number=claim[0],
+                        claim_number=claim[1],
+                        parent_claim_numbers=[
+                            int(x) for x in score["parent_claim_numbers"]
+                        ],
+                    )
+    return rows
+
+
+class _PartitionWriter:
+    """Streams row groups of all tables of one NDA group to Parquet files."""
+
+    def __init__(self, folder, nda_str):
+        self.folder = folder
+        self.nda_str = nda_str
+        self.schemas = _schemas()
+        self.writers = {}
+        self.counts = {table: 0 for table in TABLES}
+
+    def write(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        for table, columns in rows.items():
+            if not columns[self.schemas[table].names[0]]:
+                continue
+            if table not in self.writers:
+                file_name = os.path.join(
+                    self.folder, table, f"nda={self.nda_str}", "part-0.parquet"
+                )
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
+                self.writers[table] = pq.ParquetWriter(
+                    file_name, self.schemas[table], compression="zstd"
+                )
+            arrow_table = pa.Table.from_pydict(
+                columns, schema=self.schemas[table]
+            )
+            self.writers[table].write_table(arrow_table)
+            self.counts[table] += arrow_table.num_rows
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def run_export_parquet(mongo_client, folder):
+    """
+    This method runs all other methods in this module.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        folder (Path): folder to store the Parquet tables; existing tables in
+                       folder are replaced
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        _logger.error("-db2parquet requires pyarrow: pip install pyarrow")
+        raise
+
+    folder = str(folder)
+    for table in TABLES:
+        if os.path.exists(os.path.join(folder, table)):
+            shutil.rmtree(os.path.join(folder, table))
+
+    label_collection = mongo_client.label_collection
+    # labels must have nda_group_key to be found with their NDA group
+    mongo_client.backfill_nda_group_key()
+
+    all_label_ids = [str(y) for y in label_collection.distinct("_id", {})]
+    counts = {table: 0 for table in TABLES}
+
+    label_index = 0
+    while len(all_label_ids) > 0:
+        if label_index >= len(all_label_ids):
+            # all labels were traversed, remaining labels have no
+            # application_numbers
+            break
+
+        # pick label_id
+        label_id_str = str(all_label_ids[label_index])
+
+        # get a list of NDA numbers (ex. ['NDA019501',]) associated with _id
+        application_numbers = label_collection.find_one(
+            {"_id": ObjectId(label_id_str)},
+            {"_id": 0, "application_numbers": 1},
+        )["application_numbers"]
+
+        if not application_numbers:
+            # if label doesn't have application number skip for now
+            label_index += 1
+            continue
+
+        writer = _PartitionWriter(folder, "-".join(application_numbers))
+        seen_claims = set()
+        # stream all other docs with the same list of NDA numbers, one set_id
+        # group at a time
+        similar_label_docs_ids = []
+        with metrics.group("parquet", misc.nda_group_key(application_numbers)):
+            for set_id_group in metrics.timed_iter(
+                iter_set_id_groups(
+                    label_collection, application_numbers, EXPORT_PROJECTION
+                ),
+                "parquet.mongo_read",
+            ):
+                similar_label_docs_ids += [str(x["_id"]) for x in set_id_group]
+                # rebuild scores stored in the score collection
+                with metrics.timer("parquet.expand_scores", len(set_id_group)):
+                    set_id_group = score_store.expand_scores(
+                        mongo_client, set_id_group
+                    )
+                with metrics.timer("parquet.write", len(set_id_group)):
+                    writer.write(table_rows(set_id_group, seen_claims))
+            writer.close()
+        for table in TABLES:
+            counts[table] += writer.counts[table]
+
+        if not similar_label_docs_ids:
+            label_index += 1
+            continue
+
+        # remove similar_label_docs_ids from all_label_ids
+        processed_ids = set(similar_label_docs_ids)
+        all_label_ids = [x for x in all_label_ids if x not in processed_ids]
+
+    _logger.info(f"Exported {counts} rows to {folder}")
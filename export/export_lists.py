@@ -1,6 +1,22 @@
 import json
+import os
+import time
+
 from orangebook.merge import OrangeBookMap
 from utils import misc
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+# lists of the coverage report, see coverage()
+COVERAGE_LISTS = [
+    "missing_NDA",
+    "present_NDA",
+    "NDA_not_in_Orange_Book",
+    "missing_patents",
+    "present_patents",
+    "patents_not_in_Orange_Book",
+]
 
 
 def export_all_NDA(mongo_client, file_name):
@@ -23,26 +39,127 @@ def export_all_patents(mongo_client, file_name, json_convert=False):
         misc.store_to_file(file_name, json.dumps(all_patents_in_Orange_Book))
 
 
-def export_missing_NDA(mongo_client, file_name):
+def _distinct_values(collection, field):
+    """
+    Yields distinct values of an (array) field of collection.  The values are
+    grouped on the server and streamed, so that the result is not limited by
+    the document size limit of distinct().
+    """
+    pipeline = [
+        {"$match": {field: {"$exists": True}}},
+        {"$project": {"_id": 0, "value": "$" + field}},
+        {"$unwind": "$value"},
+        {"$group": {"_id": "$value"}},
+    ]
+    for doc in collection.aggregate(pipeline, allowDiskUse=True):
+        yield doc["_id"]
+
+
+def coverage(mongo_client):
+    """
+    Returns a dict of the NDA and patent coverage of the database relative to
+    the Orange Book, with a sorted list for each name in COVERAGE_LISTS:
+
+        missing_NDA: NDA numbers in the Orange Book without labels
+        present_NDA: NDA numbers in the Orange Book with labels
+        NDA_not_in_Orange_Book: NDA numbers of labels not in the Orange Book
+        missing_patents: patents in the Orange Book not in the database
+        present_patents: patents in the Orange Book and in the database
+        patents_not_in_Orange_Book: patents in the database not in the Orange
+                                    Book
+
+    along with 'counts' of each list, 'unparsed_application_numbers' of labels
+    without a number, and the 'timing' in seconds of each step.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+    """
+    timing = {}
+    start = time.time()
+    ob = OrangeBookMap(mongo_client)
+    ob_ndas = set(ob.get_all_nda())
+    ob_patents = set(str(x) for x in ob.get_all_patents())
+    timing["orange_book"] = time.time() - start
+
+    # application_numbers are strings such as 'NDA019501' or 'ANDA019501'
+    step = time.time()
+    label_ndas = set()
+    unparsed = []
+    for application_number in _distinct_values(
+        mongo_client.label_collection, "application_numbers"
+    ):
+        try:
+            label_ndas.add(misc.get_num_in_str(str(application_number)))
+        except AttributeError:
+            unparsed.append(str(application_number))
+    timing["labels"] = time.time() - step
+
+    step = time.time()
+    db_patents = set(
+        str(x)
+        for x in _distinct_values(
+            mongo_client.patent_collection, "patent_number"
+        )
+    )
+    timing["patents"] = time.time() - step
+
+    report = {
+        "missing_NDA": sorted(ob_ndas - label_ndas),
+        "present_NDA": sorted(ob_ndas & label_ndas),
+        "NDA_not_in_Orange_Book": sorted(label_ndas - ob_ndas),
+        "missing_patents": sorted(ob_patents - db_patents),
+        "present_patents": sorted(ob_patents & db_patents),
+        "patents_not_in_Orange_Book": sorted(db_patents - ob_patents),
+        "unparsed_application_numbers": sorted(unparsed),
+    }
+    report["counts"] = {name: len(report[name]) for name in COVERAGE_LISTS}
+    timing["total"] = time.time() - start
+    report["timing"] = timing
+    _logger.info(f"Coverage: {report['counts']}, timing: {timing}")
+    return report
+
+
+def export_coverage(mongo_client, folder, report=None):
+    """
+    Exports the coverage report (see coverage()) to folder, as one text file
+    per list, one value per line, and as 'coverage.json'.  Asks before
+    overwriting existing files (see misc.store_to_file()).
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        folder (Path): folder to store the coverage report
+        report (dict): optional report returned by coverage(), if already
+                       computed
+    """
+    if report is None:
+        report = coverage(mongo_client)
+    for name in COVERAGE_LISTS:
+        misc.store_to_file(os.path.join(folder, name), report[name])
+    misc.store_to_file(
+        os.path.join(folder, "coverage.json"), json.dumps(report, indent=2)
+    )
+    _logger.info(f"Stored coverage report to {folder}")
+    return report
+
+
+def export_missing_NDA(mongo_client, file_name, report=None):
     """
     Exports list of missing NDA from the database to a file.
 
     Parameters:
         mongo_client (object): MongoClient object with database and collections
         file_name (Path):  location to export list of missing NDAs
+        report (dict): optional report returned by coverage(), if already
+                       computed
     """
-    label_collection = mongo_client.label_collection
-    ob = OrangeBookMap(mongo_client)
-    all_NDA_in_Orange_Book = ob.get_all_nda()
-    all_NDA_in_MongoDB = label_collection.distinct("application_numbers")
-    all_NDA_in_MongoDB = [int(x) for x in all_NDA_in_MongoDB]
-    NDA_in_OB_not_in_Mongo = [
-        x for x in all_NDA_in_Orange_Book if x not in all_NDA_in_MongoDB
-    ]
-    misc.store_to_file(file_name, NDA_in_OB_not_in_Mongo)
+    if report is None:
+        report = coverage(mongo_client)
+    misc.store_to_file(file_name, report["missing_NDA"])
 
 
-def export_missing_patents(mongo_client, file_name, json_convert=False):
+def export_missing_patents(
+    mongo_client, file_name, json_convert=False, report=None
+):
     """
     Exports list of missing patents from the database to a file. If
     json_convert is True, the export is formatted as json.
@@ -51,17 +168,12 @@ def export_missing_patents(mongo_client, file_name, json_convert=False):
         mongo_client (object): MongoClient object with database and collections
         file_name (Path):  location to store export list of missing patents
         json_convert (Boolean): whether the output should be in json format
+        report (dict): optional report returned by coverage(), if already
+                       computed
     """
-    patent_collection = mongo_client.patent_collection
-    ob = OrangeBookMap(mongo_client)
-    all_patents_in_Orange_Book = ob.get_all_patents()
-    print(all_patents_in_Orange_Book[:10])
-    all_patents_in_MongoDB = patent_collection.distinct("patent_number")
-    print(all_patents_in_MongoDB[:10])
-    patents_in_OB_not_in_Mongo = [
-        x for x in all_patents_in_Orange_Book if x not in all_patents_in_MongoDB
-    ]
-    print(patents_in_OB_not_in_Mongo[:10])
+    if report is None:
+        report = coverage(mongo_client)
+    patents_in_OB_not_in_Mongo = report["missing_patents"]
     if not json_convert:
         misc.store_to_file(file_name, patents_in_OB_not_in_Mongo)
     else:
@@ -1,30 +1,47 @@
 """
 This file is for the generation of a db2file for data analysis purposes.
 Run after 'python main.py -rip -ril -diff'
+
+Each NDA group is planned as a list of artifacts, (path within the NDA folder,
+content bytes), which are written to the NDA folder by a thread pool, or into
+one '.tar.gz' or '.zip' file per NDA group.  Patent artifacts are written once
+per NDA group, and the patents of an NDA group are fetched in batches.
 """
 
 from bson.objectid import ObjectId
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
 import os
 import simplejson
 import html
 from collections import OrderedDict
 from pathlib import Path
+import tarfile
+import time
+import zipfile
 
 from similarity.claim_dependency import dependent_to_independent_claim
 from orangebook.merge import OrangeBookMap
-from diff.run_diff import group_label_docs_by_set_id, add_patent_map
-from utils import misc
+from db import score_store
+from diff.run_diff import iter_set_id_groups
+from utils import metrics, misc
 from utils.logging import getLogger
 
 
 _logger = getLogger(__name__)
 
+ARCHIVE_FORMATS = ["tar", "zip"]
+
+PATENT_BATCH_SIZE = 100
 
-def output_label_file(db2file_folder, nda_str, set_id_group):
+
+def label_artifacts(set_id_group):
     """
-    Outputs all label additions.
+    Returns a list of (path, content) of all label additions of set_id_group,
+    or None if set_id_group is not processed by run_diff.
     """
-    print(f"NDA: {nda_str}")
+    artifacts = []
     for label in set_id_group:
         label["_id"] = str(label["_id"])
         if "diff_against_previous_label" not in label:
@@ -33,58 +50,48 @@ def output_label_file(db2file_folder, nda_str, set_id_group):
                 " 'diff_against_previous_label' key.  Please run main.py "
                 "--diff before running this script."
             )
-            return False
-        for diff in label["diff_against_previous_label"]:
-            for text in diff["text"]:
-                text = text[:3]
+            return None
         if "additions" not in label:
             _logger.error(
                 f"Label: _id {label['_id']} missing 'additions' key.  "
                 "Please run main.py --diff before running this script."
             )
-            return False
-        for key in label["additions"].keys():
-            label["additions"][key].pop("scores", None)
+            return None
+        # drop scores from additions, without changing the copies of
+        # additions within diff_against_previous_label
+        label.pop("score_claims", None)
+        label["additions"] = {
+            key: {
+                k: v
+                for k, v in addition.items()
+                if k not in ["scores", "scores_ref"]
+            }
+            for key, addition in label["additions"].items()
+        }
 
         # output NDA/set-id/full_json
-        file_name = Path.joinpath(
-            db2file_folder,
-            nda_str,
-            label["set_id"],
-            "full_json",
-            label["published_date"] + ".json",
+        artifacts.append(
+            (
+                Path(label["set_id"], "full_json")
+                / (label["published_date"] + ".json"),
+                simplejson.dumps(label, indent=4, sort_keys=False).encode(),
+            )
         )
 
-        print(file_name)
-
-        if not os.path.exists(os.path.dirname(file_name)):
-            os.makedirs(os.path.dirname(file_name))
-
-        with open(file_name, "w") as f:
-            f.write(simplejson.dumps(label, indent=4, sort_keys=False))
-
         # output NDA/set-id/addition_with_context
-        file_name = Path.joinpath(
-            db2file_folder,
-            nda_str,
-            label["set_id"],
-            "additions_with_context",
-            label["published_date"],
-        )
-
-        print(file_name)
-
-        if not os.path.exists(os.path.dirname(file_name)):
-            os.makedirs(os.path.dirname(file_name))
-
         additions = []
         for key, value in label["additions"].items():
             additions.append(str(value["expanded_content"]))
-
-        with open(file_name, "wb") as f:
-            for addition in additions:
-                f.write(addition.encode("unicode_escape"))
-                f.write(b"\n")
+        artifacts.append(
+            (
+                Path(
+                    label["set_id"],
+                    "additions_with_context",
+                    label["published_date"],
+                ),
+                b"".join(x.encode("unicode_escape") + b"\n" for x in additions),
+            )
+        )
 
         # output NDA/set-id/just_addition
         additions = []
@@ -92,121 +99,172 @@ def output_label_file(db2file_folder, nda_str, set_id_group):
             for text in diff["text"]:
                 if text[0] == 1 and len(text) > 2:
                     additions.append(str(text[1]))
-
-        file_name = Path.joinpath(
-            db2file_folder,
-            nda_str,
-            label["set_id"],
-            "just_additions",
-            label["published_date"],
+        artifacts.append(
+            (
+                Path(
+                    label["set_id"], "just_additions", label["published_date"]
+                ),
+                b"".join(x.encode("unicode_escape") + b"\n" for x in additions),
+            )
         )
-
-        print(file_name)
-
-        if not os.path.exists(os.path.dirname(file_name)):
-            os.makedirs(os.path.dirname(file_name))
-
-        with open(file_name, "wb") as f:
-            for addition in additions:
-                f.write(addition.encode("unicode_escape"))
-                f.write(b"\n")
+    return artifacts
 
 
-def output_patent_file(mongo_client, db2file_folder, nda_str, all_patent):
+def fetch_patents(mongo_client, patent_numbers, batch_size=PATENT_BATCH_SIZE):
     """
-    Outputs all patent files to db2file_folder
+    Yields patents of patent_numbers from the patent collection, fetched in
+    batches of batch_size, each patent once.
 
     Parameters:
         mongo_client (object): MongoClient object with database and collections
-        db2file_folder (Path): folder to store exported files
-        nda_str (String): NDA group folder in which to output files
-        all_patent (list): All patents related to nda_str
+        patent_numbers (list): patent number strings
+        batch_size (int): number of patents per query
     """
-    # output NDA/patent
-
-    all_patent_list = []
-    for i in all_patent:
-        all_patent_list += i["patents"]
-
-    all_patent_list = list(set(all_patent_list))
-
-    for patent_num in all_patent_list:
-        patent_from_collection = mongo_client.patent_collection.find_one(
-            {"patent_number": str(patent_num)},
+    seen = set()
+    patent_numbers = sorted(set(str(x) for x in patent_numbers))
+    for i in range(0, len(patent_numbers), batch_size):
+        for patent in mongo_client.patent_collection.find(
+            {"patent_number": {"$in": patent_numbers[i : i + batch_size]}},
             {"patent_number": 1, "claims": 1},
-        )
-        if not patent_from_collection:
-            continue
-
-        file_name = Path.joinpath(
-            db2file_folder,
-            nda_str,
-            "patents",
-            patent_from_collection["patent_number"],
-        )
-
-        print(file_name)
+        ):
+            if patent["patent_number"] not in seen:
+                seen.add(patent["patent_number"])
+                yield patent
 
-        if not os.path.exists(os.path.dirname(file_name)):
-            os.makedirs(os.path.dirname(file_name))
 
-        with open(file_name, "wb") as f:
-            for claim in patent_from_collection["claims"]:
-                if (
-                    claim["claim_text"].lstrip("0123456789. ")
-                    != claim["claim_text"]
-                ):
-                    f.write(
-                        html.unescape(claim["claim_text"])
-                        .replace("\r", "")
-                        .encode("unicode_escape")
-                    )
-                else:
-                    f.write(
-                        html.unescape(
-                            claim["claim_number"] + ". " + claim["claim_text"]
-                        )
-                        .replace("\r", "")
-                        .encode("unicode_escape")
-                    )
-                f.write(b"\n")
-
-        # output NDA/patent_longhand
-        claim_num_text_od = OrderedDict()
-        claims = patent_from_collection["claims"]
-        sorted(claims, key=lambda i: i["claim_number"])
-        for claim in claims:
-            claim_num_text_od[int(claim["claim_number"])] = html.unescape(
-                claim["claim_text"]
+def patent_artifacts(patent_from_collection):
+    """
+    Returns a list of (path, content) of the claims and the longhand claims
+    of a patent from the patent collection.
+    """
+    # output NDA/patent
+    patent_num = patent_from_collection["patent_number"]
+    lines = []
+    for claim in patent_from_collection["claims"]:
+        if claim["claim_text"].lstrip("0123456789. ") != claim["claim_text"]:
+            lines.append(
+                html.unescape(claim["claim_text"])
+                .replace("\r", "")
+                .encode("unicode_escape")
             )
-        claims_longhand = dependent_to_independent_claim(
-            claim_num_text_od, str(patent_num)
+        else:
+            lines.append(
+                html.unescape(
+                    claim["claim_number"] + ". " + claim["claim_text"]
+                )
+                .replace("\r", "")
+                .encode("unicode_escape")
+            )
+    artifacts = [
+        (Path("patents", patent_num), b"".join(x + b"\n" for x in lines))
+    ]
+
+    # output NDA/patent_longhand
+    claim_num_text_od = OrderedDict()
+    for claim in patent_from_collection["claims"]:
+        claim_num_text_od[int(claim["claim_number"])] = html.unescape(
+            claim["claim_text"]
         )
-
-        file_name = Path.joinpath(
-            db2file_folder,
-            nda_str,
-            "patents_longhand",
-            patent_from_collection["patent_number"],
+    claims_longhand = dependent_to_independent_claim(
+        claim_num_text_od, str(patent_num)
+    )
+    lines = []
+    for claim_num, value in claims_longhand.items():
+        for interp in value:
+            lines.append(
+                (str(claim_num) + ". " + interp["text"])
+                .replace("\r", "")
+                .encode("unicode_escape")
+            )
+    artifacts.append(
+        (
+            Path("patents_longhand", patent_num),
+            b"".join(x + b"\n" for x in lines),
         )
+    )
+    return artifacts
+
+
+def _write_file(file_name, content):
+    """Writes content to file_name."""
+    if not os.path.exists(os.path.dirname(file_name)):
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, "wb") as f:
+        f.write(content)
+
+
+class _FolderWriter:
+    """Writes artifacts of an NDA group to its folder with a thread pool."""
+
+    def __init__(self, folder, pool, max_pending):
+        self.folder = folder
+        self.pool = pool
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.count = 0
+
+    def write(self, artifacts):
+        for path, content in artifacts:
+            self.pending.append(
+                self.pool.submit(
+                    _write_file, Path.joinpath(self.folder, path), content
+                )
+            )
+            self.count += 1
+            # bound the number of artifacts held in memory
+            while len(self.pending) > self.max_pending:
+                self.pending.popleft().result()
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+
+class _ArchiveWriter:
+    """Writes artifacts of an NDA group into one tar or zip file."""
+
+    def __init__(self, folder, archive):
+        self.count = 0
+        self.folder = folder
+        self.archive = archive
+        self.root = os.path.basename(folder)
+        # members are dated with the time of the export
+        self.mtime = time.time()
+        # opened on the first write, so NDA groups without artifacts leave
+        # no empty archive
+        self.tar = None
+        self.zip = None
+
+    def _open(self):
+        if not os.path.exists(os.path.dirname(self.folder)):
+            os.makedirs(os.path.dirname(self.folder))
+        if self.archive == "tar":
+            self.tar = tarfile.open(str(self.folder) + ".tar.gz", "w:gz")
+        else:
+            self.zip = zipfile.ZipFile(
+                str(self.folder) + ".zip", "w", zipfile.ZIP_DEFLATED
+            )
 
-        print(file_name)
-
-        if not os.path.exists(os.path.dirname(file_name)):
-            os.makedirs(os.path.dirname(file_name))
+    def write(self, artifacts):
+        for path, content in artifacts:
+            if not (self.tar or self.zip):
+                self._open()
+            name = str(Path(self.root, path))
+            if self.tar:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                info.mtime = self.mtime
+                self.tar.addfile(info, io.BytesIO(content))
+            else:
+                self.zip.writestr(name, content)
+            self.count += 1
 
-        with open(file_name, "wb") as f:
-            for claim_num, value in claims_longhand.items():
-                for interp in value:
-                    f.write(
-                        (str(claim_num) + ". " + interp["text"])
-                        .replace("\r", "")
-                        .encode("unicode_escape")
-                    )
-                    f.write(b"\n")
+    def close(self):
+        if self.tar or self.zip:
+            (self.tar or self.zip).close()
 
 
-def get_files_from_db(mongo_client, db2file_folder):
+def get_files_from_db(mongo_client, db2file_folder, archive=None, workers=8):
 
     """
     This method calls other methods in this module to pull data from database
@@ -215,73 +273,101 @@ def get_files_from_db(mongo_client, db2file_folder):
     Parameters:
         mongo_client (object): MongoClient object with database and collections
         db2file_folder (Path): folder to store exported files
+        archive (String): optional; "tar" or "zip" to write one archive per
+                          NDA group instead of a folder
+        workers (int): number of threads writing files
     """
+    if archive is not None and archive not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format: {archive}")
     label_collection = mongo_client.label_collection
+    # labels must have nda_group_key to be found with their NDA group
+    mongo_client.backfill_nda_group_key()
 
     # get list of label_id strings excluding any string in processed_label_id
     all_label_ids = [str(y) for y in label_collection.distinct("_id", {})]
 
-    label_index = 0
-    while len(all_label_ids) > 0:
-        if label_index >= len(all_label_ids):
-            # all labels were traversed, remaining labels have no
-            # application_numbers
-            break
-
-        # pick label_id
-        label_id_str = str(all_label_ids[label_index])
-
-        # get a list of NDA numbers (ex. ['NDA019501',]) associated with _id
-        application_numbers = label_collection.find_one(
-            {"_id": ObjectId(label_id_str)},
-            {"_id": 0, "application_numbers": 1},
-        )["application_numbers"]
-
-        if not application_numbers:
-            # if label doesn't have application number skip for now
-            label_index += 1
-            continue
-
-        # find all other docs with the same list of NDA numbers
-        # len(similar_label_docs) is at least 1
-        similar_label_docs = list(
-            label_collection.find(
-                {"application_numbers": {"$all": application_numbers}}
-            )
-        )
-        # similar_label_docs = add_patent_map(
-        #     mongo_client, similar_label_docs, application_numbers
-        # )
-
-        groups_by_set_id = group_label_docs_by_set_id(similar_label_docs)
-
-        # initialize OrangeBookMap
-        ob = OrangeBookMap(mongo_client)
+    # initialize OrangeBookMap
+    ob = OrangeBookMap(mongo_client)
 
-        for set_id_group in groups_by_set_id:
-
-            output_label_file(
-                db2file_folder,
-                "-".join(application_numbers),
-                set_id_group,
-            )
-            all_patents = [
-                {
-                    "application_number": str(nda),
-                    "patents": ob.get_patents(misc.get_num_in_str(nda)),
-                }
-                for nda in application_numbers
-            ]
-            output_patent_file(
-                mongo_client,
-                db2file_folder,
-                "-".join(application_numbers),
-                all_patents,
-            )
-
-        similar_label_docs_ids = [str(x["_id"]) for x in similar_label_docs]
-
-        # remove similar_label_docs_ids from all_label_ids
-        all_label_ids = [
-            x for x in all_label_ids if x not in similar_label_docs_ids
-        ]
+    label_index = 0
+    with ThreadPoolExecutor(workers) as pool:
+        while len(all_label_ids) > 0:
+            if label_index >= len(all_label_ids):
+                # all labels were traversed, remaining labels have no
+                # application_numbers
+                break
+
+            # pick label_id
+            label_id_str = str(all_label_ids[label_index])
+
+            # get a list of NDA numbers (ex. ['NDA019501',]) of the label
+            application_numbers = label_collection.find_one(
+                {"_id": ObjectId(label_id_str)},
+                {"_id": 0, "application_numbers": 1},
+            )["application_numbers"]
+
+            if not application_numbers:
+                # if label doesn't have application number skip for now
+                label_index += 1
+                continue
+
+            nda_str = "-".join(application_numbers)
+            nda_folder = Path.joinpath(Path(db2file_folder), nda_str)
+            if archive:
+                writer = _ArchiveWriter(nda_folder, archive)
+            else:
+                writer = _FolderWriter(nda_folder, pool, 4 * workers)
+
+            # stream all other docs with the same list of NDA numbers, one
+            # set_id group at a time
+            similar_label_docs_ids = []
+            with metrics.group(
+                "db2file", misc.nda_group_key(application_numbers)
+            ):
+                for set_id_group in metrics.timed_iter(
+                    iter_set_id_groups(label_collection, application_numbers),
+                    "db2file.mongo_read",
+                ):
+                    similar_label_docs_ids += [
+                        str(x["_id"]) for x in set_id_group
+                    ]
+                    # rebuild scores stored in the score collection and
+                    # additions stored as references
+                    with metrics.timer(
+                        "db2file.expand_scores", len(set_id_group)
+                    ):
+                        set_id_group = score_store.expand_scores(
+                            mongo_client, set_id_group
+                        )
+                        set_id_group = score_store.expand_diff_additions(
+                            set_id_group
+                        )
+                    with metrics.timer("db2file.write", len(set_id_group)):
+                        artifacts = label_artifacts(set_id_group)
+                        if artifacts:
+                            writer.write(artifacts)
+
+                # patents are written once per NDA group
+                if similar_label_docs_ids:
+                    patent_numbers = [
+                        patent
+                        for nda in application_numbers
+                        for patent in ob.get_patents(misc.get_num_in_str(nda))
+                    ]
+                    for patent in metrics.timed_iter(
+                        fetch_patents(mongo_client, patent_numbers),
+                        "db2file.patent_read",
+                    ):
+                        with metrics.timer("db2file.write", 1):
+                            writer.write(patent_artifacts(patent))
+                with metrics.timer("db2file.write"):
+                    writer.close()
+            _logger.info(f"NDA: {nda_str}, wrote {writer.count} files")
+
+            if not similar_label_docs_ids:
+                label_index += 1
+                continue
+
+            # remove similar_label_docs_ids from all_label_ids
+            processed_ids = set(similar_label_docs_ids)
+            all_label_ids = [x for x in all_label_ids if x not in processed_ids]
@@ -7,8 +7,9 @@ import sys
 
 from diff import run_diff
 from db.mongo import MongoClient
+from db import score_store
 from utils.logging import getLogger
-from utils import fetch
+from utils import fetch, memory, metrics, profiling
 from export import (
     get_files_from_db,
     export_lists,
@@ -26,6 +27,8 @@ _config = dict(
 # resource folders (contains data files read and written by this package)
 RESOURCE_FOLDER = "resources"
 ORANGE_BOOK_FOLDER = os.path.join(RESOURCE_FOLDER, "Orange_Book")
+# members of the Orange Book zip file to extract
+ORANGE_BOOK_MEMBERS = ["patent.txt", "exclusivity.txt"]
 PROCESSED_LOGS = os.path.join(RESOURCE_FOLDER, "processed_log")
 
 # csv log files (used by package internally to track completed database tasks)
@@ -50,6 +53,29 @@ UNPROCESSED_NDA_SIMILARITY_FILE = os.path.join(
     PROCESSED_LOGS, "similarity_unprocessed_NDA.csv"
 )
 
+# json files storing the database state processed by the last incremental run
+DIFF_WATERMARK_FILE = os.path.join(PROCESSED_LOGS, "diff_watermark.json")
+SIMILARITY_WATERMARK_FILE = os.path.join(
+    PROCESSED_LOGS, "similarity_watermark.json"
+)
+
+# state of the Orange Book and patent claims at the last -ob_changes run
+ORANGE_BOOK_STATE_SNAPSHOT_FILE = os.path.join(
+    PROCESSED_LOGS, "orange_book_map_processed.npz"
+)
+PATENT_CLAIM_HASH_FILE = os.path.join(
+    PROCESSED_LOGS, "patent_claim_hashes.json"
+)
+
+# for truncate_score module
+TRUNCATE_LAST_ID_FILE = os.path.join(PROCESSED_LOGS, "truncate_last_id.csv")
+
+# timings of the stages of the last run (see utils/metrics.py)
+RUN_REPORT_FILE = os.path.join(PROCESSED_LOGS, "run_report.json")
+
+# profiles written by -profile (see utils/profiling.py)
+PROFILE_FOLDER = os.path.join(RESOURCE_FOLDER, "profile")
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -106,6 +132,21 @@ def parse_args():
         metavar=("File_Name"),
     )
 
+    parser.add_argument(
+        "-coverage",
+        "--coverage",
+        nargs="?",
+        type=Path,
+        const=Path(__file__).absolute().parent / "assets" / "db_state",
+        help=(
+            "Output lists of NDA and patents of the Orange Book missing from, "
+            "or present in, MongoDB, and of NDA and patents in MongoDB not in "
+            "the Orange Book, as text files and 'coverage.json' to "
+            "Folder_Name. If unset, Folder_Name is '/assets/db_state/'."
+        ),
+        metavar=("Folder_Name"),
+    )
+
     parser.add_argument(
         "-mn",
         "--missing_NDA_from_database",
@@ -239,6 +280,38 @@ def parse_args():
         metavar=("File_Name"),
     )
 
+    parser.add_argument(
+        "-reimport_start_line",
+        "--reimport_start_line",
+        type=int,
+        default=0,
+        help=(
+            "Resume a reimport by skipping this many lines of the json file "
+            "without dropping the collection.  (for development)."
+        ),
+    )
+
+    parser.add_argument(
+        "-indexes",
+        "--indexes",
+        action="store_true",
+        help=(
+            "Create all indexes required by this package, verify that no "
+            "query is a collection scan, and report index sizes.  Exits with "
+            "an error if any query is a collection scan."
+        ),
+    )
+
+    parser.add_argument(
+        "-backfill_nda_group_key",
+        "--backfill_nda_group_key",
+        action="store_true",
+        help=(
+            "Recompute nda_group_key, the sorted application_numbers used to "
+            "find the labels of an NDA group, for all labels."
+        ),
+    )
+
     parser.add_argument(
         "-diff",
         "--diff",
@@ -266,6 +339,16 @@ def parse_args():
         metavar=("Folder_Name"),
     )
 
+    parser.add_argument(
+        "-db2file_archive",
+        "--db2file_archive",
+        choices=get_files_from_db.ARCHIVE_FORMATS,
+        help=(
+            "With -db2file, write one .tar.gz or .zip file per NDA group "
+            "instead of a folder of files."
+        ),
+    )
+
     parser.add_argument(
         "-db2csv",
         "--db2csv",
@@ -282,6 +365,45 @@ def parse_args():
         metavar=("File_Name"),
     )
 
+    parser.add_argument(
+        "-db2parquet",
+        "--db2parquet",
+        nargs="?",
+        type=Path,
+        const=Path(__file__).absolute().parent / "analysis" / "db2parquet",
+        help=(
+            "Output labels, additions, claims and scores from the database as "
+            "Parquet tables partitioned by NDA to Folder_Name (requires "
+            "pyarrow). If unset, Folder_Name is '/analysis/db2parquet/'."
+        ),
+        metavar=("Folder_Name"),
+    )
+
+    parser.add_argument(
+        "-upload_db2csv",
+        "--upload_db2csv",
+        nargs="?",
+        type=int,
+        const=3,
+        help=(
+            "Upload the -db2csv zip file to GridFS, unless unchanged since the "
+            "last upload, keeping the newest Num_Versions versions.  If "
+            "unset, Num_Versions is 3."
+        ),
+        metavar=("Num_Versions"),
+    )
+
+    parser.add_argument(
+        "-download_db2csv",
+        "--download_db2csv",
+        type=Path,
+        help=(
+            "Download the newest -db2csv zip file uploaded to GridFS to "
+            "File_Name."
+        ),
+        metavar=("File_Name"),
+    )
+
     parser.add_argument(
         "-since",
         "--since",
@@ -292,13 +414,231 @@ def parse_args():
         ),
     )
 
+    parser.add_argument(
+        "-score_storage",
+        "--score_storage",
+        choices=["inline", "sidecar"],
+        default="inline",
+        help=(
+            "Where the similarity module stores scores.  'inline' stores "
+            "scores within each label.  'sidecar' stores packed scores in the "
+            "score collection and references to them in each label."
+        ),
+    )
+
+    parser.add_argument(
+        "-score_dtype",
+        "--score_dtype",
+        choices=score_store.SCORE_DTYPES,
+        default="float32",
+        help=("Precision of scores stored with '-score_storage sidecar'."),
+    )
+
+    parser.add_argument(
+        "-top_k",
+        "--top_k",
+        type=int,
+        default=0,
+        help=(
+            "Keep only the top_k highest scoring claims for each addition. "
+            "If unset, scores for all claims are kept."
+        ),
+    )
+
+    parser.add_argument(
+        "-min_score",
+        "--min_score",
+        type=float,
+        help=("Drop scores lower than min_score."),
+    )
+
+    parser.add_argument(
+        "-score_percentile",
+        "--score_percentile",
+        type=float,
+        help=(
+            "Drop scores lower than this percentile (0-100) of the scores of "
+            "all distinct additions of the NDA group against all claims of "
+            "its patents."
+        ),
+    )
+
+    parser.add_argument(
+        "-best_claim_per_patent",
+        "--best_claim_per_patent",
+        action="store_true",
+        help=("Keep only the highest scoring claim of each patent."),
+    )
+
+    parser.add_argument(
+        "-reference_additions",
+        "--reference_additions",
+        action="store_true",
+        help=(
+            "Store only the addition key, and not a copy of the addition, "
+            "within diff_against_previous_label when running the similarity "
+            "module."
+        ),
+    )
+
+    parser.add_argument(
+        "-migrate_reference_additions",
+        "--migrate_reference_additions",
+        action="store_true",
+        help=(
+            "Remove copies of additions from diff_against_previous_label of "
+            "all labels already in the database."
+        ),
+    )
+
+    parser.add_argument(
+        "-incremental",
+        "--incremental",
+        action="store_true",
+        help=(
+            "Diff and score only NDA groups with labels inserted, or Orange "
+            "Book updates, since the last incremental run.  The state of the "
+            f"last run is stored in {DIFF_WATERMARK_FILE} and "
+            f"{SIMILARITY_WATERMARK_FILE}."
+        ),
+    )
+
+    parser.add_argument(
+        "-ob_changes",
+        "--ob_changes",
+        action="store_true",
+        help=(
+            "Update the patent mapping and scores of only the NDA groups whose "
+            "patents in the Orange Book, or whose patent claims, changed "
+            "since the last run with this flag."
+        ),
+    )
+
+    parser.add_argument(
+        "-chunk_embeddings",
+        "--chunk_embeddings",
+        action="store_true",
+        help=(
+            "Embed additions and claims longer than the 512 token limit of the "
+            "model as overlapping windows of tokens pooled into one "
+            "embedding, instead of truncating them.  Scores differ from "
+            "scores computed without this flag, so rescore all labels with "
+            "'-r' when turning it on or off."
+        ),
+    )
+
     parser.add_argument(
         "-truncate_scores",
         "--truncate_scores",
         action="store_true",
-        help=("Truncate scores to reduce size of database"),
+        help=(
+            "Truncate scores to reduce size of database.  An interrupted run "
+            f"resumes from the last _id stored in {TRUNCATE_LAST_ID_FILE}."
+        ),
     )
-    return parser.parse_args()
+
+    parser.add_argument(
+        "-truncate_method",
+        "--truncate_method",
+        choices=["server", "python"],
+        default="server",
+        help=(
+            "Round scores with update pipelines on the MongoDB server "
+            "(requires MongoDB 4.2+), or by streaming labels through python."
+        ),
+    )
+
+    parser.add_argument(
+        "-report",
+        "--report",
+        nargs="?",
+        type=Path,
+        const=Path(__file__).absolute().parent / RUN_REPORT_FILE,
+        help=(
+            "Store a json report of the time spent in each stage of the run "
+            "(p50/p95/max per call, docs/sec) and of the slowest NDA groups "
+            f"to File_Name. If unset, File_Name is '{RUN_REPORT_FILE}'."
+        ),
+        metavar=("File_Name"),
+    )
+
+    parser.add_argument(
+        "-prometheus",
+        "--prometheus",
+        type=Path,
+        help=(
+            "Store the stage timings of the run to File_Name in the "
+            "Prometheus text format, for the node_exporter textfile collector."
+        ),
+        metavar=("File_Name"),
+    )
+
+    parser.add_argument(
+        "-profile",
+        "--profile",
+        choices=profiling.MODES,
+        help=(
+            "Profile the diff, similarity and export stages of the run with "
+            "cProfile ('cprofile') or a low overhead stack sampler "
+            "('sampling'), and store per stage a pstats file and a "
+            "caller;callee '.callers.collapsed' file (cprofile), or a "
+            "collapsed-stack flamegraph file (sampling), to the folder set by "
+            f"-profile_folder, by default '{PROFILE_FOLDER}'."
+        ),
+    )
+
+    parser.add_argument(
+        "-profile_groups",
+        "--profile_groups",
+        type=int,
+        help=(
+            "With -profile, profile only the N slowest NDA groups of each "
+            "stage instead of the whole stages.  The slowest NDA groups are "
+            "read from the run report of a previous run with -report; "
+            "without one, all NDA groups are profiled with 'sampling' and the "
+            "N slowest kept."
+        ),
+        metavar=("N"),
+    )
+
+    parser.add_argument(
+        "-profile_folder",
+        "--profile_folder",
+        type=Path,
+        default=Path(__file__).absolute().parent / PROFILE_FOLDER,
+        help=f"Folder to store profiles; default is '{PROFILE_FOLDER}'.",
+        metavar=("Folder_Name"),
+    )
+
+    parser.add_argument(
+        "-track_memory",
+        "--track_memory",
+        nargs="?",
+        choices=memory.MODES,
+        const="rss",
+        help=(
+            "Record the peak memory of each NDA group, and the number of "
+            "labels, sections, additions and claims of the group, in the run "
+            "report of -report.  'rss' (default) samples the resident set "
+            "size of the process; 'tracemalloc' also traces python "
+            "allocations, at the cost of a slower run."
+        ),
+    )
+
+    parser.add_argument(
+        "-memory_budget_mb",
+        "--memory_budget_mb",
+        type=float,
+        help=(
+            "With -track_memory, flag NDA groups whose peak memory exceeds MB "
+            "in the run report and in the logs."
+        ),
+        metavar=("MB"),
+    )
+    args = parser.parse_args()
+    if args.profile_groups and not args.profile:
+        parser.error("-profile_groups requires -profile")
+    return args
 
 
 def valid_date(s):
@@ -316,21 +656,37 @@ if __name__ == "__main__":
 
     run_diff_and_similarity = False
 
+    if args.profile:
+        profiling.enable(
+            args.profile,
+            args.profile_folder,
+            args.profile_groups,
+            args.report or Path(__file__).absolute().parent / RUN_REPORT_FILE,
+        )
+
+    if args.track_memory:
+        memory.enable(args.track_memory, args.memory_budget_mb)
+
     # download latest Orange Book File from fda.gov
     if args.update_orange_book:
         url = "https://www.fda.gov/media/76860/download"
         file_path = fetch.download(url, ORANGE_BOOK_FOLDER)
-        fetch.extract_and_clean(file_path)
+        if file_path:
+            fetch.extract_and_clean(file_path, ORANGE_BOOK_MEMBERS)
 
     label_collection_name = _config["MONGODB_LABEL_COLLECTION_NAME"]
     labelmap_collection_name = _config["MONGODB_LABELMAP_COLLECTION_NAME"]
     patent_collection_name = _config["MONGODB_PATENT_COLLECTION_NAME"]
     orange_book_collection_name = _config["MONGODB_ORANGE_BOOK_COLLECTION_NAME"]
+    score_collection_name = _config.get(
+        "MONGODB_SCORE_COLLECTION_NAME", "scores"
+    )
     mongo_client = MongoClient(
         label_collection_name,
         labelmap_collection_name,
         patent_collection_name,
         orange_book_collection_name,
+        score_collection_name=score_collection_name,
     )
 
     # export all patents or NDA from the Orange Book
@@ -345,38 +701,79 @@ if __name__ == "__main__":
             mongo_client, args.all_patents_from_Orange_Book_json, True
         )
 
-    # export list of missing patents or NDA from the database
+    # export list of missing patents or NDA from the database; the coverage
+    # report is computed once for all of these exports
+    coverage_report = None
+    if (
+        args.coverage
+        or args.missing_NDA_from_database
+        or args.missing_patents_from_database
+        or args.missing_patents_from_database_json
+    ):
+        coverage_report = export_lists.coverage(mongo_client)
+    if args.coverage:
+        export_lists.export_coverage(
+            mongo_client, args.coverage, coverage_report
+        )
     if args.missing_NDA_from_database:
         export_lists.export_missing_NDA(
-            mongo_client, args.missing_NDA_from_database
+            mongo_client, args.missing_NDA_from_database, coverage_report
         )
     if args.missing_patents_from_database:
         export_lists.export_missing_patents(
-            mongo_client, args.missing_patents_from_database
+            mongo_client,
+            args.missing_patents_from_database,
+            report=coverage_report,
         )
     if args.missing_patents_from_database_json:
         export_lists.export_missing_patents(
-            mongo_client, args.missing_patents_from_database_json, True
+            mongo_client,
+            args.missing_patents_from_database_json,
+            True,
+            coverage_report,
         )
 
     # reimport of label or patent collections; for development
     if args.reimport_labels:
         mongo_client.reimport_collection(
-            label_collection_name, args.reimport_labels
+            label_collection_name,
+            args.reimport_labels,
+            args.reimport_start_line,
         )
     if args.reimport_labelmap:
         mongo_client.reimport_collection(
-            labelmap_collection_name, args.reimport_labelmap
+            labelmap_collection_name,
+            args.reimport_labelmap,
+            args.reimport_start_line,
         )
     if args.reimport_patents:
         mongo_client.reimport_collection(
-            patent_collection_name, args.reimport_patents
+            patent_collection_name,
+            args.reimport_patents,
+            args.reimport_start_line,
         )
     if args.reimport_orange_book:
         mongo_client.reimport_collection(
-            orange_book_collection_name, args.reimport_orange_book
+            orange_book_collection_name,
+            args.reimport_orange_book,
+            args.reimport_start_line,
         )
 
+    if args.backfill_nda_group_key:
+        mongo_client.backfill_nda_group_key(only_missing=False)
+
+    # create and verify indexes
+    if args.indexes:
+        mongo_client.create_indexes()
+        for collection_name, sizes in mongo_client.index_sizes().items():
+            for index_name, size in sizes.items():
+                _logger.info(
+                    f"Index '{index_name}' on '{collection_name}': {size} bytes"
+                )
+        if mongo_client.verify_indexes():
+            _logger.error("Some queries are not supported by an index!")
+            sys.exit(1)
+
     # rerun all diff and similarity
     if args.rerun:
         if os.path.exists(PROCESSED_ID_DIFF_FILE):
@@ -393,53 +790,167 @@ if __name__ == "__main__":
             os.remove(UNPROCESSED_ID_SIMILARITY_FILE)
         if os.path.exists(UNPROCESSED_NDA_SIMILARITY_FILE):
             os.remove(UNPROCESSED_NDA_SIMILARITY_FILE)
+        if os.path.exists(DIFF_WATERMARK_FILE):
+            os.remove(DIFF_WATERMARK_FILE)
+        if os.path.exists(SIMILARITY_WATERMARK_FILE):
+            os.remove(SIMILARITY_WATERMARK_FILE)
+        if os.path.exists(ORANGE_BOOK_STATE_SNAPSHOT_FILE):
+            os.remove(ORANGE_BOOK_STATE_SNAPSHOT_FILE)
+        if os.path.exists(PATENT_CLAIM_HASH_FILE):
+            os.remove(PATENT_CLAIM_HASH_FILE)
         run_diff_and_similarity = True
 
-    if len(sys.argv) == 1 or args.similarity or args.db2csv:
+    if (
+        len(sys.argv) == 1
+        or args.similarity
+        or args.db2csv
+        or args.db2parquet
+        or args.incremental
+    ):
         # for case when no optional arguments are passed
         run_diff_and_similarity = True
 
     # if run_diff_and_similarity:
     if run_diff_and_similarity:
-        run_diff.run_diff(
-            mongo_client,
-            PROCESSED_ID_DIFF_FILE,
-            PROCESSED_NDA_DIFF_FILE,
-            UNPROCESSED_ID_DIFF_FILE,
-            args.since,
-        )
+        with profiling.stage("diff"):
+            run_diff.run_diff(
+                mongo_client,
+                PROCESSED_ID_DIFF_FILE,
+                PROCESSED_NDA_DIFF_FILE,
+                UNPROCESSED_ID_DIFF_FILE,
+                args.since,
+                DIFF_WATERMARK_FILE if args.incremental else None,
+            )
 
         # do not run diff again
         args.diff = False
 
         from similarity import run_similarity
 
-        run_similarity.run_similarity(
-            mongo_client,
-            PROCESSED_ID_SIMILARITY_FILE,
-            PROCESSED_NDA_SIMILARITY_FILE,
-            UNPROCESSED_ID_SIMILARITY_FILE,
-            UNPROCESSED_NDA_SIMILARITY_FILE,
-            args.since,
-        )
+        run_similarity._chunk_embeddings = args.chunk_embeddings
+        with profiling.stage("similarity"):
+            run_similarity.run_similarity(
+                mongo_client,
+                PROCESSED_ID_SIMILARITY_FILE,
+                PROCESSED_NDA_SIMILARITY_FILE,
+                UNPROCESSED_ID_SIMILARITY_FILE,
+                UNPROCESSED_NDA_SIMILARITY_FILE,
+                args.since,
+                args.score_storage,
+                args.score_dtype,
+                args.reference_additions,
+                {
+                    "num_scores": args.top_k,
+                    "min_score": args.min_score,
+                    "percentile": args.score_percentile,
+                    "best_claim_per_patent": args.best_claim_per_patent,
+                },
+                watermark_file=(
+                    SIMILARITY_WATERMARK_FILE if args.incremental else None
+                ),
+            )
 
     elif args.diff or args.db2file:
-        run_diff.run_diff(
+        with profiling.stage("diff"):
+            run_diff.run_diff(
+                mongo_client,
+                PROCESSED_ID_DIFF_FILE,
+                PROCESSED_NDA_DIFF_FILE,
+                UNPROCESSED_ID_DIFF_FILE,
+                args.since,
+                DIFF_WATERMARK_FILE if args.incremental else None,
+            )
+
+    # remap and rescore NDA groups affected by Orange Book or claim changes
+    if args.ob_changes:
+        from orangebook import changes
+        from similarity import run_similarity
+
+        run_similarity._chunk_embeddings = args.chunk_embeddings
+        label_ids, state = changes.detect_changes(
             mongo_client,
-            PROCESSED_ID_DIFF_FILE,
-            PROCESSED_NDA_DIFF_FILE,
-            UNPROCESSED_ID_DIFF_FILE,
-            args.since,
+            ORANGE_BOOK_STATE_SNAPSHOT_FILE,
+            PATENT_CLAIM_HASH_FILE,
+        )
+        if label_ids:
+            with profiling.stage("diff"):
+                run_diff.refresh_patent_map(mongo_client, label_ids)
+            with profiling.stage("similarity"):
+                run_similarity.run_similarity(
+                    mongo_client,
+                    None,
+                    None,
+                    None,
+                    None,
+                    label_ids=label_ids,
+                    score_storage=args.score_storage,
+                    score_dtype=args.score_dtype,
+                    reference_additions=args.reference_additions,
+                    retention={
+                        "num_scores": args.top_k,
+                        "min_score": args.min_score,
+                        "percentile": args.score_percentile,
+                        "best_claim_per_patent": args.best_claim_per_patent,
+                    },
+                )
+        changes.store_state(
+            ORANGE_BOOK_STATE_SNAPSHOT_FILE, PATENT_CLAIM_HASH_FILE, state
         )
 
     if args.db2file:
-        get_files_from_db.get_files_from_db(mongo_client, args.db2file)
+        with profiling.stage("export"):
+            get_files_from_db.get_files_from_db(
+                mongo_client, args.db2file, args.db2file_archive
+            )
 
     if args.db2csv:
-        export_label_collection_as_csv_zip.run_export_csv_zip(
-            mongo_client, args.db2csv
+        with profiling.stage("export"):
+            export_label_collection_as_csv_zip.run_export_csv_zip(
+                mongo_client, args.db2csv, args.upload_db2csv
+            )
+
+    if args.db2parquet:
+        from export import export_label_collection_as_parquet
+
+        with profiling.stage("export"):
+            export_label_collection_as_parquet.run_export_parquet(
+                mongo_client, args.db2parquet
+            )
+
+    if args.download_db2csv:
+        from db import file_store
+
+        file_store.download_file(
+            mongo_client,
+            os.path.basename(
+                str(
+                    args.db2csv
+                    or Path(__file__).absolute().parent
+                    / "resources"
+                    / "hosted_folder"
+                    / "db2csv.csv"
+                )
+            )
+            + ".zip",
+            args.download_db2csv,
         )
 
+    if args.migrate_reference_additions:
+        score_store.strip_diff_additions(mongo_client)
+
     if args.truncate_scores:
         from similarity import truncate_score
-        truncate_score.run_truncation(mongo_client)
+        truncate_score.run_truncation(
+            mongo_client,
+            TRUNCATE_LAST_ID_FILE,
+            method=args.truncate_method,
+        )
+
+    if args.profile:
+        profiling.write_profiles()
+
+    # report timings of all stages of the run
+    if args.report:
+        metrics.write_report(str(args.report))
+    if args.prometheus:
+        metrics.write_prometheus(str(args.prometheus))
@@ -0,0 +1,148 @@
+"""
+Detects changes to the Orange Book and to patent claims since the last run with
+the -ob_changes flag, so that only the affected NDA groups are remapped to
+patents and rescored.
+
+An NDA is affected if its set of patents differs between the Orange Book
+snapshot of the last run and the current snapshot (see merge.OrangeBookMap),
+or if the claims of any of its patents changed in the patent collection.
+"""
+
+import hashlib
+import json
+import numpy as np
+import os
+
+from db import watermark
+from orangebook import merge
+from orangebook.merge import OrangeBookMap
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+
+def snapshot_pairs(snapshot):
+    """
+    Returns a set of (nda, patent) of a snapshot from merge.build_snapshot().
+    """
+    ndas = np.repeat(snapshot["ndas"], np.diff(snapshot["nda_offsets"]))
+    return set(zip(ndas.tolist(), snapshot["nda_patents"].tolist()))
+
+
+def changed_ndas(old_snapshot, new_snapshot):
+    """
+    Returns a sorted list of NDA numbers whose patents differ between
+    old_snapshot and new_snapshot.  If old_snapshot is None, all NDA numbers
+    of new_snapshot are returned.
+    """
+    new_pairs = snapshot_pairs(new_snapshot)
+    if old_snapshot is None:
+        return sorted({nda for nda, _ in new_pairs})
+    old_pairs = snapshot_pairs(old_snapshot)
+    return sorted({nda for nda, _ in old_pairs ^ new_pairs})
+
+
+def claim_hashes(mongo_client):
+    """
+    Returns a dict of {patent_number: hash of claims,} of all patents in the
+    patent collection.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+    """
+    hashes = {}
+    for patent in mongo_client.patent_collection.find(
+        {},
+        {
+            "_id": 0,
+            "patent_number": 1,
+            "claims.claim_number": 1,
+            "claims.claim_text": 1,
+        },
+    ):
+        hashes[str(patent["patent_number"])] = hashlib.sha1(
+            json.dumps(patent.get("claims", []), sort_keys=True).encode()
+        ).hexdigest()
+    return hashes
+
+
+def changed_patents(old_hashes, new_hashes):
+    """
+    Returns a sorted list of patent numbers that were added, removed, or whose
+    claims changed between old_hashes and new_hashes (see claim_hashes()).
+    """
+    return sorted(
+        x
+        for x in set(old_hashes) | set(new_hashes)
+        if old_hashes.get(x) != new_hashes.get(x)
+    )
+
+
+def affected_label_ids(mongo_client, ndas):
+    """
+    Returns a list of label _id strings of all labels of NDA groups that
+    include any NDA number of ndas.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        ndas (list): Orange Book NDA numbers (int)
+    """
+    label_collection = mongo_client.label_collection
+    application_numbers = [
+        x for nda in ndas for x in watermark.application_number_strings(nda)
+    ]
+    if not application_numbers:
+        return []
+    keys = label_collection.distinct(
+        "nda_group_key", {"application_numbers": {"$in": application_numbers}}
+    )
+    return [
+        str(x["_id"])
+        for x in label_collection.find(
+            {"nda_group_key": {"$in": keys}}, {"_id": 1}
+        )
+    ]
+
+
+def detect_changes(mongo_client, snapshot_file, claim_hash_file):
+    """
+    Returns (label_ids, state), wherein label_ids lists the label _id strings
+    of all affected NDA groups, and state is passed to store_state() once the
+    NDA groups are processed.
+
+    Parameters:
+        mongo_client (object): MongoClient object with database and collections
+        snapshot_file (Path): copy of the Orange Book snapshot of the last run
+        claim_hash_file (Path): claim hashes of the last run
+    """
+    OrangeBookMap.reset()
+    ob = OrangeBookMap(mongo_client)
+    new_snapshot = merge.read_snapshot(merge.SNAPSHOT_FILE)
+    old_snapshot = merge.read_snapshot(snapshot_file)
+    ndas = set(changed_ndas(old_snapshot, new_snapshot))
+    _logger.info(f"{len(ndas)} NDAs with changed patents in the Orange Book")
+
+    new_hashes = claim_hashes(mongo_client)
+    old_hashes = {}
+    if os.path.exists(claim_hash_file):
+        with open(claim_hash_file, "r") as f:
+            old_hashes = json.load(f)
+    patents = changed_patents(old_hashes, new_hashes)
+    _logger.info(f"{len(patents)} patents with changed claims")
+    for patent in patents:
+        ndas.update(ob.get_nda(patent))
+
+    label_ids = affected_label_ids(mongo_client, sorted(ndas))
+    _logger.info(f"{len(label_ids)} labels of affected NDA groups")
+    return label_ids, {"snapshot": new_snapshot, "claim_hashes": new_hashes}
+
+
+def store_state(snapshot_file, claim_hash_file, state):
+    """
+    Stores state from detect_changes() as the state of the last run.
+    """
+    merge.write_snapshot(snapshot_file, state["snapshot"])
+    if not os.path.exists(os.path.dirname(claim_hash_file)):
+        os.makedirs(os.path.dirname(claim_hash_file))
+    with open(claim_hash_file, "w") as f:
+        json.dump(state["claim_hashes"], f)
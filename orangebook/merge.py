@@ -2,108 +2,417 @@
 Module is for merging all old OrangeBook files so that a lookup can be made.
 """
 
+import bson
 import glob
+import numpy as np
+import os
 import pandas as pd
-import dateutil
 
 from utils.logging import getLogger
 
 _logger = getLogger(__name__)
 
+# snapshot of the lookups of OrangeBookMap; bump SNAPSHOT_VERSION whenever the
+# layout of the snapshot changes
+SNAPSHOT_FILE = "resources/Orange_Book/snapshot/orange_book_map.npz"
+SNAPSHOT_VERSION = 2
+# number of Orange Book documents per batch read from MongoDB
+MONGO_BATCH_SIZE = 50000
+# merged associations of all Orange Book csv files
+CSV_CACHE_FILE = "resources/Orange_Book/snapshot/merged_csv.npz"
+NBER_CSV_FILE = "resources/Orange_Book/nber_1985_2016/FDA_drug_patents.csv"
 
-def _merge_all_csv():
+
+def _read_patent_csv(csv_file):
     """
-    Returns data-frame with columns: 'nda' (int64) and 'patent' (object)
+    Returns data-frame with columns: 'nda' (int64) and 'patent' (object) from a
+    monthly Orange Book patent.txt file.
     """
-    filelist = sorted(
-        glob.glob("resources/Orange_Book/*/patent.txt"), reverse=True
+    df = pd.read_csv(
+        csv_file,
+        sep="~",
+        usecols=lambda x: x.lower() in ["appl_no", "patent_no"],
+        dtype=str,
+    ).rename(columns=str.lower)
+    df = df.dropna()
+    # remove '*PED' from the ends of some patent
+    # patents cannot be converted to integer since they include 'RE44186'
+    return pd.DataFrame(
+        {
+            "nda": df["appl_no"].astype("int64"),
+            "patent": df["patent_no"].str.rstrip("*PED"),
+        }
     )
 
-    # combine all extracted EOBZIP into one giant df
-    df_obzip = pd.concat(
-        (
-            pd.read_csv(csv_file, sep="~").rename(columns=str.lower)
-            for csv_file in filelist
-        ),
-        ignore_index=True,
-        join="outer",
-        sort=True,
+
+def _read_nber_csv(csv_file):
+    """
+    Returns data-frame with columns: 'nda' (int64) and 'patent' (object) from
+    the nber 1985-2016 csv file.
+    """
+    df = pd.read_csv(
+        csv_file,
+        sep=",",
+        usecols=lambda x: x.lower() in ["application_number", "patent_number"],
+        dtype=str,
+    ).rename(columns=str.lower)
+    df = df.dropna()
+    return pd.DataFrame(
+        {
+            "nda": df["application_number"].astype("int64"),
+            "patent": df["patent_number"],
+        }
     )
 
-    df_obzip_sm = df_obzip[["appl_no", "patent_no"]].copy()
-    df_obzip_sm.columns = ["nda", "patent"]
 
-    # remove '*PED' from the ends of some patent
-    # patents cannot be converted to integer since they include 'RE44186'
-    df_obzip_sm["patent"] = df_obzip_sm["patent"].map(
-        lambda x: x.rstrip("*PED")
+def _csv_files():
+    """
+    Returns the Orange Book csv files: the patent.txt file of each month,
+    newest first, and NBER_CSV_FILE if it exists, with a warning otherwise.
+    """
+    filelist = sorted(
+        glob.glob("resources/Orange_Book/*/patent.txt"), reverse=True
     )
+    if os.path.exists(NBER_CSV_FILE):
+        filelist.append(NBER_CSV_FILE)
+    else:
+        # associations before the monthly files are missing from the lookups
+        _logger.warning(
+            f"{NBER_CSV_FILE} not found; Orange Book associations of "
+            "1985-2016 are not included"
+        )
+    return filelist
 
-    df_1985_2016 = pd.read_csv(
-        "resources/Orange_Book/nber_1985_2016/FDA_drug_patents.csv", sep=","
-    ).rename(columns=str.lower)
 
-    df_1985_2016_sm = df_1985_2016[
-        ["application_number", "patent_number"]
-    ].copy()
-    df_1985_2016_sm.columns = ["nda", "patent"]
+def _source_signature(csv_file):
+    """
+    Returns the 'path|mtime_ns|size' signature of csv_file, which changes when
+    the file is replaced or modified.
+    """
+    stat = os.stat(csv_file)
+    return f"{csv_file}|{stat.st_mtime_ns}|{stat.st_size}"
+
 
+def _merge_all_csv(cache_file=None):
+    """
+    Returns data-frame with columns: 'nda' (int64) and 'patent' (object)
+
+    The merged associations are cached in cache_file along with the signatures
+    (see _source_signature()) of the csv files they were read from.  Only csv
+    files not yet in cache_file are read and merged; cache_file is rebuilt if
+    any csv file it contains was removed or modified.
+
+    Parameters:
+        cache_file (Path): location of the cache; defaults to CSV_CACHE_FILE
+    """
+    cache_file = cache_file or CSV_CACHE_FILE
+    signatures = {_source_signature(x): x for x in _csv_files()}
+
+    cached_sources, cached = [], None
+    if os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as f:
+            if int(f["version"]) == SNAPSHOT_VERSION and set(
+                f["sources"].tolist()
+            ).issubset(signatures):
+                cached_sources = f["sources"].tolist()
+                cached = pd.DataFrame({"nda": f["nda"], "patent": f["patent"]})
+
+    new_sources = [x for x in signatures if x not in cached_sources]
+    if not new_sources and cached is not None:
+        return cached
+
+    # combine all extracted EOBZIP not in cache into one df
     df_joined = (
-        pd.concat([df_obzip_sm, df_1985_2016_sm])
+        pd.concat(
+            ([cached] if cached is not None else [])
+            + [
+                _read_nber_csv(x) if x == NBER_CSV_FILE else _read_patent_csv(x)
+                for x in (signatures[y] for y in new_sources)
+            ],
+            ignore_index=True,
+        )
         .drop_duplicates()
         .reset_index(drop=True)
     )
+    _logger.info(
+        "Merged Orange Book csv files: "
+        f"{[signatures[x] for x in new_sources]}"
+    )
+
+    if not os.path.exists(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    tmp_file_name = cache_file + ".tmp.npz"
+    np.savez(
+        tmp_file_name,
+        version=np.array(SNAPSHOT_VERSION),
+        sources=np.array(cached_sources + new_sources, dtype="U"),
+        nda=df_joined["nda"].to_numpy(dtype="int64"),
+        patent=df_joined["patent"].to_numpy(dtype="U"),
+    )
+    os.replace(tmp_file_name, cache_file)
 
     return df_joined
 
 
-def _get_all_associations_from_mongo(mongo_client):
+def _get_all_associations_from_mongo(mongo_client, since=None):
     """Queries the OrangeBook collection in MongoDB, returning a
-    dataframe with columns (nda, patent)
+    dataframe with columns (nda, patent, date).  Only 'nda', 'patent_num' and
+    'created_at' are read, in large raw batches; each batch is decoded into
+    numpy arrays, so no Python objects are kept beyond the current batch.
     Args:
         mongo_client (MongoClient): The mongo DB client initialized with the
                                     expected credentials
+        since (datetime): if set, only documents with 'created_at' after since
+                          are read, and the csv fallback is not used
     Returns:
         pandas.DataFrame: Dataframe with columns "nda" and "patent" from the
                           OrangeBook data in the MongoDB
     """
-    # Get all documents from MongoDB
-    docs = mongo_client.orange_book_collection.find()
-    if not docs.count():
+    collection = mongo_client.orange_book_collection
+    if since is None and not collection.count_documents({}, limit=1):
         # Compile the OrangeBook locally, if no data found in MongoDB
         return _merge_all_csv()
+    query = {"created_at": {"$gt": since}} if since is not None else {}
     ndas, patents, dates = [], [], []
-    for doc in docs:
-        ndas.append(int(doc["nda"]))
-        patents.append(str(doc["patent_num"]))
-        dates.append(doc["created_at"])
-    df = pd.DataFrame(data={"nda": ndas, "patent": patents, "date": dates})
+    for batch in collection.find_raw_batches(
+        query,
+        {"_id": 0, "nda": 1, "patent_num": 1, "created_at": 1},
+        batch_size=MONGO_BATCH_SIZE,
+    ):
+        docs = bson.decode_all(batch)
+        ndas.append(
+            np.fromiter(
+                (int(doc["nda"]) for doc in docs),
+                dtype="int64",
+                count=len(docs),
+            )
+        )
+        patents.append(np.array([str(doc["patent_num"]) for doc in docs]))
+        dates.append(
+            np.array(
+                [doc["created_at"] for doc in docs], dtype="datetime64[ns]"
+            )
+        )
+    df = pd.DataFrame(
+        data={
+            "nda": np.concatenate(ndas or [np.empty(0, dtype="int64")]),
+            "patent": np.concatenate(
+                patents or [np.empty(0, dtype="U1")]
+            ).astype(object),
+            "date": pd.to_datetime(
+                np.concatenate(dates or [np.empty(0, dtype="datetime64[ns]")])
+            ),
+        }
+    )
     return df
 
 
+def _source_state(mongo_client):
+    """
+    Returns (count, max_created_at) of the Orange Book collection, or (0, None)
+    if the collection is empty.
+
+    Parameters:
+        mongo_client (MongoClient): The mongo DB client initialized with the
+                                    expected credentials
+    """
+    collection = mongo_client.orange_book_collection
+    count = collection.count_documents({})
+    if not count:
+        return 0, None
+    latest = list(
+        collection.find({}, {"_id": 0, "created_at": 1})
+        .sort("created_at", -1)
+        .limit(1)
+    )
+    return count, latest[0].get("created_at") if latest else None
+
+
+def _source_key(count, max_created_at):
+    """
+    Returns a string identifying the state of the Orange Book data.  For the
+    Orange Book collection, this is the count of documents and the max
+    'created_at' (see _source_state()).  If the collection is empty, this
+    lists the signatures of the csv files (see _source_signature()), so that
+    a csv file modified in place also makes the snapshot stale.
+    """
+    if count:
+        return f"mongo:{count}:{max_created_at}"
+    return "csv:" + ";".join(_source_signature(x) for x in _csv_files())
+
+
+def _build_index(keys, values):
+    """
+    Returns (unique sorted keys, offsets, values sorted by key) such that the
+    values of unique_keys[i] are values[offsets[i]:offsets[i + 1]].
+
+    Parameters:
+        keys (numpy.ndarray): key of each association
+        values (numpy.ndarray): value of each association
+    """
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    unique_keys, starts = np.unique(keys, return_index=True)
+    offsets = np.append(starts, len(keys)).astype("int64")
+    return unique_keys, offsets, values
+
+
+def build_snapshot(orange_book_data, source_key):
+    """
+    Returns a dict of numpy arrays with forward (NDA to patents), reverse
+    (patent to NDAs) and date indexes of orange_book_data.
+
+    Parameters:
+        orange_book_data (pandas.DataFrame): columns "nda", "patent" and
+                                             optionally "date"
+        source_key (String): see _source_key()
+    """
+    pairs = orange_book_data[["nda", "patent"]].drop_duplicates()
+    ndas = pairs["nda"].to_numpy(dtype="int64")
+    patents = pairs["patent"].to_numpy(dtype="U")
+    snapshot = {
+        "version": np.array(SNAPSHOT_VERSION),
+        "source_key": np.array(source_key),
+    }
+    (
+        snapshot["ndas"],
+        snapshot["nda_offsets"],
+        snapshot["nda_patents"],
+    ) = _build_index(ndas, patents)
+    (
+        snapshot["patents"],
+        snapshot["patent_offsets"],
+        snapshot["patent_ndas"],
+    ) = _build_index(patents, ndas)
+    if "date" in orange_book_data.columns:
+        by_date = orange_book_data.sort_values(by="date")
+        snapshot["dates"] = by_date["date"].to_numpy(dtype="datetime64[us]")
+        snapshot["date_ndas"] = by_date["nda"].to_numpy(dtype="int64")
+        snapshot["date_patents"] = by_date["patent"].to_numpy(dtype="U")
+    return snapshot
+
+
+def _snapshot_rows(snapshot):
+    """
+    Returns the data-frame with columns "nda", "patent" and "date" that
+    snapshot was built from, or None if snapshot was not built from MongoDB.
+    """
+    if "date_patents" not in snapshot:
+        return None
+    return pd.DataFrame(
+        {
+            "nda": snapshot["date_ndas"],
+            "patent": snapshot["date_patents"],
+            "date": snapshot["dates"],
+        }
+    )
+
+
+def write_snapshot(file_name, snapshot):
+    """Writes snapshot from build_snapshot() to file_name."""
+    if not os.path.exists(os.path.dirname(file_name)):
+        os.makedirs(os.path.dirname(file_name))
+    # write then rename, so that concurrent readers never see a partial file
+    tmp_file_name = file_name + ".tmp.npz"
+    np.savez(tmp_file_name, **snapshot)
+    os.replace(tmp_file_name, file_name)
+    _logger.info(f"Stored Orange Book snapshot: {file_name}")
+
+
+def read_snapshot(file_name, source_key=None):
+    """
+    Returns the snapshot stored in file_name, or None if it does not exist,
+    has another SNAPSHOT_VERSION, or (if set) another source_key.
+    """
+    if not os.path.exists(file_name):
+        return None
+    with np.load(file_name, allow_pickle=False) as f:
+        snapshot = {key: f[key] for key in f.files}
+    if int(snapshot["version"]) != SNAPSHOT_VERSION or (
+        source_key is not None and str(snapshot["source_key"]) != source_key
+    ):
+        return None
+    return snapshot
+
+
 class OrangeBookMap:
+    """
+    Lookups between NDA and patent numbers of the Orange Book.  The lookups
+    are backed by sorted numpy arrays that are built once, stored to
+    SNAPSHOT_FILE, and shared by all instances (and, through SNAPSHOT_FILE, by
+    other processes) until the Orange Book data changes.
+    """
 
-    _groups_groupby_NDA = None
-    _groups_groupby_patent = None
-    _orange_book_sort_by_date_df = None
+    _ndas = None
+    _nda_offsets = None
+    _nda_patents = None
+    _patents = None
+    _patent_offsets = None
+    _patent_ndas = None
+    _dates = None
+    _date_ndas = None
 
-    def __init__(self, mongo_client):
+    def __init__(self, mongo_client, snapshot_file=None):
         # Initialize class attributes
-        if (
-            OrangeBookMap._groups_groupby_NDA is None
-            or OrangeBookMap._groups_groupby_patent is None
-        ):
-            orange_book_data = _get_all_associations_from_mongo(mongo_client)
-            OrangeBookMap._groups_groupby_NDA = orange_book_data.groupby(
-                ["nda"]
-            )
-            OrangeBookMap._groups_groupby_patent = orange_book_data.groupby(
-                ["patent"]
-            )
-            if "date" in orange_book_data.columns:
-                OrangeBookMap._orange_book_sort_by_date_df = (
-                    orange_book_data.sort_values(by="date")
+        if OrangeBookMap._ndas is None or OrangeBookMap._patents is None:
+            OrangeBookMap.load(mongo_client, snapshot_file or SNAPSHOT_FILE)
+
+    @classmethod
+    def load(cls, mongo_client, snapshot_file):
+        """
+        Sets class attributes from snapshot_file, rebuilding snapshot_file if
+        it is missing or stale.
+
+        Parameters:
+            mongo_client (MongoClient): The mongo DB client
+            snapshot_file (Path): location of the snapshot
+        """
+        count, max_created_at = _source_state(mongo_client)
+        source_key = _source_key(count, max_created_at)
+        snapshot = read_snapshot(snapshot_file)
+        if snapshot is None or str(snapshot["source_key"]) != source_key:
+            orange_book_data = None
+            old_rows = _snapshot_rows(snapshot) if snapshot else None
+            if count and old_rows is not None and len(old_rows):
+                # pull only documents added since the stale snapshot; valid if
+                # no document was removed or changed since then
+                new_rows = _get_all_associations_from_mongo(
+                    mongo_client, since=old_rows["date"].max().to_pydatetime()
+                )
+                if len(old_rows) + len(new_rows) == count:
+                    _logger.info(
+                        f"Adding {len(new_rows)} Orange Book documents to "
+                        "snapshot"
+                    )
+                    orange_book_data = pd.concat(
+                        [old_rows, new_rows], ignore_index=True
+                    )
+            if orange_book_data is None:
+                orange_book_data = _get_all_associations_from_mongo(
+                    mongo_client
                 )
+            snapshot = build_snapshot(orange_book_data, source_key)
+            write_snapshot(snapshot_file, snapshot)
+        cls._ndas = snapshot["ndas"]
+        cls._nda_offsets = snapshot["nda_offsets"]
+        cls._nda_patents = snapshot["nda_patents"]
+        cls._patents = snapshot["patents"]
+        cls._patent_offsets = snapshot["patent_offsets"]
+        cls._patent_ndas = snapshot["patent_ndas"]
+        cls._dates = snapshot.get("dates")
+        cls._date_ndas = snapshot.get("date_ndas")
+
+    @classmethod
+    def reset(cls):
+        """Clears class attributes so that the next instance reloads them."""
+        cls._ndas = cls._patents = None
+
+    @staticmethod
+    def _lookup(keys, offsets, values, key):
+        i = np.searchsorted(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return values[offsets[i] : offsets[i + 1]].tolist()
+        return []
 
     def get_patents(self, nda):
         """Returns a list of patent numbers given an NDA number.
@@ -112,11 +421,12 @@ class OrangeBookMap:
             nda (int or string): the number portion of an NDA number or string
         """
         try:
-            return self._groups_groupby_NDA.get_group(int(nda))[
-                "patent"
-            ].tolist()
-        except KeyError:
+            nda = int(nda)
+        except ValueError:
             return []
+        return self._lookup(
+            self._ndas, self._nda_offsets, self._nda_patents, nda
+        )
 
     def get_nda(self, patent):
         """Returns a list of NDA numbers given a patent number.
@@ -125,20 +435,17 @@ class OrangeBookMap:
             patent (int or string): the number portion of patent include 'RE'
                                     if applicable
         """
-        try:
-            return self._groups_groupby_patent.get_group(str(patent))[
-                "nda"
-            ].tolist()
-        except KeyError:
-            return []
+        return self._lookup(
+            self._patents, self._patent_offsets, self._patent_ndas, str(patent)
+        )
 
     def get_all_patents(self):
         """Returns a list of all patent numbers."""
-        return list(self._groups_groupby_patent.groups.keys())
+        return self._patents.tolist()
 
     def get_all_nda(self):
         """Returns a list of all NDA numbers."""
-        return list(self._groups_groupby_NDA.groups.keys())
+        return self._ndas.tolist()
 
     def get_all_nda_past_date(self, date_):
         """Returns a list of NDA numbers on or after date_
@@ -146,9 +453,11 @@ class OrangeBookMap:
         Parameters:
             date_ (datetime): datetime object
         """
-        if isinstance(self._orange_book_sort_by_date_df, pd.DataFrame):
-            mask = self._orange_book_sort_by_date_df["date"] >= date_
-            return self._orange_book_sort_by_date_df.loc[mask]["nda"].to_list()
+        if self._dates is not None:
+            start = np.searchsorted(
+                self._dates, np.datetime64(date_, "us"), side="left"
+            )
+            return np.unique(self._date_ndas[start:]).tolist()
         else:
             _logger.warning(
                 "Not getting Orange Book data from Mongo.  There "
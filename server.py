@@ -2,26 +2,252 @@
 This file will run a simple server.
 Port 80 of firewall needs to be made available to all users.
 Run with `nohup python3 server.py &` with no quotes.
+
+Files are served read-only (no CGI) by one thread per request, with HTTP Range
+requests, ETag/Last-Modified conditional responses and zero-copy sendfile()
+transfers.  Each request is logged with its duration and throughput.
 """
 
+import argparse
+from email.utils import formatdate, parsedate_to_datetime
+import functools
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 import os
-from http.server import HTTPServer, CGIHTTPRequestHandler
+import threading
+import time
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
 
 # Set host folder name here:
 folder_name = "./resources/hosted_folder/"
 
-# Make folder if non-existant
-folder_name = os.path.abspath(folder_name)
-if not os.path.exists(os.path.dirname(folder_name)):
-    os.makedirs(os.path.dirname(folder_name))
+# bytes per sendfile() call
+SENDFILE_CHUNK_SIZE = 8 << 20
+
+
+class _Stats:
+    """Running totals of all requests served."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, sent, seconds):
+        with self.lock:
+            self.requests += 1
+            self.bytes += sent
+            self.seconds += seconds
+            return self.requests, self.bytes
+
+
+def parse_range(range_header, size):
+    """
+    Returns (start, end) of the byte range of a 'Range' header value, both
+    inclusive, or None if the header is not a single byte range.  Raises
+    ValueError if the range is not satisfiable for a file of size bytes.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes=") :].strip()
+    if "," in spec or "-" not in spec:
+        # multiple ranges are served as the full file
+        return None
+    first, last = [x.strip() for x in spec.split("-", 1)]
+    try:
+        if not first:
+            # suffix range, ex: 'bytes=-500'
+            length = int(last)
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if not first:
+        if length <= 0:
+            raise ValueError(range_header)
+        return max(size - length, 0), size - 1
+    if start >= size or end < start:
+        raise ValueError(range_header)
+    return start, min(end, size - 1)
+
+
+class StaticFileHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files of a folder with Range, ETag and Last-Modified support.
+    """
+
+    stats = _Stats()
+
+    def send_head(self):
+        self._range = None
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return super().send_head()
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        try:
+            fs = os.fstat(f.fileno())
+            etag = f'"{fs.st_mtime_ns:x}-{fs.st_size:x}"'
+            last_modified = formatdate(fs.st_mtime, usegmt=True)
+
+            if self._not_modified(etag, fs.st_mtime):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                f.close()
+                return None
+
+            byte_range = None
+            if_range = self.headers.get("If-Range")
+            if if_range is None or if_range in (etag, last_modified):
+                try:
+                    byte_range = parse_range(
+                        self.headers.get("Range"), fs.st_size
+                    )
+                except ValueError:
+                    self.send_response(
+                        HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+                    )
+                    self.send_header("Content-Range", f"bytes */{fs.st_size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    f.close()
+                    return None
+
+            if byte_range:
+                start, end = byte_range
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{end}/{fs.st_size}"
+                )
+            else:
+                start, end = 0, fs.st_size - 1
+                self.send_response(HTTPStatus.OK)
+            self._range = (start, end - start + 1)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def _not_modified(self, etag, mtime):
+        """Returns True if the conditional request headers match the file."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [x.strip() for x in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def copyfile(self, source, outputfile):
+        """Sends the requested range of source with sendfile()."""
+        if not getattr(self, "_range", None):
+            return super().copyfile(source, outputfile)
+        offset, count = self._range
+        try:
+            socket_fd = self.connection.fileno()
+            while count > 0:
+                sent = os.sendfile(
+                    socket_fd,
+                    source.fileno(),
+                    offset,
+                    min(count, SENDFILE_CHUNK_SIZE),
+                )
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+                self._sent += sent
+        except (AttributeError, OSError) as e:
+            if isinstance(e, OSError) and self._sent:
+                # the client closed the connection
+                raise
+            # sendfile() is not available for this file or platform
+            source.seek(offset)
+            while count > 0:
+                data = source.read(min(count, 1 << 20))
+                if not data:
+                    break
+                outputfile.write(data)
+                count -= len(data)
+                self._sent += len(data)
+
+    def _serve(self, method):
+        self._sent = 0
+        self._status = None
+        start = time.time()
+        try:
+            method()
+        finally:
+            seconds = time.time() - start
+            requests, total = self.stats.add(self._sent, seconds)
+            _logger.info(
+                f'{self.address_string()} "{self.requestline}" '
+                f"{self._status} {self._sent} bytes {seconds:.3f}s "
+                f"{self._sent / max(seconds, 1e-9) / 1e6:.2f} MB/s "
+                f"(total: {requests} requests, {total} bytes)"
+            )
+
+    def do_GET(self):
+        self._serve(super().do_GET)
+
+    def do_HEAD(self):
+        self._serve(super().do_HEAD)
+
+    def log_request(self, code="-", size="-"):
+        # logged with throughput once the response is sent
+        self._status = int(code) if isinstance(code, int) else code
+
+    def log_message(self, format, *args):
+        _logger.warning(f"{self.address_string()} {format % args}")
+
+
+def make_server(folder, host="", port=80):
+    """
+    Returns a ThreadingHTTPServer serving the files of folder.
+
+    Parameters:
+        folder (Path): folder to serve
+        host (String): address to listen on; all addresses if ""
+        port (int): port to listen on
+    """
+    folder = os.path.abspath(folder)
+    # Make folder if non-existant
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    handler = functools.partial(StaticFileHandler, directory=folder)
+    return ThreadingHTTPServer((host, port), handler)
+
 
-# Make sure the server is created at current directory
-os.chdir(folder_name)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the hosted folder.")
+    parser.add_argument("-port", "--port", type=int, default=80)
+    parser.add_argument("-folder", "--folder", default=folder_name)
+    args = parser.parse_args()
 
-# Create server object listening the port 80
-server_object = HTTPServer(
-    server_address=("", 80), RequestHandlerClass=CGIHTTPRequestHandler
-)
+    # Create server object listening the port
+    server_object = make_server(args.folder, port=args.port)
+    _logger.info(f"Serving {os.path.abspath(args.folder)} on port {args.port}")
 
-# Start the web server
-server_object.serve_forever()
+    # Start the web server
+    server_object.serve_forever()
@@ -1,12 +1,17 @@
 from collections import OrderedDict
 from bson.objectid import ObjectId
+from functools import lru_cache
 from sentence_transformers import SentenceTransformer, util
 import html
 import os
+import torch
 
+from db import score_store
+from diff.run_diff import iter_set_id_groups
+from db import watermark
 from orangebook.merge import OrangeBookMap
 from similarity.claim_dependency import get_parent_claims
-from utils import misc
+from utils import metrics, misc
 from utils.logging import getLogger
 
 _logger = getLogger(__name__)
@@ -21,6 +26,26 @@ _model = SentenceTransformer("stsb-mpnet-base-v2", device=_device)
 _model.max_seq_length = 512
 _model.eval()
 
+# texts longer than _model.max_seq_length are split into overlapping windows of
+# tokens, each window is embedded and the window embeddings are pooled into one
+# embedding per text; off by default (truncation), set by main.py
+# -chunk_embeddings.  Scores change when this is toggled, so all labels should
+# be rescored (main.py -r) to avoid mixing scores of both methods.
+_chunk_embeddings = False
+# number of tokens shared by adjacent windows
+_chunk_overlap = 128
+# pooling of window embeddings: "mean" or "max"
+_chunk_pooling = "mean"
+_chunk_batch_size = 32
+
+# fields of each label read by run_similarity()
+SIMILARITY_PROJECTION = ["additions", "diff_against_previous_label"]
+# fields of each label written by run_similarity()
+SIMILARITY_FIELDS = ["additions", "diff_against_previous_label", "score_claims"]
+# fields of each label removed by run_similarity() unless set, such as
+# 'score_claims' of sidecar scores of a previous run stored inline
+SIMILARITY_UNSET_FIELDS = ["score_claims"]
+
 
 def get_claims_in_patents_db(mongo_client, all_patents):
     """
@@ -119,10 +144,12 @@ def get_list_of_additions(docs):
                      application_numbers
     """
     return_list = []
+    seen = set()
     for doc in docs:
-        if doc["additions"]:
+        if doc.get("additions"):
             for value in doc["additions"].values():
-                if value["expanded_content"] not in return_list:
+                if value["expanded_content"] not in seen:
+                    seen.add(value["expanded_content"])
                     return_list.append([value["expanded_content"]])
     return return_list
 
@@ -141,7 +168,8 @@ def preprocess(matrix, index):
     tokens and will automatically truncate longer text inputs.  (The exception
     to rule is for models such as Longformer or Bert-AL, or Reformer. However
     Bert-AL and Reformer are unavailable as HuggingFace models, and Longformer
-    performs poorly.)
+    performs poorly.)  Longer texts are therefore embedded in overlapping
+    windows by encode_chunked().
 
     Parameters:
         matrix (list): a list of lists
@@ -156,10 +184,283 @@ def preprocess(matrix, index):
     return return_list
 
 
-def rank_and_score(docs, additions_list, patent_list, num_scores=0):
+def split_into_windows(token_ids, window_size, overlap):
+    """
+    Returns a list of overlapping windows (tuples) of token_ids.  Each window
+    has at most window_size tokens and shares overlap tokens with the prior
+    window.  For example, split_into_windows((1, 2, 3, 4, 5), 3, 1) returns
+    [(1, 2, 3), (3, 4, 5)].
+
+    Parameters:
+        token_ids (tuple): token ids of a text without special tokens
+        window_size (int): maximum number of tokens in a window
+        overlap (int): number of tokens shared by adjacent windows
+    """
+    if window_size < 1:
+        raise ValueError(f"window_size must be positive: {window_size}")
+    if not 0 <= overlap < window_size:
+        raise ValueError(
+            f"overlap must be in [0, {window_size}) but got: {overlap}"
+        )
+    token_ids = tuple(token_ids)
+    if len(token_ids) <= window_size:
+        return [token_ids]
+    stride = window_size - overlap
+    windows = []
+    start = 0
+    while True:
+        windows.append(token_ids[start : start + window_size])
+        if start + window_size >= len(token_ids):
+            break
+        start += stride
+    return windows
+
+
+@lru_cache(maxsize=65536)
+def _token_windows(text):
+    """
+    Returns the windows of token ids for text, each wrapped with the special
+    tokens of the model.  Results are cached so that claims shared between NDA
+    groups are only tokenized and split once.
+
+    Parameters:
+        text (String): preprocessed text
+    """
+    tokenizer = _model.tokenizer
+    window_size = _model.max_seq_length - tokenizer.num_special_tokens_to_add()
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+    return tuple(
+        tuple(tokenizer.build_inputs_with_special_tokens(list(window)))
+        for window in split_into_windows(
+            token_ids, window_size, min(_chunk_overlap, window_size - 1)
+        )
+    )
+
+
+def encode_chunked(texts, pooling=None, batch_size=None):
+    """
+    Returns a tensor of embeddings, one row per text in texts.  Texts that fit
+    within _model.max_seq_length are embedded exactly as _model.encode() would
+    embed them.  Longer texts are split into overlapping windows; the windows of
+    all texts are embedded together in length sorted batches and the window
+    embeddings of each text are pooled.
+
+    Parameters:
+        texts (list): list of preprocessed strings
+        pooling (String): "mean" or "max"; defaults to _chunk_pooling
+        batch_size (int): windows per forward pass; defaults to
+                          _chunk_batch_size
+    """
+    pooling = pooling or _chunk_pooling
+    batch_size = batch_size or _chunk_batch_size
+    if pooling not in ["mean", "max"]:
+        raise ValueError(f"Unknown pooling: {pooling}")
+    if not texts:
+        return torch.empty(0)
+
+    # windows = [(index of text, token ids),]
+    with metrics.timer("similarity.tokenization", len(texts)):
+        windows = [
+            (text_index, window)
+            for text_index, text in enumerate(texts)
+            for window in _token_windows(text)
+        ]
+    # sort by length so that each batch needs little padding
+    order = sorted(range(len(windows)), key=lambda i: len(windows[i][1]))
+    pad_id = _model.tokenizer.pad_token_id
+    window_embeddings = [None] * len(windows)
+    with metrics.timer("similarity.encoding", len(texts)), torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            batch = order[start : start + batch_size]
+            max_len = max(len(windows[i][1]) for i in batch)
+            input_ids = [
+                list(windows[i][1]) + [pad_id] * (max_len - len(windows[i][1]))
+                for i in batch
+            ]
+            attention_mask = [
+                [1] * len(windows[i][1]) + [0] * (max_len - len(windows[i][1]))
+                for i in batch
+            ]
+            features = {
+                "input_ids": torch.tensor(input_ids, device=_model.device),
+                "attention_mask": torch.tensor(
+                    attention_mask, device=_model.device
+                ),
+            }
+            embeddings = _model.forward(features)["sentence_embedding"]
+            for i, embedding in zip(batch, embeddings):
+                window_embeddings[i] = embedding
+
+    # pool window embeddings of each text
+    grouped = [[] for _ in texts]
+    for (text_index, _), embedding in zip(windows, window_embeddings):
+        grouped[text_index].append(embedding)
+    pooled = []
+    for embeddings in grouped:
+        stacked = torch.stack(embeddings)
+        if pooling == "max":
+            pooled.append(stacked.max(dim=0).values)
+        else:
+            pooled.append(stacked.mean(dim=0))
+    return torch.stack(pooled)
+
+
+def encode(texts):
+    """
+    Returns a tensor of embeddings for texts, using encode_chunked() if
+    _chunk_embeddings is set.
+
+    Parameters:
+        texts (list): list of preprocessed strings
+    """
+    if _chunk_embeddings:
+        return encode_chunked(texts)
+    with metrics.timer("similarity.encoding", len(texts)):
+        return _model.encode(texts, convert_to_tensor=True)
+
+
+def encode_cached(texts, embedding_cache):
+    """
+    Returns a tensor of embeddings for texts like encode(), encoding only the
+    texts missing from embedding_cache, {text: embedding}, and adding them to
+    it.
+
+    Parameters:
+        texts (list): list of preprocessed strings
+        embedding_cache (dict): embeddings of texts already encoded, such as
+                                additions shared by several set_id groups
+    """
+    missing = list(dict.fromkeys(x for x in texts if x not in embedding_cache))
+    if missing:
+        for text, embedding in zip(missing, encode(missing)):
+            embedding_cache[text] = embedding
+    if not texts:
+        return encode(texts)
+    return torch.stack([embedding_cache[x] for x in texts])
+
+
+def percentile_score(cosine_scores, percentile):
+    """
+    Returns the score at percentile (0-100) of all scores of cosine_scores.
+    """
+    flat = cosine_scores.flatten()
+    k = int(round(percentile / 100 * flat.numel()))
+    k = min(max(k, 1), flat.numel())
+    return flat.kthvalue(k).values
+
+
+def retention_mask(
+    cosine_scores,
+    patent_numbers,
+    num_scores=0,
+    min_score=None,
+    percentile=None,
+    best_claim_per_patent=False,
+    percentile_threshold=None,
+):
+    """
+    Returns a boolean tensor with the shape of cosine_scores that is True for
+    each score to keep.  The policies are applied in the order of the
+    parameters below, starting with min_score; num_scores is applied last.
+
+    Parameters:
+        cosine_scores (tensor): scores of shape (additions, claims)
+        patent_numbers (list): patent number of each claim (column)
+        num_scores (int): number of highest scores to keep for each addition;
+                          if num_scores<1, this policy is not applied
+        min_score (float): drop scores below min_score
+        percentile (float): drop scores below this percentile (0-100) of all
+                            scores of cosine_scores
+        best_claim_per_patent (Boolean): keep only the highest scoring claim
+                                         of each patent for each addition
+        percentile_threshold (float): optional; score of percentile computed
+                                      over more scores than cosine_scores
+                                      (all scores of the NDA group in
+                                      run_similarity()), used instead of
+                                      the percentile of cosine_scores
+    """
+    keep = torch.ones_like(cosine_scores, dtype=torch.bool)
+    if cosine_scores.numel() == 0:
+        return keep
+
+    if min_score is not None:
+        keep &= cosine_scores >= min_score
+
+    if percentile_threshold is not None:
+        keep &= cosine_scores >= percentile_threshold
+    elif percentile is not None:
+        keep &= cosine_scores >= percentile_score(cosine_scores, percentile)
+
+    if best_claim_per_patent:
+        best = torch.zeros_like(keep)
+        rows = torch.arange(cosine_scores.shape[0])
+        for patent_number in set(patent_numbers):
+            columns = torch.tensor(
+                [i for i, x in enumerate(patent_numbers) if x == patent_number]
+            )
+            best_in_patent = cosine_scores[:, columns].argmax(dim=1)
+            best[rows, columns[best_in_patent]] = True
+        keep &= best
+
+    if num_scores > 0 and num_scores < cosine_scores.shape[1]:
+        masked = cosine_scores.masked_fill(~keep, float("-inf"))
+        top = masked.topk(num_scores, dim=1).indices
+        in_top = torch.zeros_like(keep)
+        in_top.scatter_(1, top, torch.ones_like(top, dtype=torch.bool))
+        keep &= in_top
+
+    return keep
+
+
+def discarded_summary(cosine_scores, keep):
+    """
+    Returns a list, one element per addition (row), of None if no score was
+    discarded or a dict summarizing the discarded scores:
+        {"count": 30, "mean": 0.21, "std": 0.05, "min": 0.1, "max": 0.35}
+
+    Parameters:
+        cosine_scores (tensor): scores of shape (additions, claims)
+        keep (tensor): boolean tensor from retention_mask()
+    """
+    dropped = ~keep
+    count = dropped.sum(dim=1)
+    zeroed = cosine_scores.masked_fill(keep, 0.0)
+    total = zeroed.sum(dim=1)
+    total_sq = (zeroed * zeroed).sum(dim=1)
+    mean = total / count.clamp(min=1)
+    std = (total_sq / count.clamp(min=1) - mean * mean).clamp(min=0).sqrt()
+    low = cosine_scores.masked_fill(keep, float("inf")).min(dim=1).values
+    high = cosine_scores.masked_fill(keep, float("-inf")).max(dim=1).values
+    return [
+        {"count": c, "mean": m, "std": d, "min": lo, "max": hi} if c else None
+        for c, m, d, lo, hi in zip(
+            count.tolist(),
+            mean.tolist(),
+            std.tolist(),
+            low.tolist(),
+            high.tolist(),
+        )
+    ]
+
+
+def rank_and_score(
+    docs,
+    additions_list,
+    patent_list,
+    num_scores=0,
+    min_score=None,
+    percentile=None,
+    best_claim_per_patent=False,
+    claims_embeddings=None,
+    embedding_cache=None,
+    percentile_threshold=None,
+):
     """
     Returns a list of label docs in MongoDB format, wherein each doc includes
-    doc['additions'][X]['scores'] if doc['additions'][X] exists.
+    doc['additions'][X]['scores'] if doc['additions'][X] exists.  If any score
+    of doc['additions'][X] is dropped by a retention policy (see
+    retention_mask()), the dropped scores are summarized in
+    doc['additions'][X]['scores_discarded'] (see discarded_summary()).
 
     Example of doc['additions'][X]['scores']:
         [
@@ -182,42 +483,65 @@ def rank_and_score(docs, additions_list, patent_list, num_scores=0):
                              claim_text],..]
         num_scores (int): number of scores to include with each addition; if
                         num_score<1, all scores are included with each addition
+        min_score (float): see retention_mask()
+        percentile (float): see retention_mask()
+        best_claim_per_patent (Boolean): see retention_mask()
+        claims_embeddings (tensor): embeddings of the claims of patent_list,
+                                    if already computed
+        embedding_cache (dict): optional; {addition: embedding} of additions
+                                already encoded (see encode_cached())
+        percentile_threshold (float): see retention_mask()
     """
     # create 2 lists of cleaned texts (ex: [expanded_content,] or [claim_text,])
     additions = preprocess(additions_list, 0)
-    claims = preprocess(patent_list, 3)
 
     # Compute embedding for both lists
-    additions_embeddings = _model.encode(
-        additions,
-        convert_to_tensor=True,
-    )
-    claims_embeddings = _model.encode(
-        claims,
-        convert_to_tensor=True,
-    )
+    if embedding_cache is None:
+        additions_embeddings = encode(additions)
+    else:
+        additions_embeddings = encode_cached(additions, embedding_cache)
+    if claims_embeddings is None:
+        claims_embeddings = encode(preprocess(patent_list, 3))
 
     # Compute cosine-similarity for every additions to every claim
-    cosine_scores = util.pytorch_cos_sim(
-        additions_embeddings, claims_embeddings
+    with metrics.timer("similarity.cosine", len(additions)):
+        cosine_scores = util.pytorch_cos_sim(
+            additions_embeddings, claims_embeddings
+        ).cpu()
+
+    # apply retention policies before building any python objects
+    keep = retention_mask(
+        cosine_scores,
+        [x[0] for x in patent_list],
+        num_scores,
+        min_score,
+        percentile,
+        best_claim_per_patent,
+        percentile_threshold,
     )
-    cosine_scores = cosine_scores.tolist()
-    indices_of_claims = list(range(len(claims)))
+    discarded = discarded_summary(cosine_scores, keep)
+
+    # sort each row from highest to lowest score; dropped scores sort last
+    sorted_scores, sorted_indices = cosine_scores.masked_fill(
+        ~keep, float("-inf")
+    ).sort(dim=1, descending=True)
+    kept_counts = keep.sum(dim=1).tolist()
+    sorted_scores = sorted_scores.tolist()
+    sorted_indices = sorted_indices.tolist()
 
     # addition_to_score_index= {"expanded_content":[(score, index),]} wherein
     # (score, index) is sorted from highest to lowest score for each
     # "expanded_content"
     addition_to_score_index = {}
+    addition_to_discarded = {}
     for i in range(len(additions)):
-        if num_scores > 0:
-            # truncate the number of scores to length of num_scores
-            addition_to_score_index[additions_list[i][0]] = sorted(
-                zip(cosine_scores[i], indices_of_claims), reverse=True
-            )[:num_scores]
-        else:
-            addition_to_score_index[additions_list[i][0]] = sorted(
-                zip(cosine_scores[i], indices_of_claims), reverse=True
+        addition_to_score_index[additions_list[i][0]] = list(
+            zip(
+                sorted_scores[i][: kept_counts[i]],
+                sorted_indices[i][: kept_counts[i]],
             )
+        )
+        addition_to_discarded[additions_list[i][0]] = discarded[i]
 
     for doc in docs:
         if doc["additions"]:
@@ -234,18 +558,36 @@ def rank_and_score(docs, additions_list, patent_list, num_scores=0):
                     }
                     for item in score_index_list
                 ]
+                doc["additions"][key].pop("scores_discarded", None)
+                # set again by score_store.store_scores() for sidecar storage
+                doc["additions"][key].pop("scores_ref", None)
+                if addition_to_discarded[value["expanded_content"]]:
+                    doc["additions"][key][
+                        "scores_discarded"
+                    ] = addition_to_discarded[value["expanded_content"]]
     return docs
 
 
-def additions_in_diff_against_previous_label(docs):
+def additions_in_diff_against_previous_label(docs, reference_only=False):
     """
     Add additions back to each diff_against_previous_label['text'][X][0] that
-    is 1.  This feature is requested by the front end.
+    is 1.  This feature is requested by the front end.  If reference_only is
+    set, only the key of the addition is kept and any previously added copy of
+    the addition is removed (see score_store.expand_diff_additions()).
 
     Parameters:
     docs (list): list of sorted label docs from mongodb having the same
                  application_numbers
+    reference_only (Boolean): whether to keep only the key of the addition
     """
+    if reference_only:
+        for doc in docs:
+            for diff in doc.get("diff_against_previous_label") or []:
+                diff["text"] = [
+                    text[:3] if text[0] == 1 else text for text in diff["text"]
+                ]
+        return docs
+
     for doc in docs:
         if doc["additions"] and doc["diff_against_previous_label"]:
             for i in range(len(doc["diff_against_previous_label"])):
@@ -263,6 +605,48 @@ def additions_in_diff_against_previous_label(docs):
     return docs
 
 
+def nda_group_percentile_threshold(
+    label_collection,
+    application_numbers,
+    claims_embeddings,
+    percentile,
+    embedding_cache,
+):
+    """
+    Returns the score at percentile (0-100) of the scores of all distinct
+    additions of the NDA group of application_numbers against its claims, so
+    that the percentile retention policy applies to the whole NDA group while
+    its set_id groups are scored one at a time.  Returns None if the NDA group
+    has no additions.  The additions are encoded into embedding_cache, so they
+    are not encoded again when their set_id groups are scored.
+
+    Parameters:
+        label_collection (object): MongoDB label collection
+        application_numbers (list): a list of application numbers such as
+                                    ['NDA204223',]
+        claims_embeddings (tensor): embeddings of the claims of the NDA group
+        percentile (float): see retention_mask()
+        embedding_cache (dict): {addition: embedding}, see encode_cached()
+    """
+    additions = {}
+    for set_id_group in metrics.timed_iter(
+        iter_set_id_groups(
+            label_collection, application_numbers, ["additions"]
+        ),
+        "similarity.mongo_read",
+    ):
+        for addition in preprocess(get_list_of_additions(set_id_group), 0):
+            additions[addition] = None
+    if not additions:
+        return None
+    additions_embeddings = encode_cached(list(additions), embedding_cache)
+    with metrics.timer("similarity.cosine", len(additions)):
+        cosine_scores = util.pytorch_cos_sim(
+            additions_embeddings, claims_embeddings
+        ).cpu()
+    return percentile_score(cosine_scores, percentile)
+
+
 def run_similarity(
     mongo_client,
     processed_label_ids_file,
@@ -270,6 +654,12 @@ def run_similarity(
     unprocessed_label_ids_file,
     unprocessed_nda_file,
     since_date=None,
+    score_storage="inline",
+    score_dtype="float32",
+    reference_additions=False,
+    retention=None,
+    label_ids=None,
+    watermark_file=None,
 ):
     """
     This method calls other methods in this module and tracks completed label
@@ -281,23 +671,41 @@ def run_similarity(
         processed_nda_file (Path): location to store processed NDAs
         unprocessed_label_ids_file (Path): location to store unprocessed ids
         unprocessed_nda_file (Path): location to store unprocessed NDAs
+        since_date (datetime): optional argument; process only NDA groups
+                               with labels inserted or Orange Book updates on
+                               or after since_date
+        score_storage (String): "inline" stores scores within label docs;
+                                "sidecar" stores packed scores in the score
+                                collection (see db/score_store.py)
+        score_dtype (String): "float16" or "float32" for "sidecar" storage
+        reference_additions (Boolean): store only the addition key within
+                                       diff_against_previous_label
+        retention (dict): retention policies passed to rank_and_score(), such
+                          as {"num_scores": 10, "min_score": 0.2,
+                          "percentile": 90, "best_claim_per_patent": True}
+        label_ids (list): optional label _id strings; if set, process only the
+                          NDA groups of these labels
+        watermark_file (Path): optional location of the watermark of the last
+                               run (see db/watermark.py); if set, process only
+                               NDA groups changed since the last run
     """
     label_collection = mongo_client.label_collection
+    # labels must have nda_group_key to be found with their NDA group
+    mongo_client.backfill_nda_group_key()
     label_collection_name = mongo_client.label_collection_name
 
-    # select all label_ids with date on or after since_date
-    if since_date:
-        ob = OrangeBookMap(mongo_client)
-        NDA_list = ob.get_all_nda_past_date(since_date)
-        # $in finds all labels with any NDA in NDA_list
-        # https://docs.mongodb.com/manual/reference/operator/query/in/
-        all_label_ids = []
-        for x in NDA_list:
-            for y in label_collection.find(
-                {"application_numbers": {"$in": x}}, {"_id", 1}
-            ):
-                all_label_ids.append(str(y["_id"]))
-        all_label_ids = list(set(all_label_ids))
+    # select all labels of NDA groups changed on or after since_date, or
+    # since the watermark of the last run
+    new_watermark = None
+    if label_ids is not None:
+        all_label_ids = list(label_ids)
+    elif since_date or watermark_file:
+        new_watermark = watermark.current_watermark(mongo_client)
+        if since_date:
+            since = watermark.from_date(since_date)
+        else:
+            since = watermark.read_watermark(watermark_file)
+        all_label_ids = watermark.changed_label_ids(mongo_client, since)
 
     else:
         # open processed_label_id_file and return a list of processed _id string
@@ -347,38 +755,94 @@ def run_similarity(
             label_index += 1
             continue
 
-        # find all other docs with the same list of NDA numbers
-        # $all disregard order
-        # see https://docs.mongodb.com/manual/tutorial/query-arrays/
-        # len(similar_label_docs) is at least 1
-        similar_label_docs = list(
-            label_collection.find(
-                {"application_numbers": {"$all": application_numbers}}
-            )
-        )
-
-        # patent_list = [[patent_num, claim_num, parent_clm_list, claim_text],]
-        patent_list = patent_claims_from_NDA(mongo_client, application_numbers)
-        # additions_list = [expanded_content, expanded_content...]
-        additions_list = get_list_of_additions(similar_label_docs)
-
-        similar_label_docs_ids = [str(x["_id"]) for x in similar_label_docs]
-
-        if patent_list:
-            if additions_list:
-                similar_label_docs = rank_and_score(
-                    similar_label_docs, additions_list, patent_list
-                )
-
-                similar_label_docs = additions_in_diff_against_previous_label(
-                    similar_label_docs
-                )
-
-                # update MongoDB
-                mongo_client.update_db(
-                    label_collection_name, similar_label_docs
+        similar_label_docs_ids = []
+        with metrics.group(
+            "similarity", misc.nda_group_key(application_numbers)
+        ):
+            # patent_list = [[patent_num, claim_num, parent_clm_list,
+            #                 claim_text],]
+            with metrics.timer("similarity.claims"):
+                patent_list = patent_claims_from_NDA(
+                    mongo_client, application_numbers
                 )
+            metrics.add_sizes(claims=len(patent_list))
+            if patent_list:
+                # claims are embedded once for all set_id groups of the NDA
+                # group, and each distinct addition once for the NDA group
+                claims_embeddings = None
+                embedding_cache = {}
+                retention_policies = dict(retention or {})
+                if retention_policies.get("percentile") is not None:
+                    # the percentile applies to all scores of the NDA group
+                    claims_embeddings = encode(preprocess(patent_list, 3))
+                    retention_policies[
+                        "percentile_threshold"
+                    ] = nda_group_percentile_threshold(
+                        label_collection,
+                        application_numbers,
+                        claims_embeddings,
+                        retention_policies["percentile"],
+                        embedding_cache,
+                    )
+                # stream all other docs with the same list of NDA numbers, one
+                # set_id group at a time
+                for set_id_group in metrics.timed_iter(
+                    iter_set_id_groups(
+                        label_collection,
+                        application_numbers,
+                        SIMILARITY_PROJECTION,
+                    ),
+                    "similarity.mongo_read",
+                ):
+                    similar_label_docs_ids += [
+                        str(x["_id"]) for x in set_id_group
+                    ]
+                    # additions_list = [[expanded_content],
+                    #                   [expanded_content],...]
+                    additions_list = get_list_of_additions(set_id_group)
+                    metrics.add_sizes(
+                        labels=len(set_id_group), additions=len(additions_list)
+                    )
+                    if not additions_list:
+                        continue
+                    if claims_embeddings is None:
+                        claims_embeddings = encode(preprocess(patent_list, 3))
+
+                    set_id_group = rank_and_score(
+                        set_id_group,
+                        additions_list,
+                        patent_list,
+                        claims_embeddings=claims_embeddings,
+                        embedding_cache=embedding_cache,
+                        **retention_policies,
+                    )
+
+                    set_id_group = additions_in_diff_against_previous_label(
+                        set_id_group, reference_additions
+                    )
+
+                    with metrics.timer(
+                        "similarity.update_db", len(set_id_group)
+                    ):
+                        if score_storage == "sidecar":
+                            set_id_group = score_store.store_scores(
+                                mongo_client, set_id_group, score_dtype
+                            )
+                        else:
+                            # sidecar scores of a previous run are stale
+                            score_store.delete_scores(
+                                mongo_client, set_id_group
+                            )
+
+                        # update MongoDB
+                        mongo_client.update_fields(
+                            label_collection_name,
+                            set_id_group,
+                            SIMILARITY_FIELDS,
+                            SIMILARITY_UNSET_FIELDS,
+                        )
 
+        if patent_list:
             # store processed_label_ids & processed application_numbers to disk
             if processed_label_ids_file:
                 misc.append_to_file(
@@ -389,6 +853,13 @@ def run_similarity(
                     processed_nda_file, str(application_numbers)[1:-1]
                 )
         else:
+            similar_label_docs_ids = [
+                str(x["_id"])
+                for x in label_collection.find(
+                    {"nda_group_key": misc.nda_group_key(application_numbers)},
+                    {"_id": 1},
+                )
+            ]
             # store unprocessed label_ids & unprocessed application_numbers to
             # disk
             if unprocessed_label_ids_file:
@@ -400,7 +871,15 @@ def run_similarity(
                     unprocessed_nda_file, str(application_numbers)[1:-1]
                 )
 
+        if not similar_label_docs_ids:
+            # label is missing nda_group_key; skip for now
+            label_index += 1
+            continue
+
         # remove similar_label_docs_ids from all_label_ids
-        all_label_ids = [
-            x for x in all_label_ids if x not in similar_label_docs_ids
-        ]
+        processed_ids = set(similar_label_docs_ids)
+        all_label_ids = [x for x in all_label_ids if x not in processed_ids]
+
+    # store watermark of the state of the database at the start of this run
+    if watermark_file and new_watermark:
+        watermark.store_watermark(watermark_file, new_watermark)
@@ -1,8 +1,151 @@
+"""
+Rounds the scores stored in the label collection to reduce the size of the
+database.  By default, scores are rounded on the MongoDB server with update
+pipelines ($round requires MongoDB 4.2+), batch by batch of label _id.  If the
+server does not support update pipelines, labels are streamed through python
+instead.  Either way, the last processed _id is written to a progress file so
+that an interrupted run resumes where it stopped.
+"""
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+import os
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from utils import misc
 from utils.logging import getLogger
 
 _logger = getLogger(__name__)
 
 
+def _round_scores_expr(scores, digits):
+    """
+    Returns an aggregation expression rounding 'score' of each element in the
+    scores expression.  Elements without a numeric 'score' are unchanged.
+    """
+    return {
+        "$map": {
+            "input": scores,
+            "as": "s",
+            "in": {
+                "$cond": [
+                    {
+                        "$in": [
+                            {"$type": "$$s.score"},
+                            ["double", "int", "long", "decimal"],
+                        ]
+                    },
+                    {
+                        "$mergeObjects": [
+                            "$$s",
+                            {"score": {"$round": ["$$s.score", digits]}},
+                        ]
+                    },
+                    "$$s",
+                ]
+            },
+        }
+    }
+
+
+def _round_addition_expr(addition, digits):
+    """
+    Returns an aggregation expression of the addition expression with rounded
+    'scores'.  Additions without a 'scores' array are unchanged.
+    """
+    return {
+        "$cond": [
+            {"$isArray": addition + ".scores"},
+            {
+                "$mergeObjects": [
+                    addition,
+                    {
+                        "scores": _round_scores_expr(
+                            addition + ".scores", digits
+                        )
+                    },
+                ]
+            },
+            addition,
+        ]
+    }
+
+
+def round_score_pipeline(digits=9):
+    """
+    Returns an update pipeline that rounds all scores within 'additions' and
+    within the copies of additions in 'diff_against_previous_label'.
+
+    Parameters:
+        digits (int): number of decimal digits to keep
+    """
+    additions = {
+        "$arrayToObject": {
+            "$map": {
+                "input": {"$objectToArray": "$additions"},
+                "as": "a",
+                "in": {
+                    "k": "$$a.k",
+                    "v": _round_addition_expr("$$a.v", digits),
+                },
+            }
+        }
+    }
+    diff_text = {
+        "$map": {
+            "input": "$$d.text",
+            "as": "t",
+            "in": {
+                "$cond": [
+                    {"$gt": [{"$size": "$$t"}, 3]},
+                    {
+                        "$concatArrays": [
+                            {"$slice": ["$$t", 3]},
+                            [
+                                {
+                                    "$let": {
+                                        "vars": {
+                                            "a": {"$arrayElemAt": ["$$t", 3]}
+                                        },
+                                        "in": _round_addition_expr(
+                                            "$$a", digits
+                                        ),
+                                    }
+                                }
+                            ],
+                        ]
+                    },
+                    "$$t",
+                ]
+            },
+        }
+    }
+    diff_against_previous_label = {
+        "$cond": [
+            {"$isArray": "$diff_against_previous_label"},
+            {
+                "$map": {
+                    "input": "$diff_against_previous_label",
+                    "as": "d",
+                    "in": {"$mergeObjects": ["$$d", {"text": diff_text}]},
+                }
+            },
+            "$diff_against_previous_label",
+        ]
+    }
+    return [
+        {
+            "$set": {
+                "additions": additions,
+                "diff_against_previous_label": diff_against_previous_label,
+            }
+        }
+    ]
+
+
 def round_score(doc, digits=9):
     """
     truncate the score to 9 digits
@@ -10,69 +153,182 @@ def round_score(doc, digits=9):
     Parameters:
         doc (MongoDB document)
     """
-    for addition_key, addition_value in doc["additions"].items():
-        for score_num in range(len(doc["additions"][addition_key]["scores"])):
-            if (
-                "score"
-                in doc["additions"][addition_key]["scores"][score_num].keys()
-            ):
-                doc["additions"][addition_key]["scores"][score_num][
-                    "score"
-                ] = round(
-                    doc["additions"][addition_key]["scores"][score_num][
-                        "score"
-                    ],
-                    digits,
-                )
-
-    for diff_num in range(len(doc["diff_against_previous_label"])):
-        for text_num in range(
-            len(doc["diff_against_previous_label"][diff_num]["text"])
-        ):
-            if (
-                len(
-                    doc["diff_against_previous_label"][diff_num]["text"][
-                        text_num
-                    ]
-                )
-                > 3
-            ):
-                for score_num in range(
-                    len(
-                        doc["diff_against_previous_label"][diff_num]["text"][
-                            text_num
-                        ][3]["scores"]
-                    )
-                ):
-                    doc["diff_against_previous_label"][diff_num]["text"][
-                        text_num
-                    ][3]["scores"][score_num]["score"] = round(
-                        doc["diff_against_previous_label"][diff_num]["text"][
-                            text_num
-                        ][3]["scores"][score_num]["score"],
-                        digits,
-                    )
+
+    def round_addition(addition):
+        for score in addition.get("scores") or []:
+            if "score" in score:
+                score["score"] = round(score["score"], digits)
+
+    for addition in (doc.get("additions") or {}).values():
+        round_addition(addition)
+
+    for diff in doc.get("diff_against_previous_label") or []:
+        for text in diff["text"]:
+            if len(text) > 3:
+                round_addition(text[3])
     return doc
 
 
+def _get_last_id(progress_file):
+    """Returns the last processed _id stored in progress_file, or None."""
+    if progress_file:
+        lines = misc.get_lines_in_file(progress_file)
+        if lines:
+            return ObjectId(lines[-1])
+    return None
+
+
+def _store_last_id(progress_file, last_id):
+    """Stores last_id as the only line of progress_file."""
+    if progress_file:
+        if os.path.exists(progress_file):
+            os.remove(progress_file)
+        misc.append_to_file(progress_file, str(last_id))
+
+
+def _id_batches(label_collection, last_id, batch_size):
+    """
+    Yields lists of label _id with scores, in ascending order, after last_id.
+    """
+    query = {"additions": {"$type": "object"}}
+    if last_id:
+        query["_id"] = {"$gt": last_id}
+    batch = []
+    for doc in label_collection.find(query, {"_id": 1}).sort("_id", 1):
+        batch.append(doc["_id"])
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _truncate_on_server(mongo_client, digits, batch_size, progress_file):
+    """Rounds scores with update pipelines, batch_size labels at a time."""
+    label_collection = mongo_client.label_collection
+    pipeline = round_score_pipeline(digits)
+    total = label_collection.count_documents(
+        {"additions": {"$type": "object"}}
+    )
+    done = 0
+    for batch in _id_batches(
+        label_collection, _get_last_id(progress_file), batch_size
+    ):
+        label_collection.update_many({"_id": {"$in": batch}}, pipeline)
+        _store_last_id(progress_file, batch[-1])
+        done += len(batch)
+        _logger.info(f"Rounded scores of {done} labels (of {total} labels)")
+
+
+def rounded_score_fields(raw_doc, digits=9):
+    """
+    Returns {path: rounded scores} of all 'scores' arrays of a label read as
+    RawBSONDocument, for a $set update.  Only the scores are decoded; the
+    label and its additions are otherwise left as raw BSON.
+
+    Parameters:
+        raw_doc (RawBSONDocument): label with 'additions' and
+                                   'diff_against_previous_label'
+        digits (int): number of decimal digits to keep
+    """
+
+    def rounded(scores):
+        scores = [bson.decode(x.raw) for x in scores]
+        for score in scores:
+            if isinstance(score.get("score"), (int, float)):
+                score["score"] = round(score["score"], digits)
+        return scores
+
+    fields = {}
+    additions = raw_doc.get("additions")
+    if isinstance(additions, RawBSONDocument):
+        for key in additions:
+            scores = additions[key].get("scores")
+            if scores:
+                fields[f"additions.{key}.scores"] = rounded(scores)
+    for i, diff in enumerate(raw_doc.get("diff_against_previous_label") or []):
+        for j, text in enumerate(diff["text"]):
+            if len(text) > 3 and isinstance(text[3], RawBSONDocument):
+                scores = text[3].get("scores")
+                if scores:
+                    fields[
+                        f"diff_against_previous_label.{i}.text.{j}.3.scores"
+                    ] = rounded(scores)
+    return fields
+
+
+def _truncate_in_python(mongo_client, digits, batch_size, progress_file):
+    """
+    Streams labels as RawBSONDocument, decodes only their scores, and writes
+    rounded scores back with bulk writes of batch_size updates.
+    """
+    label_collection = mongo_client.label_collection.with_options(
+        codec_options=CodecOptions(document_class=RawBSONDocument)
+    )
+    last_id = _get_last_id(progress_file)
+    query = {"additions": {"$type": "object"}}
+    if last_id:
+        query["_id"] = {"$gt": last_id}
+    total = label_collection.count_documents(query)
+    cursor = label_collection.find(
+        query,
+        {"additions": 1, "diff_against_previous_label": 1},
+        batch_size=batch_size,
+    ).sort("_id", 1)
+
+    requests = []
+    done = 0
+    processed_id = None
+    for raw_doc in cursor:
+        processed_id = raw_doc["_id"]
+        fields = rounded_score_fields(raw_doc, digits)
+        if fields:
+            requests.append(UpdateOne({"_id": processed_id}, {"$set": fields}))
+        if len(requests) >= batch_size:
+            mongo_client.label_collection.bulk_write(requests, ordered=False)
+            _store_last_id(progress_file, processed_id)
+            done += len(requests)
+            requests = []
+            _logger.info(f"Rounded scores of {done} labels (of {total} labels)")
+    if requests:
+        mongo_client.label_collection.bulk_write(requests, ordered=False)
+        done += len(requests)
+        _logger.info(f"Rounded scores of {done} labels (of {total} labels)")
+    if processed_id:
+        _store_last_id(progress_file, processed_id)
+
+
 def run_truncation(
     mongo_client,
+    progress_file=None,
+    digits=9,
+    batch_size=500,
+    method="server",
 ):
     """
     This method calls other methods in this module.
 
     Parameters:
         mongo_client (object): MongoClient object with database and collections
+        progress_file (Path): location to store the last processed _id; if the
+                              file exists, the run resumes after that _id and
+                              the file is deleted once all labels are rounded
+        digits (int): number of decimal digits to keep
+        batch_size (int): number of labels per update
+        method (String): "server" for update pipelines, falling back to
+                         "python" if unsupported by the server
     """
-    label_collection = mongo_client.label_collection
-    label_collection_name = mongo_client.label_collection_name
-
-    # get all docs in label_collection
-    docs = label_collection.find({})
-
-    # loop through all_label_ids
-    for doc in docs:
-        doc = round_score(doc)
+    if method == "server":
+        try:
+            _truncate_on_server(mongo_client, digits, batch_size, progress_file)
+        except OperationFailure as e:
+            _logger.warning(
+                f"Unable to round scores on the server ({e}).  Rounding scores "
+                "in python instead."
+            )
+            method = "python"
+    if method == "python":
+        _truncate_in_python(mongo_client, digits, batch_size, progress_file)
 
-        # update MongoDB
-        mongo_client.update_db(label_collection_name, [doc])
+    if progress_file and os.path.exists(progress_file):
+        os.remove(progress_file)
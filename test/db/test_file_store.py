@@ -0,0 +1,158 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+import zipfile
+
+from db import file_store
+from export.export_label_collection_as_csv_zip import (
+    ZIP_DATE_TIME,
+    open_csv_entry,
+)
+
+
+class _Cursor:
+    """Cursor of _Bucket.find() supporting sort(), limit() and skip()."""
+
+    def __init__(self, files):
+        self.files = list(files)
+
+    def sort(self, key, direction):
+        self.files.sort(key=lambda x: x[key], reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self.files = self.files[:n]
+        return self
+
+    def skip(self, n):
+        self.files = self.files[n:]
+        return self
+
+    def __iter__(self):
+        return iter([_GridOut(x) for x in self.files])
+
+
+class _GridOut:
+    def __init__(self, stored):
+        self._id = stored["_id"]
+        self.metadata = stored["metadata"]
+        self.data = stored["data"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        return iter([self.data[:3], self.data[3:]])
+
+
+class _Bucket:
+    """In-memory stand-in of gridfs.GridFSBucket."""
+
+    def __init__(self):
+        self.files = []
+
+    def find(self, query):
+        return _Cursor(
+            x for x in self.files if x["filename"] == query["filename"]
+        )
+
+    def upload_from_stream(self, name, source, chunk_size_bytes, metadata):
+        file_id = len(self.files) + 1
+        self.files.append(
+            {
+                "_id": file_id,
+                "filename": name,
+                "uploadDate": file_id,
+                "metadata": metadata,
+                "data": source.read(),
+            }
+        )
+        return file_id
+
+    def delete(self, file_id):
+        self.files = [x for x in self.files if x["_id"] != file_id]
+
+    def open_download_stream_by_name(self, name, revision):
+        versions = [x for x in self.files if x["filename"] == name]
+        return _GridOut(versions[revision])
+
+
+class Test_file_store(unittest.TestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.bucket = _Bucket()
+        patcher = mock.patch.object(
+            file_store.gridfs, "GridFSBucket", return_value=self.bucket
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mongo_client = mock.Mock()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def _write(self, content):
+        file_name = os.path.join(self.folder.name, "db2csv.csv.zip")
+        with open(file_name, "wb") as f:
+            f.write(content)
+        return file_name
+
+    def test_upload_skip_and_prune(self):
+        file_name = self._write(b"v1")
+        self.assertEqual(
+            file_store.upload_file(self.mongo_client, file_name), 1
+        )
+        # unchanged content is not uploaded again
+        self.assertIsNone(file_store.upload_file(self.mongo_client, file_name))
+        for content in [b"v2", b"v3", b"v4"]:
+            file_store.upload_file(
+                self.mongo_client, self._write(content), keep_versions=2
+            )
+        self.assertEqual([x["data"] for x in self.bucket.files], [b"v3", b"v4"])
+
+    def test_download_verifies_sha256(self):
+        file_store.upload_file(self.mongo_client, self._write(b"content"))
+        target = os.path.join(self.folder.name, "out", "db2csv.csv.zip")
+        file_store.download_file(self.mongo_client, "db2csv.csv.zip", target)
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), b"content")
+
+        self.bucket.files[-1]["data"] = b"corrupt"
+        with self.assertRaises(ValueError):
+            file_store.download_file(
+                self.mongo_client, "db2csv.csv.zip", target + ".2"
+            )
+        self.assertFalse(os.path.exists(target + ".2.part"))
+
+    def test_csv_zip_is_reproducible(self):
+        def zip_bytes():
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w") as zip_file:
+                with open_csv_entry(zip_file, "db2csv.csv") as entry:
+                    entry.write(b"NDA,set_id\n")
+            return buffer.getvalue()
+
+        first = zip_bytes()
+        with zipfile.ZipFile(io.BytesIO(first)) as zip_file:
+            self.assertEqual(
+                zip_file.getinfo("db2csv.csv").date_time, ZIP_DATE_TIME
+            )
+        with mock.patch("time.time", return_value=2e9):
+            self.assertEqual(zip_bytes(), first)
+        file_name = self._write(first)
+        file_store.upload_file(self.mongo_client, file_name)
+        self.assertIsNone(
+            file_store.upload_file(self.mongo_client, self._write(zip_bytes()))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
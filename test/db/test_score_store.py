@@ -0,0 +1,91 @@
+import re
+import unittest
+from unittest import mock
+
+from db.score_store import (
+    pack_scores,
+    unpack_scores,
+    expand_diff_additions,
+    delete_scores,
+)
+
+
+class Test_score_store(unittest.TestCase):
+
+    maxDiff = None
+
+    scores = [
+        {
+            "patent_number": "5202128",
+            "claim_number": 6,
+            "parent_claim_numbers": [1, 5],
+            "score": 0.5,
+        },
+        {
+            "patent_number": "5378474",
+            "claim_number": 1,
+            "parent_claim_numbers": [],
+            "score": 0.25,
+        },
+    ]
+
+    def test_pack_and_unpack(self):
+        claim_keys = {}
+        packed_scores, packed_index = pack_scores(self.scores, claim_keys)
+        score_claims = [
+            [x[0], x[1], list(x[2])]
+            for x in sorted(claim_keys, key=claim_keys.get)
+        ]
+        sidecar_doc = {
+            "dtype": "float32",
+            "scores": packed_scores,
+            "claim_index": packed_index,
+        }
+        self.assertEqual(unpack_scores(sidecar_doc, score_claims), self.scores)
+
+    def test_shared_claim_keys(self):
+        claim_keys = {}
+        pack_scores(self.scores, claim_keys, "float16")
+        pack_scores(self.scores[::-1], claim_keys, "float16")
+        self.assertEqual(len(claim_keys), 2)
+
+    def test_unknown_dtype(self):
+        with self.assertRaises(ValueError):
+            pack_scores(self.scores, {}, "float64")
+
+    def test_expand_diff_additions(self):
+        addition = {"expanded_content": "b.", "scores": self.scores}
+        doc = {
+            "additions": {"0": addition},
+            "diff_against_previous_label": [
+                {"name": "1", "text": [[0, "a. "], [1, "b.", "0"]]}
+            ],
+        }
+        expand_diff_additions([doc])
+        self.assertEqual(
+            doc["diff_against_previous_label"][0]["text"],
+            [[0, "a. "], [1, "b.", "0", addition]],
+        )
+
+    def test_delete_scores(self):
+        ids = ["a1/0", "a1/1", "a10/0", "b2/0"]
+
+        def delete_many(query):
+            patterns = [x["_id"]["$regex"] for x in query["$or"]]
+            deleted = [
+                x for x in ids if any(re.match(y, x) for y in patterns)
+            ]
+            for x in deleted:
+                ids.remove(x)
+            return mock.Mock(deleted_count=len(deleted))
+
+        mongo_client = mock.Mock()
+        mongo_client.score_collection.delete_many.side_effect = delete_many
+        # labels switched back to inline storage leave no sidecar documents
+        self.assertEqual(delete_scores(mongo_client, [{"_id": "a1"}]), 2)
+        self.assertEqual(ids, ["a10/0", "b2/0"])
+        self.assertEqual(delete_scores(mongo_client, []), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
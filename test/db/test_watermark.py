@@ -0,0 +1,117 @@
+from datetime import datetime
+import os
+import tempfile
+import unittest
+
+from bson.objectid import ObjectId
+
+from db import watermark
+
+
+def _matches(doc, query):
+    """Returns True if doc matches a query of $gt, $gte, $in or $exists."""
+    for field, condition in query.items():
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, operand in condition.items():
+            if op == "$exists":
+                if (field in doc) != operand:
+                    return False
+            elif value is None:
+                return False
+            elif op == "$gt" and not value > operand:
+                return False
+            elif op == "$gte" and not value >= operand:
+                return False
+            elif op == "$in" and not (
+                set(value if isinstance(value, list) else [value])
+                & set(operand)
+            ):
+                return False
+    return True
+
+
+class _Collection:
+    """In-memory stand-in of the few pymongo queries of db/watermark.py."""
+
+    def __init__(self):
+        self.docs = []
+
+    def find(self, query, projection=None):
+        return [x for x in self.docs if _matches(x, query)]
+
+    def find_one(self, query, projection=None, sort=None):
+        docs = self.find(query)
+        if sort:
+            field, direction = sort[0]
+            docs.sort(key=lambda x: x[field], reverse=direction < 0)
+        return docs[0] if docs else None
+
+    def distinct(self, field, query):
+        values = []
+        for doc in self.find(query):
+            value = doc.get(field)
+            for x in value if isinstance(value, list) else [value]:
+                if x not in values:
+                    values.append(x)
+        return values
+
+
+class _MongoClient:
+    def __init__(self):
+        self.label_collection = _Collection()
+        self.orange_book_collection = _Collection()
+
+
+class Test_watermark(unittest.TestCase):
+
+    maxDiff = None
+
+    def test_first_run_on_empty_collections(self):
+        mongo_client = _MongoClient()
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "watermark.json")
+            # first run: nothing to process, the watermark has no fields
+            watermark.store_watermark(
+                file_name, watermark.current_watermark(mongo_client)
+            )
+            stored = watermark.read_watermark(file_name)
+            self.assertEqual(
+                stored, {"label_id": None, "orange_book_created_at": None}
+            )
+
+            # labels and Orange Book documents inserted after the first run
+            label_id = ObjectId()
+            mongo_client.label_collection.docs.append(
+                {
+                    "_id": label_id,
+                    "nda_group_key": "NDA019501",
+                    "application_numbers": ["NDA019501"],
+                }
+            )
+            mongo_client.orange_book_collection.docs.append(
+                {"nda": 19501, "created_at": datetime(2021, 3, 1)}
+            )
+            self.assertEqual(
+                watermark.changed_label_ids(mongo_client, stored),
+                [str(label_id)],
+            )
+
+            # Orange Book documents are still all new after labels are
+            # processed
+            watermark.store_watermark(
+                file_name,
+                {"label_id": label_id, "orange_book_created_at": None},
+            )
+            stored = watermark.read_watermark(file_name)
+            self.assertEqual(
+                watermark.changed_nda_group_keys(mongo_client, stored),
+                {"NDA019501"},
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
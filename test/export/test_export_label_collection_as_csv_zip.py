@@ -0,0 +1,86 @@
+import io
+import unittest
+
+from export.export_label_collection_as_csv_zip import append_to_csv
+
+
+class Test_export_label_collection_as_csv_zip(unittest.TestCase):
+    maxDiff = None
+
+    def test_append_to_csv_matches_previous_output(self):
+        label = {
+            "_id": "1",
+            "set_id": "s1",
+            "previous_label_published_date": None,
+            "published_date": "2021-01-01",
+            "name": "Drug",
+            "generic_name": "drug",
+            "active_ingredient": "ing",
+            "spl_version": "2",
+            "additions": {"0": {}},
+            "diff_against_previous_label": [
+                {
+                    "name": "1 INDICATIONS, USAGE",
+                    "text": [
+                        [0, "a. "],
+                        [
+                            1,
+                            'Treats  "pain", fever.',
+                            "0",
+                            {
+                                "expanded_content": "Treats pain, fever\nand",
+                                "scores": [
+                                    {
+                                        "patent_number": "5202128",
+                                        "claim_number": 6,
+                                        "parent_claim_numbers": [1, 5],
+                                        "score": 0.1234567891234,
+                                    },
+                                    {
+                                        "patent_number": "RE44186",
+                                        "claim_number": 1,
+                                        "parent_claim_numbers": [],
+                                        "score": 0.5,
+                                    },
+                                ],
+                            },
+                        ],
+                        [
+                            1,
+                            "Dose",
+                            "1",
+                            {
+                                "expanded_content": "Dose",
+                                "scores": [
+                                    {
+                                        "patent_number": "5202128",
+                                        "claim_number": 1,
+                                        "parent_claim_numbers": [],
+                                        "score": 0.25,
+                                    },
+                                ],
+                            },
+                        ],
+                    ],
+                },
+                {"name": "2", "text": []},
+            ],
+        }
+        csv_file = io.StringIO()
+        self.assertEqual(append_to_csv(csv_file, "NDA1;NDA2", [label]), 3)
+        # output of the export before rows were written with csv.writer
+        self.assertEqual(
+            csv_file.getvalue(),
+            "NDA1;NDA2,s1,,2021-01-01,Drug,drug,ing,"
+            "\"1 INDICATIONS, USAGE\",\"Treats 'pain', fever.\","
+            '"Treats pain, fever and",5202128,6,1;5,0.123456789\n'
+            "NDA1;NDA2,s1,,2021-01-01,Drug,drug,ing,"
+            "\"1 INDICATIONS, USAGE\",\"Treats 'pain', fever.\","
+            '"Treats pain, fever and",RE44186,1,,0.5\n'
+            "NDA1;NDA2,s1,,2021-01-01,Drug,drug,ing,"
+            '"1 INDICATIONS, USAGE","Dose","Dose",5202128,1,,0.25\n',
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
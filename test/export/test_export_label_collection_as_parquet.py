@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+from export.export_label_collection_as_parquet import (
+    _PartitionWriter,
+    table_rows,
+)
+
+
+def _label(label_id, published_date, score):
+    return {
+        "_id": label_id,
+        "set_id": "7b5489a1-e30f-450f-bd2b-00d05fd52915",
+        "spl_id": "a",
+        "spl_version": 3,
+        "published_date": published_date,
+        "previous_label_published_date": None,
+        "name": "Drug",
+        "generic_name": "drug",
+        "active_ingredient": "DRUG",
+        "diff_against_previous_label": [
+            {"name": "Indications", "text": [[0, "Same "], [1, "new", "0"]]}
+        ],
+        "additions": {
+            "0": {
+                "expanded_content": "Same new.",
+                "scores": [
+                    {
+                        "patent_number": "4978532",
+                        "claim_number": 2,
+                        "parent_claim_numbers": [1],
+                        "score": score,
+                    }
+                ],
+            }
+        },
+    }
+
+
+@unittest.skipUnless(pq, "pyarrow is an optional dependency")
+class Test_export_label_collection_as_parquet(unittest.TestCase):
+
+    maxDiff = None
+
+    def test_table_rows(self):
+        seen_claims = set()
+        rows = table_rows([_label("1", "2020-01-01", 0.5)], seen_claims)
+        self.assertEqual(rows["labels"]["spl_version"], ["3"])
+        self.assertEqual(rows["additions"]["section_name"], ["Indications"])
+        self.assertEqual(rows["scores"]["score"], [0.5])
+        self.assertEqual(rows["claims"]["parent_claim_numbers"], [[1]])
+
+        # claims are exported once per NDA group
+        rows = table_rows([_label("2", "2021-01-01", 0.25)], seen_claims)
+        self.assertEqual(rows["scores"]["label_id"], ["2"])
+        self.assertEqual(rows["claims"]["patent_number"], [])
+
+    def test_table_rows_of_addition_in_several_diffs(self):
+        label = _label("1", "2020-01-01", 0.5)
+        label["diff_against_previous_label"] = [
+            {
+                "name": "Indications",
+                "text": [[1, "new ", "0"], [0, "Same "], [1, "text", "0"]],
+            },
+            {"name": "Dosage", "text": [[1, "more", "0"]]},
+        ]
+        rows = table_rows([label])
+        self.assertEqual(rows["additions"]["addition_key"], ["0"])
+        self.assertEqual(rows["additions"]["section_name"], ["Indications"])
+        self.assertEqual(rows["additions"]["addition"], ["new textmore"])
+        self.assertEqual(rows["scores"]["score"], [0.5])
+
+    def test_partition_writer(self):
+        with tempfile.TemporaryDirectory() as folder:
+            writer = _PartitionWriter(folder, "NDA019501")
+            seen_claims = set()
+            for label in [
+                _label("1", "2020-01-01", 0.5),
+                _label("2", "2021-01-01", 0.25),
+            ]:
+                writer.write(table_rows([label], seen_claims))
+            writer.close()
+            self.assertEqual(
+                writer.counts,
+                {"labels": 2, "additions": 2, "claims": 1, "scores": 2},
+            )
+            scores = pq.read_table(
+                os.path.join(folder, "scores", "nda=NDA019501"),
+                columns=["label_id", "score"],
+            ).to_pydict()
+            self.assertEqual(scores["label_id"], ["1", "2"])
+            self.assertEqual(scores["score"], [0.5, 0.25])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import os
+import tarfile
+import tempfile
+import time
+import unittest
+
+from db.score_store import expand_diff_additions
+from export.get_files_from_db import _ArchiveWriter, label_artifacts
+
+
+class Test_get_files_from_db(unittest.TestCase):
+    maxDiff = None
+
+    def test_label_artifacts_of_reference_additions(self):
+        scores = [
+            {
+                "patent_number": "5202128",
+                "claim_number": 6,
+                "parent_claim_numbers": [1, 5],
+                "score": 0.5,
+            }
+        ]
+        label = {
+            "_id": "1",
+            "set_id": "s",
+            "published_date": "2020-01-01",
+            "score_claims": [["5202128", 6, [1, 5]]],
+            "additions": {
+                "0": {
+                    "expanded_content": "b.",
+                    "scores": scores,
+                    "scores_ref": "1/0",
+                }
+            },
+            "diff_against_previous_label": [
+                {"name": "1", "text": [[0, "a. "], [1, "b.", "0"]]}
+            ],
+        }
+        artifacts = {
+            str(path): content
+            for path, content in label_artifacts(expand_diff_additions([label]))
+        }
+        full_json = json.loads(artifacts["s/full_json/2020-01-01.json"])
+        self.assertNotIn("score_claims", full_json)
+        self.assertEqual(
+            full_json["additions"], {"0": {"expanded_content": "b."}}
+        )
+        # copies of additions within the diff keep their scores
+        self.assertEqual(
+            full_json["diff_against_previous_label"][0]["text"][1][3][
+                "scores"
+            ],
+            scores,
+        )
+
+    def test_tar_members_are_dated(self):
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.time()
+            writer = _ArchiveWriter(os.path.join(folder, "NDA1"), "tar")
+            writer.write([("s/full_json/2020-01-01.json", b"{}")])
+            writer.close()
+            with tarfile.open(os.path.join(folder, "NDA1.tar.gz")) as tar:
+                member = tar.getmember("NDA1/s/full_json/2020-01-01.json")
+            self.assertGreaterEqual(member.mtime, int(start))
+
+    def test_no_archive_without_artifacts(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for archive in ["tar", "zip"]:
+                writer = _ArchiveWriter(os.path.join(folder, "NDA1"), archive)
+                writer.write([])
+                writer.close()
+            self.assertEqual(os.listdir(folder), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -81,7 +81,7 @@ class Test_merge_without_orangebook_collection(unittest.TestCase):
         self.assertTrue(self.ob.get_patents("22315"))
 
     def test_get_all_nda_past_date(self):
-        OrangeBookMap._orange_book_sort_by_date_df = None
+        OrangeBookMap._dates = None
         date_time_obj = datetime.datetime.strptime("2021-01-01", "%Y-%m-%d")
         # print(str(self.ob.get_all_nda_past_date(date_time_obj))[:50])
         self.assertFalse(self.ob.get_all_nda_past_date(date_time_obj))
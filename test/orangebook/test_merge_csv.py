@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from orangebook import merge
+
+
+class Test_merge_csv(unittest.TestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        # csv files are found relative to the working directory
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        self.patent_file = "resources/Orange_Book/2021_03/patent.txt"
+        self._write("Appl_No~Patent_No\n019501~4978532*PED\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def _write(self, content, mtime_ns=None):
+        os.makedirs(os.path.dirname(self.patent_file), exist_ok=True)
+        with open(self.patent_file, "w") as f:
+            f.write(content)
+        if mtime_ns is not None:
+            os.utime(self.patent_file, ns=(mtime_ns, mtime_ns))
+
+    def test_csv_modified_in_place(self):
+        self._write("Appl_No~Patent_No\n019501~4978532*PED\n", 10**18)
+        source_key = merge._source_key(0, None)
+        self.assertEqual(
+            merge._merge_all_csv().values.tolist(), [[19501, "4978532"]]
+        )
+
+        # a month re-extracted in place makes the cache and snapshot stale
+        self._write("Appl_No~Patent_No\n020616~5202128\n", 2 * 10**18)
+        self.assertNotEqual(merge._source_key(0, None), source_key)
+        self.assertEqual(
+            merge._merge_all_csv().values.tolist(), [[20616, "5202128"]]
+        )
+
+    def test_missing_nber_csv_file_is_logged(self):
+        with self.assertLogs(merge._logger, "WARNING") as logs:
+            self.assertEqual(merge._csv_files(), [self.patent_file])
+        self.assertIn(merge.NBER_CSV_FILE, logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,4 @@
+import torch
 import unittest
 from diff.run_diff import run_diff
 from similarity import run_similarity as r
@@ -59,5 +60,71 @@ class Test_run_similarity(unittest.TestCase):
         self.assertIn("patents", label["nda_to_patent"][0])
 
 
+class Test_split_into_windows(unittest.TestCase):
+    def test_short_text(self):
+        self.assertEqual(r.split_into_windows((1, 2, 3), 5, 2), [(1, 2, 3)])
+
+    def test_overlapping_windows(self):
+        self.assertEqual(
+            r.split_into_windows(range(1, 8), 4, 2),
+            [(1, 2, 3, 4), (3, 4, 5, 6), (5, 6, 7)],
+        )
+
+    def test_last_window_ends_at_last_token(self):
+        self.assertEqual(
+            r.split_into_windows((1, 2, 3, 4, 5), 3, 1),
+            [(1, 2, 3), (3, 4, 5)],
+        )
+
+    def test_invalid_overlap(self):
+        with self.assertRaises(ValueError):
+            r.split_into_windows((1, 2, 3), 3, 3)
+
+
+class Test_retention(unittest.TestCase):
+
+    scores = torch.tensor([[0.9, 0.1, 0.5, 0.7], [0.2, 0.8, 0.3, 0.4]])
+    patents = ["1", "1", "2", "2"]
+
+    def test_keep_all(self):
+        keep = r.retention_mask(self.scores, self.patents)
+        self.assertTrue(keep.all())
+        self.assertEqual(r.discarded_summary(self.scores, keep), [None, None])
+
+    def test_num_scores(self):
+        keep = r.retention_mask(self.scores, self.patents, num_scores=2)
+        self.assertEqual(
+            keep.tolist(),
+            [[True, False, False, True], [False, True, False, True]],
+        )
+
+    def test_min_score(self):
+        keep = r.retention_mask(self.scores, self.patents, min_score=0.5)
+        self.assertEqual(
+            keep.tolist(),
+            [[True, False, True, True], [False, True, False, False]],
+        )
+
+    def test_percentile(self):
+        keep = r.retention_mask(self.scores, self.patents, percentile=75)
+        self.assertEqual(keep.sum().item(), 3)
+
+    def test_best_claim_per_patent(self):
+        keep = r.retention_mask(
+            self.scores, self.patents, best_claim_per_patent=True
+        )
+        self.assertEqual(
+            keep.tolist(),
+            [[True, False, False, True], [False, True, False, True]],
+        )
+
+    def test_discarded_summary(self):
+        keep = r.retention_mask(self.scores, self.patents, num_scores=3)
+        summary = r.discarded_summary(self.scores, keep)
+        self.assertEqual(summary[0]["count"], 1)
+        self.assertAlmostEqual(summary[0]["max"], 0.1, places=6)
+        self.assertAlmostEqual(summary[1]["mean"], 0.2, places=6)
+
+
 if __name__ == "__main__":
     unittest.main()
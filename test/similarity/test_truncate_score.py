@@ -0,0 +1,61 @@
+import bson
+from bson.raw_bson import RawBSONDocument
+import unittest
+
+from similarity.truncate_score import rounded_score_fields
+
+
+def _raw(doc):
+    return RawBSONDocument(bson.encode(doc))
+
+
+class Test_truncate_score(unittest.TestCase):
+    maxDiff = None
+
+    def test_rounded_score_fields(self):
+        addition = {
+            "expanded_content": "b.",
+            "scores": [
+                {"patent_number": "1", "score": 0.123456789123},
+                {"patent_number": "2"},
+            ],
+        }
+        raw_doc = _raw(
+            {
+                "_id": 1,
+                "additions": {"0": addition, "1": {"expanded_content": "c."}},
+                "diff_against_previous_label": [
+                    {
+                        "name": "1",
+                        "text": [[0, "a. "], [1, "b.", "0", addition]],
+                    }
+                ],
+            }
+        )
+        rounded = [
+            {"patent_number": "1", "score": 0.1235},
+            {"patent_number": "2"},
+        ]
+        self.assertEqual(
+            rounded_score_fields(raw_doc, 4),
+            {
+                "additions.0.scores": rounded,
+                "diff_against_previous_label.0.text.1.3.scores": rounded,
+            },
+        )
+
+    def test_label_without_scores(self):
+        raw_doc = _raw(
+            {
+                "_id": 1,
+                "additions": {"0": {"expanded_content": "b.", "scores": []}},
+                "diff_against_previous_label": [
+                    {"name": "1", "text": [[1, "b.", "0"]]}
+                ],
+            }
+        )
+        self.assertEqual(rounded_score_fields(raw_doc), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import http.client
+import json
+import threading
+import time
+import unittest
+
+from bson.objectid import ObjectId
+
+from api_server import (
+    BadRequest,
+    ResponseCache,
+    _diff_cursor,
+    _int_param,
+    make_server,
+)
+
+LABEL_ID = "60a7c3f5e4b0a1b2c3d4e5f6"
+
+
+class Test_api_server(unittest.TestCase):
+
+    maxDiff = None
+
+    def test_response_cache(self):
+        cache = ResponseCache(capacity=2, ttl=60)
+        cache.put("a", b"1")
+        cache.put("b", b"2")
+        self.assertEqual(cache.get("a"), b"1")
+        # 'b' is the least recently used entry
+        cache.put("c", b"3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"3")
+
+        cache = ResponseCache(capacity=2, ttl=0)
+        cache.put("a", b"1")
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("a"))
+
+    def test_int_param(self):
+        self.assertEqual(_int_param({}, "k", 10, 100), 10)
+        self.assertEqual(_int_param({"k": ["1000"]}, "k", 10, 100), 100)
+        with self.assertRaises(BadRequest):
+            _int_param({"k": ["x"]}, "k", 10, 100)
+        with self.assertRaises(BadRequest):
+            _int_param({"k": ["0"]}, "k", 10, 100)
+
+    def test_diff_cursor(self):
+        self.assertEqual(
+            _diff_cursor(f"2021-01-01|{LABEL_ID}"),
+            ("2021-01-01", ObjectId(LABEL_ID)),
+        )
+        with self.assertRaises(BadRequest):
+            _diff_cursor("2021-01-01")
+        with self.assertRaises(BadRequest):
+            _diff_cursor("2021-01-01|x")
+
+    def test_errors(self):
+        server = make_server(None, "127.0.0.1", 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for path, status in [
+                ("/api/unknown", 404),
+                ("/api/labels/1/additions/0/claims?k=x", 400),
+                ("/api/patents/4978532/additions?min_score=x", 400),
+                ("/api/set_ids/s/diffs?cursor=2021-01-01", 400),
+                (f"/api/labels/{LABEL_ID}/additions/a.b/claims", 400),
+                (f"/api/labels/{LABEL_ID}/additions/$x/claims", 400),
+                # errors of MongoDB (here, no client) are answered with 500
+                (f"/api/labels/{LABEL_ID}/additions/0/claims", 500),
+            ]:
+                connection = http.client.HTTPConnection(
+                    "127.0.0.1", server.server_port
+                )
+                connection.request("GET", path)
+                response = connection.getresponse()
+                self.assertEqual(response.status, status)
+                # errors are not cached by clients
+                self.assertEqual(
+                    response.getheader("Cache-Control"), "no-store"
+                )
+                self.assertIn("error", json.loads(response.read()))
+                connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
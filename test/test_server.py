@@ -0,0 +1,88 @@
+import http.client
+import os
+import tempfile
+import threading
+import unittest
+
+from server import make_server, parse_range
+
+
+class Test_server(unittest.TestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.content = bytes(range(256)) * 1000
+        with open(os.path.join(self.folder.name, "db2csv.csv.zip"), "wb") as f:
+            f.write(self.content)
+        self.server = make_server(self.folder.name, "127.0.0.1", 0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.folder.cleanup()
+
+    def request(self, headers=None, method="GET"):
+        connection = http.client.HTTPConnection(
+            "127.0.0.1", self.server.server_port
+        )
+        connection.request(method, "/db2csv.csv.zip", headers=headers or {})
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response, body
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=0-1000", 100), (0, 99))
+        self.assertIsNone(parse_range("bytes=0-1,5-6", 100))
+        self.assertIsNone(parse_range(None, 100))
+        with self.assertRaises(ValueError):
+            parse_range("bytes=100-", 100)
+        with self.assertRaises(ValueError):
+            parse_range("bytes=-0", 100)
+
+    def test_get(self):
+        response, body = self.request()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self.content)
+        self.assertEqual(response.getheader("Accept-Ranges"), "bytes")
+
+    def test_range(self):
+        response, body = self.request({"Range": "bytes=1000-1999"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, self.content[1000:2000])
+        self.assertEqual(
+            response.getheader("Content-Range"),
+            f"bytes 1000-1999/{len(self.content)}",
+        )
+
+        response, body = self.request({"Range": f"bytes={len(self.content)}-"})
+        self.assertEqual(response.status, 416)
+
+    def test_conditional(self):
+        response, _ = self.request(method="HEAD")
+        etag = response.getheader("ETag")
+        last_modified = response.getheader("Last-Modified")
+
+        response, body = self.request({"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(body, b"")
+
+        response, _ = self.request({"If-Modified-Since": last_modified})
+        self.assertEqual(response.status, 304)
+
+        # stale If-Range returns the full file
+        response, body = self.request(
+            {"Range": "bytes=0-9", "If-Range": '"stale"'}
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self.content)
+
+
+if __name__ == "__main__":
+    unittest.main()
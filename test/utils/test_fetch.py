@@ -0,0 +1,141 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import os
+import tempfile
+import threading
+import unittest
+import zipfile
+
+from utils import fetch
+
+
+def _zip_bytes():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as f:
+        f.writestr("patent.txt", "Appl_No~Patent_No\n019501~4978532\n" * 100)
+        f.writestr("exclusivity.txt", "Appl_No~Exclusivity_Code\n")
+        f.writestr("products.txt", "Appl_No~Trade_Name\n")
+    return buffer.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serves the Orange Book zip with ETag and Range support."""
+
+    content = _zip_bytes()
+    etag = '"v1"'
+    requests = []
+    # number of bytes to send before dropping the connection
+    cut_at = None
+    # if set, Range requests are answered from this many bytes further
+    range_shift = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        _Handler.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get("Range") and (
+            self.headers.get("If-Range") == self.etag
+        ):
+            start = int(self.headers["Range"][len("bytes=") : -1])
+            start += _Handler.range_shift
+        body = self.content[start:]
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", self.etag)
+        self.send_header(
+            "Content-Disposition", "attachment; filename=EOBZIP_2021_03.zip"
+        )
+        self.send_header("Content-Length", str(len(body)))
+        if start:
+            self.send_header(
+                "Content-Range",
+                f"bytes {start}-{len(self.content) - 1}/{len(self.content)}",
+            )
+        self.end_headers()
+        if _Handler.cut_at is not None:
+            body = body[: _Handler.cut_at]
+            _Handler.cut_at = None
+        self.wfile.write(body)
+
+
+class Test_fetch(unittest.TestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        _Handler.requests = []
+        _Handler.cut_at = None
+        _Handler.range_shift = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/download"
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.folder.cleanup()
+
+    def test_conditional_download(self):
+        sha256 = hashlib.sha256(_Handler.content).hexdigest()
+        file_path = fetch.download(self.url, self.folder.name, sha256)
+        self.assertEqual(os.path.basename(file_path), "EOBZIP_2021_03.zip")
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), _Handler.content)
+
+        # unchanged file is not downloaded again
+        self.assertIsNone(fetch.download(self.url, self.folder.name))
+        self.assertEqual(_Handler.requests[-1]["If-None-Match"], '"v1"')
+
+    def test_resume_download(self):
+        _Handler.cut_at = 100
+        with self.assertRaises(Exception):
+            fetch.download(self.url, self.folder.name, chunk_size=10)
+
+        file_path = fetch.download(self.url, self.folder.name)
+        self.assertEqual(_Handler.requests[-1]["Range"], "bytes=100-")
+        self.assertEqual(
+            [x["Accept-Encoding"] for x in _Handler.requests],
+            ["identity", "identity"],
+        )
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), _Handler.content)
+
+    def test_partial_response_not_continuing_part_file(self):
+        _Handler.cut_at = 100
+        with self.assertRaises(Exception):
+            fetch.download(self.url, self.folder.name, chunk_size=10)
+
+        # the partial response starts at byte 110 instead of 100; the part
+        # file is discarded and the whole file is requested again
+        _Handler.range_shift = 10
+        file_path = fetch.download(self.url, self.folder.name)
+        self.assertEqual(_Handler.requests[-2]["Range"], "bytes=100-")
+        self.assertNotIn("Range", _Handler.requests[-1])
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), _Handler.content)
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(ValueError):
+            fetch.download(self.url, self.folder.name, "0" * 64)
+
+    def test_extract_members(self):
+        file_path = fetch.download(self.url, self.folder.name)
+        fetch.extract_and_clean(file_path, ["patent.txt", "exclusivity.txt"])
+        self.assertEqual(
+            sorted(
+                os.listdir(os.path.join(self.folder.name, "EOBZIP_2021_03"))
+            ),
+            ["exclusivity.txt", "patent.txt"],
+        )
+        self.assertFalse(os.path.exists(file_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import tracemalloc
+import unittest
+from unittest import mock
+
+from utils import memory, metrics
+
+
+class Test_memory(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        memory.disable()
+
+    def test_rss_over_budget(self):
+        memory.enable("rss", budget_mb=1)
+        with metrics.group("diff", "NDA1"):
+            metrics.add_sizes(labels=2, additions=3)
+            metrics.add_sizes(labels=1)
+        run_report = metrics.report()
+        group = run_report["slowest_groups"]["diff"][0]
+        self.assertEqual(group["sizes"], {"labels": 3, "additions": 3})
+        self.assertGreater(group["memory"]["rss_peak_mb"], 1)
+        self.assertTrue(group["memory"]["over_budget"])
+        self.assertEqual(
+            [x["key"] for x in run_report["over_budget_groups"]["diff"]],
+            ["NDA1"],
+        )
+
+    def test_tracemalloc_peak_of_group(self):
+        memory.enable("tracemalloc", budget_mb=1e6)
+        with metrics.group("similarity", "NDA1"):
+            data = bytearray(8 << 20)
+            del data
+        group = metrics.report()["slowest_groups"]["similarity"][0]
+        self.assertGreaterEqual(group["memory"]["traced_peak_mb"], 8)
+        self.assertFalse(group["memory"]["over_budget"])
+        self.assertNotIn("top_allocations", group["memory"])
+        self.assertEqual(metrics.report()["over_budget_groups"], {})
+
+    def test_tracemalloc_peak_without_reset_peak(self):
+        # tracemalloc.reset_peak() is not available before Python 3.9
+        memory.enable("tracemalloc", budget_mb=1e6)
+        with mock.patch.object(tracemalloc, "reset_peak", None, create=True):
+            with metrics.group("similarity", "NDA1"):
+                data = bytearray(8 << 20)
+                del data
+        group = metrics.report()["slowest_groups"]["similarity"][0]
+        self.assertGreaterEqual(group["memory"]["traced_peak_mb"], 8)
+        self.assertTrue(tracemalloc.is_tracing())
+
+    def test_tracing_started_by_others(self):
+        tracemalloc.start()
+        try:
+            memory.enable("tracemalloc")
+            memory.disable()
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+    def test_tracemalloc_top_allocations(self):
+        memory.enable("tracemalloc", budget_mb=1e-3)
+        with metrics.group("similarity", "NDA1"):
+            data = [bytearray(1 << 10) for _ in range(100)]
+        group = metrics.report()["slowest_groups"]["similarity"][0]
+        self.assertTrue(group["memory"]["over_budget"])
+        self.assertTrue(
+            any(
+                "test_memory.py" in x["site"]
+                for x in group["memory"]["top_allocations"]
+            )
+        )
+        del data
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+import unittest
+
+from utils import metrics
+
+
+class Test_metrics(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_group_stages_and_report(self):
+        for key, docs in [("NDA1", 2), ("NDA2", 5)]:
+            with metrics.group("diff", key):
+                for set_id_group in metrics.timed_iter(
+                    [[{}] * docs, [{}]], "diff.mongo_read"
+                ):
+                    with metrics.timer("diff.get_diff", len(set_id_group)):
+                        pass
+        metrics.count("labels", 3)
+
+        run_report = metrics.report(slowest=1)
+        self.assertEqual(run_report["counters"], {"labels": 3})
+        self.assertEqual(run_report["groups"], {"diff": 2})
+        self.assertEqual(len(run_report["slowest_groups"]["diff"]), 1)
+        get_diff = run_report["stages"]["diff.get_diff"]
+        self.assertEqual(get_diff["calls"], 4)
+        self.assertEqual(get_diff["docs"], 9)
+        self.assertLessEqual(get_diff["p50"], get_diff["p95"])
+        self.assertLessEqual(get_diff["p95"], get_diff["max"])
+        # 2 set_id groups and the end of the cursor per NDA group
+        self.assertEqual(run_report["stages"]["diff.mongo_read"]["calls"], 6)
+        self.assertEqual(run_report["stages"]["diff.group"]["calls"], 2)
+        group = run_report["slowest_groups"]["diff"][0]
+        self.assertEqual(
+            set(group["stages"]), {"diff.mongo_read", "diff.get_diff"}
+        )
+
+    def test_timer_outside_group_and_on_error(self):
+        with self.assertRaises(ValueError):
+            with metrics.timer("similarity.encoding", 4):
+                raise ValueError()
+        run_report = metrics.report()
+        self.assertEqual(run_report["stages"]["similarity.encoding"]["docs"], 4)
+        self.assertEqual(run_report["slowest_groups"], {})
+
+    def test_write_report_and_prometheus(self):
+        with metrics.group("csv", "NDA1"):
+            with metrics.timer("csv.write", 10):
+                pass
+        with tempfile.TemporaryDirectory() as folder:
+            report_file = os.path.join(folder, "log", "run_report.json")
+            metrics.write_report(report_file)
+            with open(report_file) as f:
+                self.assertIn("csv.write", json.load(f)["stages"])
+
+            prom_file = os.path.join(folder, "metrics.prom")
+            metrics.write_prometheus(prom_file)
+            with open(prom_file) as f:
+                lines = f.read().splitlines()
+            self.assertIn(
+                'scoring_data_processor_stage_docs_total{stage="csv.write"} 10',
+                lines,
+            )
+            self.assertIn(
+                'scoring_data_processor_stage_seconds_count{stage="csv.write"}'
+                " 1",
+                lines,
+            )
+            self.assertFalse(os.path.exists(prom_file + ".tmp"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,5 @@
 import unittest
-from utils.misc import reorg_list_dict
+from utils.misc import reorg_list_dict, nda_group_key
 
 
 class Test_utils_misc(unittest.TestCase):
@@ -16,6 +16,13 @@ class Test_utils_misc(unittest.TestCase):
 
         self.assertEqual(reorg_list_dict(a, "claim", "text"), b)
 
+    def test_nda_group_key(self):
+        self.assertEqual(
+            nda_group_key(["NDA020616", "NDA019501"]),
+            nda_group_key(["NDA019501", "NDA020616", "NDA019501"]),
+        )
+        self.assertEqual(nda_group_key(["NDA020616"]), "NDA020616")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from utils import metrics, profiling
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class Test_profiling(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        metrics.reset()
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        profiling.disable()
+        self.folder.cleanup()
+
+    def test_cprofile_stage(self):
+        profiling.enable("cprofile", self.folder.name)
+        for _ in range(2):
+            with profiling.stage("diff"):
+                _busy(0.01)
+        profiling.write_profiles()
+        self.assertEqual(
+            sorted(os.listdir(self.folder.name)),
+            ["diff.callers.collapsed", "diff.pstats"],
+        )
+        with open(
+            os.path.join(self.folder.name, "diff.callers.collapsed")
+        ) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(
+            any("test_profiling.py:_busy" in line for line in lines)
+        )
+        for line in lines:
+            self.assertTrue(line.rsplit(" ", 1)[1].isdigit())
+
+    def test_sampling_slowest_groups(self):
+        profiling.enable("sampling", self.folder.name, groups=1)
+        # stages are not profiled when profiling groups
+        with profiling.stage("diff"):
+            pass
+        for key, seconds in [("NDA1", 0.02), ("NDA2;NDA3", 0.1)]:
+            with metrics.group("diff", key):
+                _busy(seconds)
+        profiling.write_profiles()
+        self.assertEqual(
+            os.listdir(self.folder.name), ["diff-NDA2_NDA3.collapsed"]
+        )
+        with open(
+            os.path.join(self.folder.name, "diff-NDA2_NDA3.collapsed")
+        ) as f:
+            self.assertIn("test_profiling.py:_busy", f.read())
+
+    def test_groups_of_previous_run_report(self):
+        report_file = os.path.join(self.folder.name, "run_report.json")
+        with open(report_file, "w") as f:
+            json.dump(
+                {
+                    "slowest_groups": {
+                        "diff": [{"key": "NDA1"}, {"key": "NDA2"}]
+                    }
+                },
+                f,
+            )
+        profile_folder = os.path.join(self.folder.name, "profile")
+        profiling.enable("cprofile", profile_folder, 1, report_file)
+        for key in ["NDA1", "NDA2"]:
+            with metrics.group("diff", key):
+                pass
+        profiling.write_profiles()
+        self.assertEqual(
+            sorted(os.listdir(profile_folder)),
+            ["diff-NDA1.callers.collapsed", "diff-NDA1.pstats"],
+        )
+
+    def test_cprofile_groups_without_run_report(self):
+        # all groups would run under cProfile; sampling is used instead
+        profiling.enable("cprofile", self.folder.name, groups=1)
+        with metrics.group("diff", "NDA1"):
+            _busy(0.02)
+        profiling.write_profiles()
+        self.assertEqual(os.listdir(self.folder.name), ["diff-NDA1.collapsed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,29 @@
 """
 This module provides methods to download and extract large files.
+
+Downloads are conditional and resumable.  The ETag, Last-Modified and sha256
+of the last download of each URL are kept in a state file within the download
+folder:
+
+    {
+        'https://...': {
+            'file_name': 'EOBZIP_2021_03.zip',
+            'etag': '"abc"',
+            'last_modified': 'Tue, 02 Mar 2021 15:00:00 GMT',
+            'sha256': '...',
+            'complete': True,
+        },
+    }
+
+If the last download completed, the next request is a conditional GET and an
+unchanged file is not downloaded again.  If it was interrupted, the next
+request resumes the partial '.part' file with a Range request.
 """
 
+import hashlib
+import json
 import requests
+import shutil
 import tarfile
 import zipfile
 import os
@@ -13,67 +34,268 @@ from utils.logging import getLogger
 
 _logger = getLogger(__name__)
 
+CHUNK_SIZE = 1 << 20
+
+STATE_FILE = ".download_state.json"
+
+
+def _read_state(state_file):
+    """Returns the dict stored in state_file, or {} if it does not exist."""
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, "r") as f:
+        return json.load(f)
+
+
+def _store_state(state_file, url, url_state):
+    """Stores url_state of url to state_file."""
+    state = _read_state(state_file)
+    state[url] = url_state
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_file + ".tmp", state_file)
+
 
-def download(url, folder_location):
+def _file_name(response, url):
+    """Returns the file name of response from Content-Disposition or url."""
+    if "Content-Disposition" in response.headers.keys():
+        return (
+            response.headers["Content-Disposition"]
+            .split("filename=")[1]
+            .split(";")[0]
+            .strip('"')
+        )
+    return os.path.basename(urlparse(url).path)
+
+
+def _hash_file(file_path, chunk_size=CHUNK_SIZE):
+    """Returns the sha256 object of the content of file_path."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for data in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(data)
+    return sha256
+
+
+def _content_range_start(response):
     """
-    Downloads URL to folder_location
+    Returns the first byte position of the Content-Range header of response,
+    or None if it is missing or invalid.
     """
-    response = requests.get(url, stream=True, allow_redirects=True)
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        unit, spec = content_range.split(" ", 1)
+        if unit != "bytes":
+            return None
+        return int(spec.split("-", 1)[0])
+    except ValueError:
+        return None
 
-    if "Content-Disposition" in response.headers.keys():
-        file_name = response.headers["Content-Disposition"].split("filename=")[1]
-    else:
-        file_name = os.path.basename(urlparse(url).path)
 
-    file_path = os.path.join(folder_location, file_name)
+def _request_headers(url_state, part_path):
+    """
+    Returns the request headers for a Range request resuming part_path, or a
+    conditional GET if the last download completed.  The file is requested
+    without Content-Encoding (such as gzip), so the streamed bytes are the
+    bytes of the file that Content-Length, Range offsets and sha256 refer to.
+    """
+    headers = {"Accept-Encoding": "identity"}
+    validator = url_state.get("etag") or url_state.get("last_modified")
+    if (
+        not url_state.get("complete")
+        and validator
+        and part_path
+        and os.path.exists(part_path)
+        and os.path.getsize(part_path) > 0
+    ):
+        headers["Range"] = f"bytes={os.path.getsize(part_path)}-"
+        headers["If-Range"] = validator
+        return headers
+    if url_state.get("complete"):
+        if url_state.get("etag"):
+            headers["If-None-Match"] = url_state["etag"]
+        if url_state.get("last_modified"):
+            headers["If-Modified-Since"] = url_state["last_modified"]
+    return headers
+
+
+def download(url, folder_location, sha256=None, chunk_size=CHUNK_SIZE):
+    """
+    Downloads URL to folder_location.  Returns the path of the downloaded
+    file, or None if the file is unchanged since the last download.
+
+    Parameters:
+        url (String): URL to download
+        folder_location (Path): folder to download into
+        sha256 (String): optional expected sha256 hex digest of the file
+        chunk_size (int): number of bytes streamed per write
+    """
     if not os.path.exists(folder_location):
         os.makedirs(folder_location)
+    state_file = os.path.join(folder_location, STATE_FILE)
+    url_state = _read_state(state_file).get(url, {})
+    part_path = None
+    if url_state.get("file_name"):
+        part_path = os.path.join(
+            folder_location, url_state["file_name"] + ".part"
+        )
+    headers = _request_headers(url_state, part_path)
 
-    # referenced https://stackoverflow.com/questions/15644964/python-progress-bar-and-downloads to create a download bar
-    with open(file_path, "wb") as f:
-        _logger.info("Downloading %s" % file_name)
+    with requests.get(
+        url, headers=headers, stream=True, allow_redirects=True, timeout=60
+    ) as response:
+        if response.status_code == 304:
+            _logger.info(f"{url} is not modified since the last download")
+            return None
+        if response.status_code == 416:
+            # partial file is no longer valid
+            _logger.warning(f"Unable to resume {part_path}; restarting")
+            os.remove(part_path)
+            return download(url, folder_location, sha256, chunk_size)
+        response.raise_for_status()
 
-        total_length = response.headers.get("content-length")
-        if total_length is None:
-            # no content length header
-            f.write(response.content)
+        file_name = _file_name(response, url)
+        file_path = os.path.join(folder_location, file_name)
+        new_part_path = file_path + ".part"
+
+        if response.status_code == 206:
+            # a partial response is only valid as the continuation of the
+            # part file of the Range request
+            if "Range" not in headers:
+                raise IOError(f"Unexpected partial response for {url}")
+            if new_part_path != part_path or _content_range_start(
+                response
+            ) != os.path.getsize(part_path):
+                _logger.warning(
+                    f"Partial response does not continue {part_path}; "
+                    "restarting"
+                )
+                response.close()
+                os.remove(part_path)
+                return download(url, folder_location, sha256, chunk_size)
+            offset = os.path.getsize(part_path)
+            digest = _hash_file(part_path, chunk_size)
+            mode = "ab"
+            _logger.info(f"Resuming download of {file_name} at byte {offset}")
+        elif response.status_code != 200:
+            raise IOError(
+                f"Unexpected status {response.status_code} for {url}"
+            )
         else:
-            dl = 0
-            total_length = int(total_length)
-            for data in response.iter_content(chunk_size=4096):
+            offset = 0
+            digest = hashlib.sha256()
+            mode = "wb"
+            _logger.info("Downloading %s" % file_name)
+
+        new_state = {
+            "file_name": file_name,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "complete": False,
+        }
+        _store_state(state_file, url, new_state)
+
+        total_length = response.headers.get("content-length")
+        if total_length is not None:
+            total_length = int(total_length) + offset
+
+        dl = offset
+        with open(new_part_path, mode) as f:
+            for data in response.iter_content(chunk_size=chunk_size):
                 dl += len(data)
                 f.write(data)
-                done = int(50 * dl / total_length)
-                sys.stdout.write("\r[%s%s]" % ("=" * done, " " * (50 - done)))
-                sys.stdout.flush()
-    print("")
+                digest.update(data)
+                if total_length:
+                    done = int(50 * dl / total_length)
+                    sys.stdout.write(
+                        "\r[%s%s]" % ("=" * done, " " * (50 - done))
+                    )
+                    sys.stdout.flush()
+        if total_length:
+            print("")
+
+    if total_length is not None and dl != total_length:
+        raise IOError(
+            f"Incomplete download of {file_name}: {dl} of {total_length} "
+            "bytes; run again to resume"
+        )
+    digest = digest.hexdigest()
+    if sha256 and digest != sha256.lower():
+        os.remove(new_part_path)
+        raise ValueError(
+            f"Checksum mismatch of {file_name}: {digest} (expected {sha256})"
+        )
+    os.replace(new_part_path, file_path)
+    new_state["sha256"] = digest
+    new_state["complete"] = True
+    _store_state(state_file, url, new_state)
+
+    if digest == url_state.get("sha256"):
+        # server does not support conditional requests, content is unchanged
+        _logger.info(f"{file_name} is unchanged since the last download")
+        os.remove(file_path)
+        return None
     return file_path
 
 
-def extract_and_clean(file_name):
+def _extract_member(fileobj, target_path):
+    """Streams fileobj to target_path."""
+    if not os.path.exists(os.path.dirname(target_path)):
+        os.makedirs(os.path.dirname(target_path))
+    with open(target_path, "wb") as f:
+        shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+
+
+def extract_and_clean(file_name, members=None):
     """
     Extracts and deletes compressed file
+
+    Parameters:
+        file_name (Path): .zip, .tar or .tar.gz file
+        members (list): optional base names of the members to extract, such
+                        as ['patent.txt']; all members are extracted if None
     """
     # Extraction
     _logger.info("Extracting %s" % file_name)
     dir_name = os.path.dirname(os.path.abspath(file_name))
     base_name = os.path.basename(os.path.abspath(file_name))
-    if file_name.endswith("tar.gz"):
-        tar = tarfile.open(file_name, "r:gz")
-        tar.extractall(path=dir_name)
-        tar.close()
-    elif file_name.endswith("tar"):
-        tar = tarfile.open(file_name, "r:")
-        tar.extractall(path=dir_name)
-        tar.close()
+    if file_name.endswith("tar.gz") or file_name.endswith("tar"):
+        with tarfile.open(
+            file_name, "r:gz" if file_name.endswith("tar.gz") else "r:"
+        ) as tar:
+            if members is None:
+                tar.extractall(path=dir_name)
+            else:
+                for member in tar:
+                    if (
+                        member.isfile()
+                        and os.path.basename(member.name) in members
+                        and not os.path.isabs(member.name)
+                        and ".." not in member.name.split("/")
+                    ):
+                        _extract_member(
+                            tar.extractfile(member),
+                            os.path.join(dir_name, member.name),
+                        )
     elif file_name.endswith("zip"):
         with zipfile.ZipFile(file_name, "r") as f:
             extract_dir = os.path.join(dir_name, base_name[:-4])
-            f.extractall(extract_dir)
+            if members is None:
+                f.extractall(extract_dir)
+            else:
+                for info in f.infolist():
+                    if not info.is_dir() and (
+                        os.path.basename(info.filename) in members
+                    ):
+                        with f.open(info) as member:
+                            _extract_member(
+                                member,
+                                os.path.join(
+                                    extract_dir, os.path.basename(info.filename)
+                                ),
+                            )
 
     # Cleanup
     _logger.info("Deleting %s" % file_name)
     if os.path.exists(file_name):
         os.remove(file_name)
-
-
@@ -0,0 +1,199 @@
+"""
+Memory tracking of each NDA group (see metrics.group()), enabled with
+`main.py -track_memory`.
+
+    rss:         a background thread samples the resident set size of the
+                 process every interval seconds; the peak RSS while a group
+                 is processed is stored in the group of the run report
+    tracemalloc: also traces python allocations with tracemalloc, storing the
+                 peak of traced memory of each group, and the top allocation
+                 sites of groups over the memory budget; python runs
+                 noticeably slower while tracing
+
+Groups whose peak RSS (or peak of traced memory if RSS is not available)
+exceeds the memory budget are flagged with 'over_budget' and listed in
+'over_budget_groups' of the run report.
+"""
+
+from contextlib import contextmanager
+import os
+import threading
+import tracemalloc
+
+from utils import metrics
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+MODES = ["rss", "tracemalloc"]
+
+MB = 1 << 20
+
+# seconds between two samples of RSS
+SAMPLING_INTERVAL = 0.05
+
+# number of allocation sites stored for groups over budget
+TOP_ALLOCATIONS = 10
+
+# configuration set by enable()
+_mode = None
+_budget = None
+_sampler = None
+# True if tracemalloc was started by enable(), and is stopped by disable()
+_started_tracemalloc = False
+
+
+def rss_bytes():
+    """Returns the resident set size of this process, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _RSSSampler:
+    """Samples RSS every interval seconds and keeps the peak since reset()."""
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        rss = rss_bytes()
+        with self.lock:
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+        return rss
+
+    def reset(self):
+        """Resets the peak to the current RSS and returns it."""
+        with self.lock:
+            self.peak = None
+        return self.sample()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+
+def _top_allocations():
+    """Returns the top allocation sites of the current tracemalloc snapshot."""
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    return [
+        {
+            "site": str(stat.traceback),
+            "mb": round(stat.size / MB, 3),
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+    ]
+
+
+def _reset_traced_peak():
+    """
+    Resets the peak of traced memory to the current traced memory and returns
+    it, or returns None if the peak cannot be reset.  tracemalloc.reset_peak()
+    is new in Python 3.9; on older versions, tracing started by enable() is
+    restarted instead, and tracing started by others is left as it is.
+    """
+    reset_peak = getattr(tracemalloc, "reset_peak", None)
+    if reset_peak is not None:
+        reset_peak()
+    elif _started_tracemalloc:
+        tracemalloc.stop()
+        tracemalloc.start()
+    else:
+        return None
+    return tracemalloc.get_traced_memory()[0]
+
+
+@contextmanager
+def _track_group(group_):
+    """Group hook of metrics.group() recording the peak memory of a group."""
+    rss_start = _sampler.reset()
+    if _mode == "tracemalloc":
+        traced_start = _reset_traced_peak()
+    try:
+        yield
+    finally:
+        _sampler.sample()
+        rss_peak = _sampler.peak
+        memory = {
+            "rss_start_mb": None if rss_start is None else rss_start / MB,
+            "rss_peak_mb": None if rss_peak is None else rss_peak / MB,
+        }
+        peak = memory["rss_peak_mb"]
+        if _mode == "tracemalloc":
+            memory["traced_peak_mb"] = (
+                None
+                if traced_start is None
+                else (tracemalloc.get_traced_memory()[1] - traced_start) / MB
+            )
+            if peak is None:
+                peak = memory["traced_peak_mb"]
+        memory["over_budget"] = bool(_budget and peak and peak > _budget)
+        if memory["over_budget"]:
+            _logger.warning(
+                f"NDA group {group_['key']} of {group_['kind']} peaked at "
+                f"{peak:.0f} MB, over the budget of {_budget} MB; sizes: "
+                f"{group_['sizes']}"
+            )
+            if _mode == "tracemalloc":
+                memory["top_allocations"] = _top_allocations()
+        group_["memory"] = memory
+
+
+def enable(mode="rss", budget_mb=None):
+    """
+    Enables memory tracking of each NDA group.
+
+    Parameters:
+        mode (String): "rss" or "tracemalloc"
+        budget_mb (float): optional; peak memory in MB over which a group is
+                           flagged in the run report
+    """
+    global _mode, _budget, _sampler, _started_tracemalloc
+    if mode not in MODES:
+        raise ValueError(f"Unknown memory tracking mode: {mode}")
+    if _mode is not None:
+        disable()
+    _mode = mode
+    _budget = budget_mb
+    if rss_bytes() is None:
+        _logger.warning("RSS is not available on this platform")
+    if mode == "tracemalloc" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _sampler = _RSSSampler()
+    _sampler.start()
+    metrics.add_group_hook(_track_group)
+
+
+def disable():
+    """
+    Disables memory tracking.  tracemalloc is stopped only if it was started
+    by enable().
+    """
+    global _mode, _budget, _sampler, _started_tracemalloc
+    metrics.remove_group_hook(_track_group)
+    if _sampler is not None:
+        _sampler.stop()
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+    _mode = None
+    _budget = None
+    _sampler = None
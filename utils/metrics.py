@@ -0,0 +1,274 @@
+"""
+Lightweight timers and counters of the stages of a run, such as
+'diff.get_diff' or 'similarity.encoding', and of each NDA group.
+
+    with metrics.group("diff", nda_group_key):
+        for set_id_group in metrics.timed_iter(cursor, "diff.mongo_read"):
+            with metrics.timer("diff.get_diff", docs=len(set_id_group)):
+                ...
+
+Timings are kept in memory for the whole process; report() summarizes them
+(p50/p95/max per stage, docs/sec, slowest NDA groups), write_report() stores
+the summary as json, and write_prometheus() as a Prometheus textfile.
+"""
+
+from array import array
+from contextlib import contextmanager, ExitStack
+from datetime import datetime
+import json
+import numpy as np
+import os
+import threading
+import time
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+_lock = threading.Lock()
+_local = threading.local()
+
+# {stage: array of seconds per call}
+_stage_seconds = {}
+# {stage: number of docs processed}
+_stage_docs = {}
+# {name: count}
+_counters = {}
+# {group id: {"kind":..., "key":..., "seconds":..., "stages": {stage: s},
+#              "sizes": {name: n}}}
+_groups = {}
+# callables of group dict returning a context manager entered around a group
+_group_hooks = []
+_started_at = time.time()
+
+
+def reset():
+    """Clears all timings and counters."""
+    global _started_at
+    with _lock:
+        _stage_seconds.clear()
+        _stage_docs.clear()
+        _counters.clear()
+        _groups.clear()
+        _started_at = time.time()
+
+
+def add_group_hook(hook):
+    """
+    Adds hook, a callable of the group dict returning a context manager, which
+    is entered around each group, such as a profiler.
+    """
+    _group_hooks.append(hook)
+
+
+def remove_group_hook(hook):
+    """Removes hook added by add_group_hook()."""
+    if hook in _group_hooks:
+        _group_hooks.remove(hook)
+
+
+def current_group():
+    """Returns the group dict of the current thread, or None."""
+    return getattr(_local, "group", None)
+
+
+def record(stage, seconds, docs=0):
+    """Records one call of stage that took seconds and processed docs."""
+    with _lock:
+        _stage_seconds.setdefault(stage, array("d")).append(seconds)
+        _stage_docs[stage] = _stage_docs.get(stage, 0) + docs
+        group_ = current_group()
+        if group_ is not None:
+            group_["stages"][stage] = group_["stages"].get(stage, 0) + seconds
+            group_["docs"][stage] = group_["docs"].get(stage, 0) + docs
+
+
+@contextmanager
+def timer(stage, docs=0):
+    """Times the enclosed block as one call of stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, docs)
+
+
+def timed_iter(iterable, stage):
+    """
+    Yields the items of iterable, timing each step as one call of stage, such
+    as the reads of a MongoDB cursor.  Lists count as len(item) docs.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            record(stage, time.perf_counter() - start, 0)
+            return
+        docs = len(item) if isinstance(item, list) else 1
+        record(stage, time.perf_counter() - start, docs)
+        yield item
+
+
+def count(name, n=1):
+    """Adds n to the counter name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def add_sizes(**sizes):
+    """
+    Adds sizes (ex: labels=10, additions=200) to the sizes of the current
+    group, if any.
+    """
+    group_ = current_group()
+    if group_ is not None:
+        with _lock:
+            for name, n in sizes.items():
+                group_["sizes"][name] = group_["sizes"].get(name, 0) + n
+
+
+@contextmanager
+def group(kind, key):
+    """
+    Times the enclosed block as the processing of the NDA group key within
+    the stage kind (ex: 'diff'); timers within the block are also attributed
+    to the group.  Yields the group dict.
+    """
+    group_ = {
+        "kind": kind,
+        "key": key,
+        "seconds": 0.0,
+        "stages": {},
+        "docs": {},
+        "sizes": {},
+    }
+    previous = current_group()
+    _local.group = group_
+    try:
+        with ExitStack() as stack:
+            for hook in list(_group_hooks):
+                stack.enter_context(hook(group_))
+            start = time.perf_counter()
+            try:
+                yield group_
+            finally:
+                group_["seconds"] = time.perf_counter() - start
+    finally:
+        _local.group = previous
+        with _lock:
+            _groups[f"{kind}:{key}"] = group_
+        record(f"{kind}.group", group_["seconds"])
+
+
+def _summary(seconds, docs):
+    """Returns the summary of an array of seconds per call."""
+    values = np.frombuffer(seconds, dtype="float64")
+    total = float(values.sum())
+    return {
+        "calls": int(len(values)),
+        "seconds": total,
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(values.max()),
+        "docs": docs,
+        "docs_per_sec": docs / total if total > 0 else None,
+    }
+
+
+def report(slowest=10):
+    """
+    Returns a dict summarizing all stages, counters, the slowest NDA groups
+    of each kind, and NDA groups flagged over the memory budget by
+    utils/memory.py.
+
+    Parameters:
+        slowest (int): number of slowest groups of each kind to include
+    """
+    with _lock:
+        stages = {
+            stage: _summary(seconds, _stage_docs.get(stage, 0))
+            for stage, seconds in sorted(_stage_seconds.items())
+            if len(seconds)
+        }
+        groups = list(_groups.values())
+        counters = dict(_counters)
+    slowest_groups = {}
+    over_budget_groups = {}
+    for kind in sorted(set(x["kind"] for x in groups)):
+        slowest_groups[kind] = sorted(
+            (x for x in groups if x["kind"] == kind),
+            key=lambda x: x["seconds"],
+            reverse=True,
+        )[:slowest]
+        over_budget = [
+            x
+            for x in groups
+            if x["kind"] == kind and (x.get("memory") or {}).get("over_budget")
+        ]
+        if over_budget:
+            over_budget_groups[kind] = over_budget
+    return {
+        "started_at": datetime.fromtimestamp(_started_at).isoformat(),
+        "elapsed": time.time() - _started_at,
+        "stages": stages,
+        "counters": counters,
+        "groups": {
+            kind: sum(1 for x in groups if x["kind"] == kind)
+            for kind in slowest_groups
+        },
+        "slowest_groups": slowest_groups,
+        "over_budget_groups": over_budget_groups,
+    }
+
+
+def write_report(file_name, slowest=10):
+    """Stores report() as json to file_name and returns the report."""
+    run_report = report(slowest)
+    if os.path.dirname(file_name) and not os.path.exists(
+        os.path.dirname(file_name)
+    ):
+        os.makedirs(os.path.dirname(file_name))
+    with open(file_name, "w") as f:
+        json.dump(run_report, f, indent=2)
+    _logger.info(f"Stored run report to {file_name}")
+    return run_report
+
+
+def write_prometheus(file_name, prefix="scoring_data_processor"):
+    """
+    Stores the stage timings and counters to file_name in the Prometheus
+    text format, for the textfile collector of node_exporter.
+    """
+    run_report = report(0)
+    lines = [
+        f"# TYPE {prefix}_stage_seconds summary",
+    ]
+    for stage, summary in run_report["stages"].items():
+        for quantile, key in [("0.5", "p50"), ("0.95", "p95"), ("1", "max")]:
+            lines.append(
+                f'{prefix}_stage_seconds{{stage="{stage}",'
+                f'quantile="{quantile}"}} {summary[key]}'
+            )
+        lines.append(
+            f'{prefix}_stage_seconds_sum{{stage="{stage}"}} '
+            f'{summary["seconds"]}'
+        )
+        lines.append(
+            f'{prefix}_stage_seconds_count{{stage="{stage}"}} '
+            f'{summary["calls"]}'
+        )
+    lines.append(f"# TYPE {prefix}_stage_docs_total counter")
+    for stage, summary in run_report["stages"].items():
+        lines.append(
+            f'{prefix}_stage_docs_total{{stage="{stage}"}} {summary["docs"]}'
+        )
+    lines.append(f"# TYPE {prefix}_events_total counter")
+    for name, value in run_report["counters"].items():
+        lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+    # written atomically for the textfile collector
+    with open(str(file_name) + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(str(file_name) + ".tmp", file_name)
+    _logger.info(f"Stored Prometheus metrics to {file_name}")
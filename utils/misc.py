@@ -76,6 +76,15 @@ def get_num_in_str(text):
     return int(re.search(r"([0-9]+)", text, re.I).groups()[0])
 
 
+def nda_group_key(application_numbers):
+    """
+    Return the canonical key of a list of application numbers, which is
+    identical for all labels of an NDA group regardless of order (ex:
+    ['NDA020616', 'NDA019501'] returns 'NDA019501;NDA020616').
+    """
+    return ";".join(sorted(set(str(x) for x in application_numbers)))
+
+
 def is_number(string):
     """
     Test if string is a float.
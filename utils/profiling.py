@@ -0,0 +1,261 @@
+"""
+Profiling of the stages of a run (diff, similarity, export), or of only the
+slowest NDA groups of each stage, enabled with `main.py -profile`.
+
+Two modes are supported:
+
+    cprofile: deterministic profiling with cProfile; writes <name>.pstats
+              (load with pstats or snakeviz) and <name>.callers.collapsed
+    sampling: samples the stack of the profiled thread every interval seconds;
+              writes <name>.collapsed, with a much lower overhead
+
+'.collapsed' files hold one 'frame;frame;frame count' line per stack, the
+input of flamegraph.pl or speedscope.  As cProfile does not record full
+stacks, the '.callers.collapsed' file of cprofile is not a flamegraph of full
+stacks: it has one two-frame 'caller;callee' line per call edge, weighted by
+the time spent in the callee (in microseconds).
+"""
+
+from collections import Counter
+import cProfile
+from contextlib import contextmanager
+import heapq
+import itertools
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+from utils import metrics
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+MODES = ["cprofile", "sampling"]
+
+# seconds between two samples of the sampling mode
+SAMPLING_INTERVAL = 0.005
+
+# configuration set by enable()
+_mode = None
+_folder = None
+_groups = None
+# {stage: profiler} of profiled stages
+_stage_profilers = {}
+# {kind: set of group keys} to profile, read from a previous run report
+_group_keys = None
+# {kind: heap of (seconds, order, key, profiler)} of the slowest groups
+_slowest = {}
+_order = itertools.count()
+
+
+def _frame_name(file_name, function_name):
+    """Returns the 'file:function' name of a frame."""
+    return f"{os.path.basename(file_name)}:{function_name}"
+
+
+class _CProfiler:
+    """Wraps cProfile.Profile; can be started and stopped repeatedly."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, file_prefix):
+        self.profile.dump_stats(file_prefix + ".pstats")
+        stats = pstats.Stats(self.profile).stats
+        lines = Counter()
+        # stats = {(file, line, function): (cc, nc, tottime, cumtime,
+        #                                    {caller: (cc, nc, tt, ct)})}
+        for function, (_, _, tottime, _, callers) in stats.items():
+            name = _frame_name(function[0], function[2])
+            if not callers:
+                lines[name] += int(tottime * 1e6)
+            for caller, caller_stats in callers.items():
+                caller_name = _frame_name(caller[0], caller[2])
+                lines[f"{caller_name};{name}"] += int(caller_stats[2] * 1e6)
+        _write_collapsed(file_prefix + ".callers.collapsed", lines)
+
+
+class _Sampler:
+    """
+    Samples the stack of the thread that starts it every interval seconds,
+    from a background thread.
+    """
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(_frame_name(code.co_filename, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, file_prefix):
+        _write_collapsed(file_prefix + ".collapsed", self.stacks)
+
+
+def _write_collapsed(file_name, stacks):
+    """Writes a Counter of {stack: count} as a collapsed stack file."""
+    with open(file_name, "w") as f:
+        for stack, count in sorted(stacks.items()):
+            if count > 0:
+                f.write(f"{stack} {count}\n")
+
+
+def _profiler():
+    return _CProfiler() if _mode == "cprofile" else _Sampler()
+
+
+def _file_prefix(*names):
+    """Returns the path of the output files of names, without extension."""
+    name = "-".join(re.sub(r"[^\w.-]", "_", str(x)) for x in names)
+    return os.path.join(_folder, name)
+
+
+def slowest_group_keys(run_report_file, n):
+    """
+    Returns {kind: set of keys} of the n slowest groups of each kind in a
+    run report stored by metrics.write_report(), or None if there is none.
+    """
+    if not run_report_file or not os.path.exists(run_report_file):
+        return None
+    with open(run_report_file) as f:
+        slowest_groups = json.load(f).get("slowest_groups", {})
+    return {
+        kind: set(x["key"] for x in groups[:n])
+        for kind, groups in slowest_groups.items()
+    }
+
+
+@contextmanager
+def _profile_group(group_):
+    """Group hook of metrics.group() profiling the slowest groups."""
+    kind, key = group_["kind"], group_["key"]
+    if _group_keys is not None and key not in _group_keys.get(kind, ()):
+        yield
+        return
+    profiler = _profiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        # keep the profiles of the _groups slowest groups of each kind
+        heap = _slowest.setdefault(kind, [])
+        entry = (group_["seconds"], next(_order), key, profiler)
+        if len(heap) < _groups:
+            heapq.heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+
+
+def enable(mode, folder, groups=None, run_report_file=None):
+    """
+    Enables profiling of the stages of the run, or of the slowest NDA groups.
+
+    Parameters:
+        mode (String): "cprofile" or "sampling"
+        folder (Path): folder to store the profiles
+        groups (int): optional; if set, profile only the groups slowest NDA
+                      groups of each stage instead of the whole stages
+        run_report_file (Path): optional run report of a previous run; if
+                                set with groups, only the slowest groups of
+                                that run are profiled, otherwise all groups
+                                are profiled with the sampling mode and the
+                                slowest are kept
+    """
+    global _mode, _folder, _groups, _group_keys
+    if mode not in MODES:
+        raise ValueError(f"Unknown profiling mode: {mode}")
+    _mode = mode
+    _folder = str(folder)
+    _groups = groups
+    if not os.path.exists(_folder):
+        os.makedirs(_folder)
+    if groups:
+        _group_keys = slowest_group_keys(run_report_file, groups)
+        if _group_keys is None:
+            if _mode != "sampling":
+                # cProfile would slow down every NDA group of the run
+                _logger.warning(
+                    f"Profiling all NDA groups with sampling instead of {mode}"
+                )
+                _mode = "sampling"
+            _logger.warning(
+                "No run report of a previous run; profiling all NDA groups "
+                f"and keeping the {groups} slowest of each stage"
+            )
+        metrics.add_group_hook(_profile_group)
+
+
+def disable():
+    """Disables profiling and discards all profiles not yet written."""
+    global _mode, _groups, _group_keys
+    metrics.remove_group_hook(_profile_group)
+    _mode = None
+    _groups = None
+    _group_keys = None
+    _stage_profilers.clear()
+    _slowest.clear()
+
+
+@contextmanager
+def stage(name):
+    """
+    Profiles the enclosed block as part of stage name (ex: 'diff') if
+    profiling of stages is enabled; a stage may be entered several times.
+    """
+    if _mode is None or _groups:
+        yield
+        return
+    if name not in _stage_profilers:
+        _stage_profilers[name] = _profiler()
+    profiler = _stage_profilers[name]
+    start = time.perf_counter()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        _logger.info(
+            f"Profiled stage {name} ({time.perf_counter() - start:.1f}s)"
+        )
+
+
+def write_profiles():
+    """Writes the profiles of all stages and groups to the profile folder."""
+    for name, profiler in _stage_profilers.items():
+        profiler.write(_file_prefix(name))
+    for kind, heap in _slowest.items():
+        for _, _, key, profiler in heap:
+            profiler.write(_file_prefix(kind, key))
+    if _stage_profilers or _slowest:
+        _logger.info(f"Stored {_mode} profiles to {_folder}")